@@ -0,0 +1,504 @@
+# Async (ASGI) serving mode for the analytics read API
+#
+# The same read routes as analytics_backend_example, on asyncpg with an async
+# connection pool and served by uvicorn. A slow aggregate only holds a
+# pooled connection while it runs, not a worker thread, so one process keeps
+# serving other clients while popular-books or timeline queries are in
+# flight. SQL and response shaping come from analytics_queries, so the JSON
+# contracts are identical to the Flask app.
+#
+# Sync ingest, exports and the CLI stay on the Flask app; the response cache
+# (threading based) is not used here.
+#
+#   python analytics_asgi.py                      # production entry point
+#   uvicorn analytics_asgi:app --port 8080        # or run uvicorn directly
+#
+# Requires: asyncpg, starlette, uvicorn
+
+import asyncio
+import contextlib
+import json
+import os
+import re
+import time
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+from analytics_dashboard import DASHBOARD_SECTIONS, RANGE_SECTIONS
+from analytics_etag import CACHE_CONTROL, SYNC_WATERMARK_SQL, etag_matches, make_etag
+from analytics_json import compress, dumps, negotiate_encoding
+from analytics_hll import (
+    SKETCHED_DAYS_FILTER, SKETCHED_BOOKS_FILTER, DAILY_SKETCHES_SQL, BOOK_SKETCHES_SQL,
+    apply_daily_sketches, apply_book_sketches,
+)
+from analytics_jobs import JOB_RESULT_SQL, result_info
+from analytics_overview import SNAPSHOT_SQL as OVERVIEW_SNAPSHOT_SQL, snapshot_info
+from analytics_pagination import InvalidCursor, next_cursor
+from analytics_regions import (
+    REGION_LEVELS, REGION_ROOT_SQL, REGIONS_SQL, REGION_SQL, region_schools_query,
+)
+from analytics_queries import (
+    get_time_range_ms, OVERVIEW_CURRENT_SQL, OVERVIEW_PREVIOUS_SQL, overview_payload,
+    schools_stats_query, popular_books_query, TIMELINE_SQL, BOOKS_BY_GRADE_SQL,
+    sync_logs_query, DEVICE_STATS_SQL, SYNC_STATUS_SQL, SYNC_TOTALS_SQL, sync_status_params,
+    sync_status_payload, PAGE_ENGAGEMENT_BOOK_SQL, PAGE_ENGAGEMENT_TOP_SQL,
+    SCHOOL_TIMELINE_SQL, BOOK_DETAILS_SQL, BOOK_SCHOOLS_SQL, READING_PATTERNS_SQL,
+)
+from analytics_sync_stats import (
+    DURATION_HISTOGRAM_SQL, ALL_HISTORY, duration_summary, since_day, slowest_schools_query,
+)
+from analytics_rollups import (
+    rollup_timeline_query, rollup_school_timeline_query, rollup_reading_patterns_query,
+)
+from analytics_topk import top_books_query, top_pages_query
+
+# Same database and settings as analytics_backend_example
+DB_CONFIG = {
+    'host': 'localhost',
+    'database': 'right_to_read_db',
+    'user': 'postgres',
+    'password': 'your_password',
+    'port': 5432
+}
+
+ASYNC_POOL_CONFIG = {
+    'min_size': 2,
+    'max_size': 20,
+    'max_inactive_connection_lifetime': 300.0,  # recycle idle connections
+    'command_timeout': 30.0,
+}
+CHECKOUT_TIMEOUT = 5.0  # seconds to wait for a free connection
+
+USE_ROLLUPS = True
+
+DASHBOARD_SECTION_TIMEOUT = 10.0
+
+# Conditional GET (analytics_etag); None disables ETags
+ETAG_TIME_BUCKET = 3600
+
+# Compress (brotli / gzip, see analytics_json) responses from this many bytes up
+COMPRESS_MIN_SIZE = 1024
+
+SERVER_CONFIG = {
+    'host': os.environ.get('ANALYTICS_HOST', '0.0.0.0'),
+    'port': int(os.environ.get('ANALYTICS_PORT', 8080)),
+    'workers': int(os.environ.get('ANALYTICS_WORKERS', os.cpu_count() or 1)),
+}
+
+
+# ============================================================================
+# DATABASE
+# ============================================================================
+
+_PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def to_asyncpg(query, params=None):
+    """Rewrite a psycopg2-style statement to asyncpg's $n placeholders
+
+    Returns (query, args). Named parameters used more than once map to the
+    same $n.
+    """
+    params = params or ()
+    args, names = [], {}
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            args.append(params[len(args)])
+            return '$%d' % len(args)
+        if name not in names:
+            args.append(params[name])
+            names[name] = len(args)
+        return '$%d' % names[name]
+
+    return _PLACEHOLDER_RE.sub(replace, query), args
+
+
+async def _init_connection(conn):
+    # psycopg2 decodes json columns (sync status recentErrors); match it
+    await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+class Database:
+    """Thin wrapper over an asyncpg pool returning rows as dicts"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetch(self, query, params=None):
+        query, args = to_asyncpg(query, params)
+        async with self.pool.acquire(timeout=CHECKOUT_TIMEOUT) as conn:
+            return [dict(row) for row in await conn.fetch(query, *args)]
+
+    async def fetchone(self, query, params=None):
+        rows = await self.fetch(query, params)
+        return rows[0] if rows else None
+
+    def stats(self):
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {'inUse': size - idle, 'idle': idle, 'size': size}
+
+
+# ============================================================================
+# JSON
+# ============================================================================
+
+def json_response(body, status_code=200):
+    return Response(dumps(body) + b'\n', status_code=status_code, media_type='application/json')
+
+
+def compressed(request, response):
+    """Compress a response body as the client's Accept-Encoding allows"""
+    response.headers.add_vary_header('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('accept-encoding'))
+    if encoding is not None and len(response.body) >= COMPRESS_MIN_SIZE:
+        response.body = compress(response.body, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(response.body))
+    return response
+
+
+def _int_arg(params, name, default=None):
+    """request.args.get(name, default, type=int)"""
+    try:
+        return int(params[name])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+# ============================================================================
+# ROUTES
+# ============================================================================
+# Each handler takes (db, params) and returns the response body without the
+# `success` flag. LookupError means 404, InvalidCursor 400.
+
+async def get_overview_stats(db, params):
+    # The snapshot is refreshed by the Flask app (analytics_overview)
+    snapshot, root = await asyncio.gather(db.fetchone(OVERVIEW_SNAPSHOT_SQL), db.fetchone(REGION_ROOT_SQL))
+    if snapshot:
+        # Totals from the region tree's root, time-windowed figures from the snapshot
+        data = overview_payload({**snapshot, **(root or {})}, snapshot)
+        return {'data': data, 'snapshot': snapshot_info(snapshot)}
+    current = await db.fetchone(OVERVIEW_CURRENT_SQL)
+    previous = await db.fetchone(OVERVIEW_PREVIOUS_SQL)
+    return {'data': overview_payload(current, previous), 'snapshot': None}
+
+
+async def get_schools_stats(db, params):
+    limit = _int_arg(params, 'limit', 50)
+    query, args, scope = schools_stats_query(
+        params.get('sortBy', 'totalReadingTime'), limit, _int_arg(params, 'offset', 0), params.get('cursor'))
+    schools = await db.fetch(query, args)
+    return {'data': schools, 'nextCursor': next_cursor(schools, limit, scope, '_sortKey')}
+
+
+async def get_regions(db, params):
+    level = params['level']
+    if level != 'global' and level not in REGION_LEVELS:
+        raise LookupError('Unknown region level %s' % level)
+    return {'data': await db.fetch(REGIONS_SQL, (level,))}
+
+
+async def get_region_schools(db, params):
+    level, name = params['level'], params.get('name', '')
+    if level not in REGION_LEVELS:
+        raise LookupError('Unknown region level %s' % level)
+    region, schools = await asyncio.gather(
+        db.fetchone(REGION_SQL, (level, name)),
+        db.fetch(*region_schools_query(
+            level, name, params.get('sortBy', 'totalReadingTime'), _int_arg(params, 'limit', 10))),
+    )
+    if not region:
+        raise LookupError('Region not found')
+    region['topSchools'] = schools
+    return {'data': region}
+
+
+async def get_popular_books(db, params):
+    exact = params.get('exact') == 'true'
+    limit = _int_arg(params, 'limit', 10)
+    if params.get('window') is not None:
+        # Windowed rankings straight from the rollups (the Flask app serves
+        # them from its in-memory analytics_topk engine)
+        return {'data': await db.fetch(*top_books_query(params['window'], limit)), 'window': params['window']}
+    if not exact:
+        # Ranked by the Flask app's book_popularity job (analytics_jobs)
+        result = await db.fetchone(JOB_RESULT_SQL, ('book_popularity',))
+        if result is not None:
+            return {'data': result['output'][:limit], 'job': result_info(result)}
+    books = await db.fetch(*popular_books_query(limit, '' if exact else SKETCHED_BOOKS_FILTER))
+    if not exact and books:
+        apply_book_sketches(books, await db.fetch(BOOK_SKETCHES_SQL, ([book['bookId'] for book in books],)))
+    return {'data': books, 'job': None}
+
+
+async def get_timeline_data(db, params):
+    exact = params.get('exact') == 'true'
+    start_time, end_time = get_time_range_ms(params.get('range', '30d'))
+    if USE_ROLLUPS:
+        query, args = rollup_timeline_query(start_time, end_time, '' if exact else SKETCHED_DAYS_FILTER)
+        if exact:
+            return {'data': await db.fetch(query, args)}
+        timeline, sketches = await asyncio.gather(db.fetch(query, args), db.fetch(DAILY_SKETCHES_SQL, args))
+        return {'data': apply_daily_sketches(timeline, sketches)}
+    return {'data': await db.fetch(TIMELINE_SQL, (start_time, end_time))}
+
+
+async def get_books_by_grade(db, params):
+    return {'data': await db.fetch(BOOKS_BY_GRADE_SQL)}
+
+
+async def get_sync_logs(db, params):
+    limit = _int_arg(params, 'limit', 50)
+    query, args, scope = sync_logs_query(limit, _int_arg(params, 'offset', 0), params.get('cursor'))
+    logs = await db.fetch(query, args)
+    return {'data': logs, 'nextCursor': next_cursor(logs, limit, scope, 'createdAt')}
+
+
+async def get_device_stats(db, params):
+    return {'data': await db.fetch(DEVICE_STATS_SQL)}
+
+
+async def get_sync_status(db, params):
+    row, result, histogram = await asyncio.gather(
+        db.fetchone(SYNC_STATUS_SQL, sync_status_params()),
+        db.fetchone(JOB_RESULT_SQL, ('sync_totals',)),
+        db.fetch(DURATION_HISTOGRAM_SQL, (ALL_HISTORY,)),
+    )
+    durations = duration_summary(histogram)
+    if result is None:
+        return {'data': sync_status_payload(row, await db.fetchone(SYNC_TOTALS_SQL), durations), 'job': None}
+    return {'data': sync_status_payload(row, result['output'], durations), 'job': result_info(result)}
+
+
+async def get_sync_durations(db, params):
+    start_time, _ = get_time_range_ms(params.get('range', '30d'))
+    since = since_day(start_time)
+    histogram, slowest = await asyncio.gather(
+        db.fetch(DURATION_HISTOGRAM_SQL, (since,)),
+        db.fetch(*slowest_schools_query(
+            since, _int_arg(params, 'limit', 10), params.get('sortBy', 'averageDuration'))),
+    )
+    return {'data': {**duration_summary(histogram), 'slowestSchools': slowest}}
+
+
+async def get_page_engagement(db, params):
+    book_id = _int_arg(params, 'bookId')
+    if params.get('window') is not None and not book_id:
+        pages = await db.fetch(*top_pages_query(params['window'], _int_arg(params, 'limit', 50)))
+        return {'data': pages, 'window': params['window']}
+    if book_id:
+        return {'data': await db.fetch(PAGE_ENGAGEMENT_BOOK_SQL, (book_id,))}
+    return {'data': await db.fetch(PAGE_ENGAGEMENT_TOP_SQL)}
+
+
+async def get_school_timeline(db, params):
+    school_id = params['school_id']
+    start_time, end_time = get_time_range_ms(params.get('range', '30d'))
+    if USE_ROLLUPS:
+        return {'data': await db.fetch(*rollup_school_timeline_query(school_id, start_time, end_time))}
+    return {'data': await db.fetch(SCHOOL_TIMELINE_SQL, (school_id, start_time, end_time))}
+
+
+async def get_book_details(db, params):
+    book_id = params['book_id']
+    # Both statements are independent; run them on two connections at once
+    book, schools = await asyncio.gather(
+        db.fetchone(BOOK_DETAILS_SQL, (book_id, book_id)),
+        db.fetch(BOOK_SCHOOLS_SQL, (book_id,)),
+    )
+    if not book:
+        raise LookupError('Book not found')
+    book['schoolsUsing'] = schools
+    return {'data': book}
+
+
+async def get_reading_patterns(db, params):
+    start_time, end_time = get_time_range_ms('30d')
+    if USE_ROLLUPS:
+        return {'data': await db.fetch(*rollup_reading_patterns_query(start_time, end_time))}
+    return {'data': await db.fetch(READING_PATTERNS_SQL, (start_time,))}
+
+
+READ_ROUTES = [
+    ('/api/analytics/overview', get_overview_stats),
+    ('/api/analytics/schools/stats', get_schools_stats),
+    ('/api/analytics/regions/{level}', get_regions),
+    ('/api/analytics/regions/{level}/schools', get_region_schools),
+    ('/api/analytics/books/popular', get_popular_books),
+    ('/api/analytics/timeline', get_timeline_data),
+    ('/api/analytics/books/by-grade', get_books_by_grade),
+    ('/api/analytics/sync/logs', get_sync_logs),
+    ('/api/analytics/device/stats', get_device_stats),
+    ('/api/analytics/sync/status', get_sync_status),
+    ('/api/analytics/sync/durations', get_sync_durations),
+    ('/api/analytics/pages/engagement', get_page_engagement),
+    ('/api/analytics/schools/{school_id:int}/timeline', get_school_timeline),
+    ('/api/analytics/books/{book_id:int}/details', get_book_details),
+    ('/api/analytics/reading-patterns', get_reading_patterns),
+]
+
+HANDLERS = dict(READ_ROUTES)
+
+
+async def current_etag(request):
+    """ETag of `request` at the current sync watermark, None if disabled"""
+    if ETAG_TIME_BUCKET is None:
+        return None
+    row = await request.app.state.db.fetchone(SYNC_WATERMARK_SQL)
+    return make_etag(row['watermark'], request.url.path, request.query_params.multi_items(), ETAG_TIME_BUCKET)
+
+
+def not_modified(request, etag):
+    """304 response if the client's If-None-Match matches `etag`"""
+    if etag is not None and etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
+    return None
+
+
+def tag(response, etag):
+    if etag is not None:
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def endpoint(handler):
+    """Wrap a (db, params) handler with the API's success/error envelope"""
+    async def run(request):
+        params = {**request.query_params, **request.path_params}
+        try:
+            etag = await current_etag(request)
+            cached = not_modified(request, etag)
+            if cached is not None:
+                return cached
+            body = await handler(request.app.state.db, params)
+            return tag(compressed(request, json_response({'success': True, **body})), etag)
+        except InvalidCursor as e:
+            return json_response({'success': False, 'error': str(e)}, 400)
+        except LookupError as e:
+            return json_response({'success': False, 'error': str(e)}, 404)
+        except Exception as e:
+            return json_response({'success': False, 'error': str(e)}, 500)
+    return run
+
+
+# ============================================================================
+# DASHBOARD BUNDLE
+# ============================================================================
+
+async def _run_section(db, path, args):
+    """Run one section handler; returns (data, error, elapsed_ms)"""
+    started = time.perf_counter()
+    try:
+        body = await asyncio.wait_for(HANDLERS[path](db, args), DASHBOARD_SECTION_TIMEOUT)
+        data, error = body['data'], None
+    except asyncio.TimeoutError:
+        data, error = None, 'Timed out after %.1fs' % DASHBOARD_SECTION_TIMEOUT
+    except Exception as e:
+        data, error = None, str(e)
+    return data, error, round((time.perf_counter() - started) * 1000, 1)
+
+
+async def get_dashboard_bundle(request):
+    try:
+        started = time.perf_counter()
+        sections = request.query_params.get('sections')
+        sections = [name.strip() for name in sections.split(',')] if sections else None
+        unknown = [name for name in sections or [] if name not in DASHBOARD_SECTIONS]
+        if unknown:
+            return json_response({'success': False, 'error': 'Unknown sections: %s' % ', '.join(unknown)}, 400)
+
+        etag = await current_etag(request)
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+
+        range_str = request.query_params.get('range')
+        names = [name for name in (sections or DASHBOARD_SECTIONS) if name in DASHBOARD_SECTIONS]
+        runs = []
+        for name in names:
+            path, args = DASHBOARD_SECTIONS[name]
+            args = {key: str(value) for key, value in args.items()}
+            if range_str and name in RANGE_SECTIONS:
+                args['range'] = range_str
+            runs.append(_run_section(request.app.state.db, path, args))
+
+        data, errors, timings = {}, {}, {}
+        for name, (data[name], error, timings[name]) in zip(names, await asyncio.gather(*runs)):
+            if error:
+                errors[name] = error
+
+        response = json_response({
+            'success': len(errors) < len(data),
+            'partial': bool(errors) and len(errors) < len(data),
+            'data': data,
+            'errors': errors,
+            'timings': timings,
+            'totalMs': round((time.perf_counter() - started) * 1000, 1),
+        }, 200 if len(errors) < len(data) else 500)
+        if errors:
+            # Never revalidate a partial bundle with a 304
+            response.headers['Cache-Control'] = 'no-store'
+            return compressed(request, response)
+        return tag(compressed(request, response), etag)
+
+    except Exception as e:
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def get_pool_stats(request):
+    return json_response({'success': True, 'data': request.app.state.db.stats()})
+
+
+async def not_found(request, exc):
+    return json_response({'success': False, 'error': 'Endpoint not found'}, 404)
+
+
+async def internal_error(request, exc):
+    return json_response({'success': False, 'error': 'Internal server error'}, 500)
+
+
+# ============================================================================
+# APP
+# ============================================================================
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    pool = await asyncpg.create_pool(init=_init_connection, **DB_CONFIG, **ASYNC_POOL_CONFIG)
+    app.state.db = Database(pool)
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[Route(path, endpoint(handler), methods=['GET']) for path, handler in READ_ROUTES] + [
+        Route('/api/analytics/dashboard', get_dashboard_bundle, methods=['GET']),
+        Route('/api/analytics/_pool', get_pool_stats, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={404: not_found, 500: internal_error},
+    lifespan=lifespan,
+)
+
+# ============================================================================
+# RUN SERVER
+# ============================================================================
+
+if __name__ == '__main__':
+    import uvicorn
+
+    # Each worker process has its own pool: size max_size * workers against
+    # Postgres max_connections
+    uvicorn.run('analytics_asgi:app', proxy_headers=True, access_log=False, **SERVER_CONFIG)
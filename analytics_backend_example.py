@@ -1,13 +1,62 @@
 # Python Flask Backend Example for Analytics API
 # This is a starter template - adapt to your existing backend structure
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import click
 import time
 from datetime import datetime, timedelta
 
+from analytics_columnar import ColumnarEngine
+from analytics_dashboard import DashboardBundler, DASHBOARD_SECTIONS
+from analytics_datagen import generate_dataset
+from analytics_db import init_pool, get_pool, get_request_connection, init_replicas, get_read_connection
+from analytics_jobs import JOBS, JobScheduler, job_output, job_status, run_job
+from analytics_metrics import InstrumentedCursor, InstrumentedTupleCursor, init_metrics
+from analytics_hll import (
+    SKETCHED_DAYS_FILTER, SKETCHED_BOOKS_FILTER, DAILY_SKETCHES_SQL, BOOK_SKETCHES_SQL,
+    apply_daily_sketches, apply_book_sketches, add_sync_to_sketches, rebuild_sketches, range_counts,
+)
+from analytics_memo import (
+    EntityMemo, WARM_BOOKS_SQL, WARM_SCHOOLS_SQL, init_memo, memoized, start_entity_listener,
+    start_memo_warmup,
+)
+from analytics_migrations import migrate, status as migration_status
+from analytics_overview import (
+    SNAPSHOT_SQL as OVERVIEW_SNAPSHOT_SQL, OverviewSnapshotter, snapshot_info,
+    refresh_overview_snapshot,
+)
+from analytics_partitions import (
+    ensure_partitions, list_partitions, prune_partitions, start_partition_maintainer,
+)
+from analytics_cache import (
+    init_cache, get_cache, cached, MemoryLRUBackend, start_sync_listener,
+    init_conditional_get, conditional, init_response_encoding,
+)
+from analytics_pagination import InvalidCursor, next_cursor
+from analytics_regions import (
+    REGION_LEVELS, REGION_ROOT_SQL, REGIONS_SQL, REGION_SQL, region_schools_query,
+)
+from analytics_queries import (
+    get_time_range_ms, fetch_dicts, OVERVIEW_CURRENT_SQL, OVERVIEW_PREVIOUS_SQL, overview_payload,
+    schools_stats_query, popular_books_query, TIMELINE_SQL, TIMELINE_RANGE_SQL, BOOKS_BY_GRADE_SQL,
+    sync_logs_query, DEVICE_STATS_SQL, SYNC_STATUS_SQL, SYNC_TOTALS_SQL, sync_status_params,
+    sync_status_payload, PAGE_ENGAGEMENT_BOOK_SQL, PAGE_ENGAGEMENT_TOP_SQL,
+    SCHOOL_TIMELINE_SQL, BOOK_DETAILS_SQL, BOOK_SCHOOLS_SQL, READING_PATTERNS_SQL,
+)
+from analytics_export import EXPORTS, EXPORT_FORMATS, stream_rows
+from analytics_sync import (
+    SyncPayloadError, parse_sync_payload, ingest_sync, record_sync_log,
+)
+from analytics_sync_stats import (
+    DURATION_HISTOGRAM_SQL, ALL_HISTORY, duration_summary, since_day, slowest_schools_query,
+)
+from analytics_rollups import (
+    ROLLUP_TIMEZONE, rebuild_rollups, rollup_timeline_query, rollup_range_query, rollup_school_timeline,
+    rollup_reading_patterns,
+)
+from analytics_topk import TopKEngine, top_books_query, top_pages_query, window_first_day
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
@@ -20,99 +69,184 @@ DB_CONFIG = {
     'port': 5432
 }
 
+# Connection pool configuration
+DB_POOL_CONFIG = {
+    'minconn': 2,
+    'maxconn': 20,
+    'checkout_timeout': 5.0,        # seconds to wait for a free connection
+    'health_check_interval': 30.0,  # ping connections idle longer than this
+    # Session TimeZone of every pooled connection: the raw-SQL routes bucket
+    # days with DATE_TRUNC / TO_CHAR in it, so they agree with the rollups
+    'timezone': ROLLUP_TIMEZONE,
+}
+
+init_pool(app, DB_CONFIG, cursor_factory=InstrumentedCursor, **DB_POOL_CONFIG)
+
+# Streaming replicas for the read-only routes (analytics_db.ReplicaRouter),
+# e.g. [{**DB_CONFIG, 'host': 'replica-1'}, {**DB_CONFIG, 'port': 5433}].
+# Reads go round-robin over the replicas that are up and at most
+# REPLICA_MAX_LAG_SECONDS behind, else to the primary. Sync ingest and all
+# other writes always use the primary.
+REPLICA_CONFIGS = []
+REPLICA_MAX_LAG_SECONDS = 10.0
+REPLICA_CHECK_INTERVAL = 5.0  # seconds between health / lag checks
+replicas = init_replicas(
+    app, REPLICA_CONFIGS, REPLICA_MAX_LAG_SECONDS, REPLICA_CHECK_INTERVAL,
+    cursor_factory=InstrumentedCursor, **DB_POOL_CONFIG
+) if REPLICA_CONFIGS else None
+
+# Query instrumentation (analytics_metrics): statements slower than this are
+# logged with their EXPLAIN plan (at most once per statement per interval)
+SLOW_QUERY_MS = 500
+SLOW_QUERY_EXPLAIN_INTERVAL = 300.0
+init_metrics(app, slow_query_ms=SLOW_QUERY_MS, explain_interval=SLOW_QUERY_EXPLAIN_INTERVAL)
+
+# Serve timeline / reading-pattern routes from the daily rollup tables
+# (created by `flask db migrate`, see analytics_rollups.py)
+USE_ROLLUPS = True
+
+# Backend for page engagement, reading patterns and timelines: 'sql', or
+# 'columnar' for the in-memory NumPy engine (analytics_columnar; needs numpy
+# and about 29 bytes of RAM per page_sessions row). The SQL path is used
+# until the engine's first load finishes.
+ANALYTICS_ENGINE = 'sql'
+COLUMNAR_REFRESH_INTERVAL = 60  # seconds
+columnar = ColumnarEngine(DB_CONFIG, COLUMNAR_REFRESH_INTERVAL) if ANALYTICS_ENGINE == 'columnar' else None
+
+def columnar_ready():
+    return columnar is not None and columnar.ready
+
+def no_store(response):
+    """Keep an in-memory engine's answer out of the response cache and ETags
+
+    The engines change on their own refresh schedule, not with the sync
+    watermark, so a cached or revalidated copy could outlive their data.
+    """
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Windowed rankings (?window=day|7d|30d on popular books and page
+# engagement) from the in-memory top-K engine (analytics_topk), reloaded
+# from the rollups this often (seconds) and on every sync NOTIFY, and
+# updated at once by syncs ingested here
+TOPK_REFRESH_INTERVAL = 60
+topk = TopKEngine(DB_CONFIG, TOPK_REFRESH_INTERVAL)
+
+def topk_ready(limit):
+    return topk.ready and limit <= topk.k
+
+# Response cache: per-endpoint TTLs in seconds. Cached entries are also
+# dropped whenever a new sync_logs row lands (trigger from `flask db migrate`).
+CACHE_TTLS = {
+    'schools_stats': 120,
+    'regions': 120,
+    'region_schools': 120,
+    'popular_books': 300,
+    'timeline': 300,
+    'books_by_grade': 600,
+    'sync_logs': 30,
+    'device_stats': 600,
+    'sync_status': 30,
+    'sync_durations': 60,
+    'page_engagement': 300,
+    'school_timeline': 300,
+    'book_details': 300,
+    'reading_patterns': 600,
+}
+CACHE_BACKEND = MemoryLRUBackend(max_entries=2048, max_bytes=128 * 1024 * 1024)
+# For a cache shared across worker processes:
+# from analytics_cache import RedisBackend
+# CACHE_BACKEND = RedisBackend('redis://localhost:6379/0')
+
+cache = init_cache(app, CACHE_BACKEND, CACHE_TTLS)
+def on_sync_notify():
+    if replicas is not None:
+        replicas.note_write()
+    topk.request_refresh()
+
+start_sync_listener(cache, DB_CONFIG, on_sync=on_sync_notify)
+
+# Per-entity memo (analytics_memo) for book details and school timelines:
+# kept across syncs of other schools, dropped per book / school when a sync
+# touches it, and bounded by MEMO_MAX_BYTES of responses ('lru' or 'lfu'
+# eviction). With MEMO_WARMUP the top books and schools are requested at
+# startup (analytics_bench.py turns this off with analytics_memo.disable_warmup).
+MEMO_MAX_BYTES = 32 * 1024 * 1024
+MEMO_POLICY = 'lfu'
+MEMO_WARMUP = True
+MEMO_WARM_BOOKS = 20
+MEMO_WARM_SCHOOLS = 50
+memo = init_memo(app, EntityMemo(MEMO_MAX_BYTES, MEMO_POLICY))
+start_entity_listener(memo, DB_CONFIG, on_sync=replicas.note_write if replicas else None)
+
+# Conditional GET (analytics_etag): ETags follow the newest sync_logs row and
+# also roll over this often (seconds) for time-windowed figures
+ETAG_TIME_BUCKET = 3600
+init_conditional_get(app, ETAG_TIME_BUCKET)
+
+# Responses are serialized with analytics_json (orjson when installed) and
+# compressed (brotli / gzip) from this many bytes up
+COMPRESS_MIN_SIZE = 1024
+init_response_encoding(app, COMPRESS_MIN_SIZE)
+
+# Dashboard bundle: sections run concurrently, each on its own pooled
+# connection, so keep max_workers below DB_POOL_CONFIG['maxconn']
+dashboard = DashboardBundler(app, max_workers=8, section_timeout=10.0)
+
+# page_sessions monthly partitions: how many future months to keep created
+PARTITION_MONTHS_AHEAD = 3
+start_partition_maintainer(get_pool(app), PARTITION_MONTHS_AHEAD)
+
+# Overview snapshot: refreshed this often (seconds) and after every sync
+OVERVIEW_SNAPSHOT_INTERVAL = 300
+overview_snapshotter = OverviewSnapshotter(get_pool(app), OVERVIEW_SNAPSHOT_INTERVAL)
+
+# Background jobs (analytics_jobs): book popularity and all-history sync
+# totals are recomputed on their schedule and after every sync, on this many
+# pooled connections at most
+JOB_WORKERS = 2
+job_scheduler = JobScheduler(get_pool(app), JOB_WORKERS)
+
 def get_db_connection():
-    """Create database connection"""
-    conn = psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
-    return conn
-
-def get_time_range_ms(range_str):
-    """Convert range string to milliseconds"""
-    ranges = {
-        '24h': 24 * 60 * 60 * 1000,
-        '7d': 7 * 24 * 60 * 60 * 1000,
-        '30d': 30 * 24 * 60 * 60 * 1000,
-        '90d': 90 * 24 * 60 * 60 * 1000,
-        '365d': 365 * 24 * 60 * 60 * 1000,
-    }
-    end_time = int(time.time() * 1000)
-    start_time = end_time - ranges.get(range_str, ranges['30d'])
-    return start_time, end_time
-
-def calculate_percentage_change(current, previous):
-    """Calculate percentage change between two values"""
-    if previous == 0:
-        return 100 if current > 0 else 0
-    return round(((current - previous) / previous) * 100)
+    """Get the pooled connection for this request (returned on teardown)"""
+    return get_request_connection(app)
+
+def get_read_db_connection():
+    """Connection for read-only queries: a replica when one is usable, else the primary"""
+    return get_read_connection(app)
 
 # ============================================================================
 # 1. OVERVIEW STATS
 # ============================================================================
+# Not response-cached: a single-row read of the snapshot (analytics_overview),
+# so a refreshed snapshot shows up immediately
 @app.route('/api/analytics/overview', methods=['GET'])
+@conditional
 def get_overview_stats():
     try:
-        conn = get_db_connection()
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        # Get current period stats
-        cur.execute("""
-            SELECT 
-                COUNT(*) FILTER (WHERE is_active = true) as total_active_schools,
-                (SELECT COUNT(DISTINCT book_id) FROM books) as total_books,
-                COALESCE(SUM(total_reading_time_ms), 0) as total_reading_time_ms,
-                COALESCE(SUM(total_records), 0) as total_records,
-                COUNT(*) FILTER (
-                    WHERE last_sync_time >= EXTRACT(EPOCH FROM NOW() - INTERVAL '7 days') * 1000
-                ) as active_schools_last_7_days,
-                COUNT(*) FILTER (
-                    WHERE last_sync_time >= EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000
-                ) as active_schools_last_30_days
-            FROM schools;
-        """)
-        current = cur.fetchone()
-        
-        # Get previous period stats (for percentage change)
-        cur.execute("""
-            SELECT 
-                COUNT(*) FILTER (
-                    WHERE last_sync_time BETWEEN 
-                        EXTRACT(EPOCH FROM NOW() - INTERVAL '60 days') * 1000 
-                        AND EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000
-                ) as prev_schools,
-                COALESCE(SUM(total_reading_time_ms), 0) as prev_reading_time,
-                COALESCE(SUM(total_records), 0) as prev_records
-            FROM schools
-            WHERE last_sync_time < EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000;
-        """)
-        previous = cur.fetchone()
-        
-        data = {
-            'totalActiveSchools': current['total_active_schools'],
-            'totalBooks': current['total_books'],
-            'totalReadingTimeMs': current['total_reading_time_ms'],
-            'totalReadingTimeHours': round(current['total_reading_time_ms'] / (1000 * 60 * 60), 2),
-            'totalRecords': current['total_records'],
-            'activeSchoolsLast7Days': current['active_schools_last_7_days'],
-            'activeSchoolsLast30Days': current['active_schools_last_30_days'],
-            'percentageChange': {
-                'schools': calculate_percentage_change(
-                    current['active_schools_last_30_days'],
-                    previous['prev_schools'] if previous['prev_schools'] else 0
-                ),
-                'readingTime': calculate_percentage_change(
-                    current['total_reading_time_ms'],
-                    previous['prev_reading_time'] if previous['prev_reading_time'] else 0
-                ),
-                'records': calculate_percentage_change(
-                    current['total_records'],
-                    previous['prev_records'] if previous['prev_records'] else 0
-                )
-            }
-        }
+        cur.execute(OVERVIEW_SNAPSHOT_SQL)
+        snapshot = cur.fetchone()
+        
+        if snapshot:
+            # Totals from the region tree's root (always current); the
+            # time-windowed figures from the snapshot
+            cur.execute(REGION_ROOT_SQL)
+            root = cur.fetchone()
+            data = overview_payload({**snapshot, **(root or {})}, snapshot)
+        else:
+            # No snapshot yet (fresh install): compute the live numbers
+            cur.execute(OVERVIEW_CURRENT_SQL)
+            current = cur.fetchone()
+            cur.execute(OVERVIEW_PREVIOUS_SQL)
+            previous = cur.fetchone()
+            data = overview_payload(current, previous)
         
         cur.close()
-        conn.close()
         
-        return jsonify({'success': True, 'data': data})
+        return jsonify({'success': True, 'data': data, 'snapshot': snapshot_info(snapshot)})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -121,45 +255,90 @@ def get_overview_stats():
 # 2. SCHOOLS STATISTICS
 # ============================================================================
 @app.route('/api/analytics/schools/stats', methods=['GET'])
+@conditional
+@cached('schools_stats')
 def get_schools_stats():
     try:
         limit = request.args.get('limit', 50, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')
         sort_by = request.args.get('sortBy', 'totalReadingTime')
         
-        # Map frontend sort field to database column
-        sort_mapping = {
-            'totalReadingTime': 'total_reading_time_ms',
-            'schoolName': 'school_name',
-            'totalRecords': 'total_records'
-        }
-        sort_column = sort_mapping.get(sort_by, 'total_reading_time_ms')
+        query, params, scope = schools_stats_query(sort_by, limit, offset, cursor)
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
+        
+        cur.execute(query, params)
+        
+        schools = fetch_dicts(cur)
+        
+        cur.close()
+        
+        return jsonify({
+            'success': True,
+            'data': schools,
+            'nextCursor': next_cursor(schools, limit, scope, '_sortKey'),
+        })
+    
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# 2b. REGIONS
+# ============================================================================
+# Province / district / zone totals from the region tree (analytics_regions),
+# and the top schools of one region
+@app.route('/api/analytics/regions/<level>', methods=['GET'])
+@conditional
+@cached('regions')
+def get_regions(level):
+    try:
+        if level != 'global' and level not in REGION_LEVELS:
+            return jsonify({'success': False, 'error': 'Unknown region level %s' % level}), 404
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor()
+        
+        cur.execute(REGIONS_SQL, (level,))
+        
+        regions = cur.fetchall()
+        
+        cur.close()
         
-        conn = get_db_connection()
+        return jsonify({'success': True, 'data': regions})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/analytics/regions/<level>/schools', methods=['GET'])
+@conditional
+@cached('region_schools')
+def get_region_schools(level):
+    try:
+        if level not in REGION_LEVELS:
+            return jsonify({'success': False, 'error': 'Unknown region level %s' % level}), 404
+        name = request.args.get('name', '')
+        limit = request.args.get('limit', 10, type=int)
+        sort_by = request.args.get('sortBy', 'totalReadingTime')
+        
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        cur.execute(f"""
-            SELECT 
-                id,
-                school_name AS "schoolName",
-                serial_number AS "serialNumber",
-                total_reading_time_ms AS "totalReadingTimeMs",
-                ROUND((total_reading_time_ms / (1000.0 * 60 * 60))::numeric, 2) AS "totalReadingTimeHours",
-                total_books_accessed AS "totalBooksAccessed",
-                total_records AS "totalRecords",
-                last_sync_time AS "lastSyncTime",
-                is_active AS "isActive"
-            FROM schools
-            ORDER BY {sort_column} DESC
-            LIMIT %s OFFSET %s;
-        """, (limit, offset))
-        
-        schools = cur.fetchall()
+        cur.execute(REGION_SQL, (level, name))
+        region = cur.fetchone()
+        
+        if not region:
+            return jsonify({'success': False, 'error': 'Region not found'}), 404
+        
+        cur.execute(*region_schools_query(level, name, sort_by, limit))
+        region['topSchools'] = cur.fetchall()
         
         cur.close()
-        conn.close()
         
-        return jsonify({'success': True, 'data': schools})
+        return jsonify({'success': True, 'data': region})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -168,59 +347,51 @@ def get_schools_stats():
 # 3. POPULAR BOOKS
 # ============================================================================
 @app.route('/api/analytics/books/popular', methods=['GET'])
+@conditional
+@cached('popular_books', jobs=True)
 def get_popular_books():
     try:
         limit = request.args.get('limit', 10, type=int)
+        exact = request.args.get('exact') == 'true'
+        window = request.args.get('window')
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        if window is not None:
+            window_first_day(window)
+            if not exact and topk_ready(limit):
+                return no_store(jsonify({'success': True, 'data': topk.top_books(window, limit), 'window': window}))
+            cur = get_read_db_connection().cursor(cursor_factory=InstrumentedTupleCursor)
+            cur.execute(*top_books_query(window, limit))
+            books = fetch_dicts(cur)
+            cur.close()
+            return jsonify({'success': True, 'data': books, 'window': window})
+        
+        conn = get_read_db_connection()
+        
+        # Ranked by the book_popularity job unless exact=true
+        if not exact:
+            cur = conn.cursor()
+            ranked, job = job_output(cur, 'book_popularity')
+            cur.close()
+            if ranked is not None:
+                return jsonify({'success': True, 'data': ranked[:limit], 'job': job})
+        
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
+        
+        # uniqueSchools from the per-book HLL sketches unless exact=true
+        cur.execute(*popular_books_query(limit, '' if exact else SKETCHED_BOOKS_FILTER))
         
-        cur.execute("""
-            WITH book_stats AS (
-                SELECT 
-                    b.book_id AS "bookId",
-                    b.book_title AS "bookTitle",
-                    b.book_id AS grade,
-                    SUM(b.total_active_time_ms) AS "totalActiveTimeMs",
-                    SUM(ARRAY_LENGTH(b.pages_accessed, 1)) AS "totalAccessCount",
-                    COUNT(DISTINCT b.school_id) AS "uniqueSchools",
-                    AVG(ps.active_time_ms) AS "avgSessionTimeMs"
-                FROM books b
-                LEFT JOIN page_sessions ps ON ps.book_record_id = b.id
-                GROUP BY b.book_id, b.book_title
-            )
-            SELECT 
-                "bookId",
-                "bookTitle",
-                grade,
-                COALESCE("totalActiveTimeMs", 0) AS "totalActiveTimeMs",
-                COALESCE("totalAccessCount", 0) AS "totalAccessCount",
-                "uniqueSchools",
-                COALESCE(ROUND("avgSessionTimeMs"), 0) AS "avgSessionTimeMs",
-                ARRAY[]::integer[] AS "pagesAccessed"
-            FROM book_stats
-            ORDER BY "totalActiveTimeMs" DESC
-            LIMIT %s;
-        """, (limit,))
-        
-        books = cur.fetchall()
-        
-        # Get pages accessed for each book
-        for book in books:
-            cur.execute("""
-                SELECT ARRAY_AGG(DISTINCT page_num ORDER BY page_num) as pages
-                FROM books b, unnest(b.pages_accessed) as page_num
-                WHERE b.book_id = %s
-                GROUP BY b.book_id;
-            """, (book['bookId'],))
-            result = cur.fetchone()
-            book['pagesAccessed'] = result['pages'] if result and result['pages'] else []
+        books = fetch_dicts(cur)
+        
+        if not exact and books:
+            cur.execute(BOOK_SKETCHES_SQL, ([book['bookId'] for book in books],))
+            apply_book_sketches(books, fetch_dicts(cur))
         
         cur.close()
-        conn.close()
         
-        return jsonify({'success': True, 'data': books})
+        return jsonify({'success': True, 'data': books, 'job': None})
     
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -228,36 +399,48 @@ def get_popular_books():
 # 4. TIMELINE DATA
 # ============================================================================
 @app.route('/api/analytics/timeline', methods=['GET'])
+@conditional
+@cached('timeline')
 def get_timeline_data():
     try:
         range_str = request.args.get('range', '30d')
+        exact = request.args.get('exact') == 'true'
         start_time, end_time = get_time_range_ms(range_str)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        if columnar_ready():
+            return no_store(jsonify({'success': True, 'data': columnar.timeline(start_time, end_time),
+                                     'range': columnar.timeline_range(start_time, end_time)}))
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
+        
+        if USE_ROLLUPS:
+            # Per-day and whole-range distinct counts from the HLL sketches
+            # unless exact=true
+            distinct_filter = '' if exact else SKETCHED_DAYS_FILTER
+            query, params = rollup_timeline_query(start_time, end_time, distinct_filter)
+            cur.execute(query, params)
+            timeline = fetch_dicts(cur)
+            cur.execute(*rollup_range_query(start_time, end_time, distinct_filter))
+            totals = fetch_dicts(cur)[0]
+            if not exact:
+                cur.execute(DAILY_SKETCHES_SQL, params)
+                sketch_rows = fetch_dicts(cur)
+                apply_daily_sketches(timeline, sketch_rows)
+                totals = range_counts(sketch_rows, totals)
+            cur.close()
+            return jsonify({'success': True, 'data': timeline, 'range': totals})
+        
+        cur.execute(TIMELINE_SQL, (start_time, end_time))
         
-        cur.execute("""
-            SELECT 
-                (EXTRACT(EPOCH FROM DATE_TRUNC('day', TO_TIMESTAMP(ps.session_start_time / 1000.0))) * 1000)::bigint AS timestamp,
-                TO_CHAR(TO_TIMESTAMP(ps.session_start_time / 1000.0), 'YYYY-MM-DD') AS date,
-                COUNT(*) AS "totalSessions",
-                SUM(ps.active_time_ms) AS "totalActiveTimeMs",
-                COUNT(DISTINCT ps.book_id) AS "uniqueBooks",
-                COUNT(DISTINCT b.school_id) AS "uniqueSchools"
-            FROM page_sessions ps
-            JOIN books b ON ps.book_record_id = b.id
-            WHERE ps.session_start_time >= %s
-                AND ps.session_start_time <= %s
-            GROUP BY timestamp, date
-            ORDER BY timestamp;
-        """, (start_time, end_time))
-        
-        timeline = cur.fetchall()
+        timeline = fetch_dicts(cur)
+        
+        cur.execute(TIMELINE_RANGE_SQL, (start_time, end_time))
+        totals = fetch_dicts(cur)[0]
         
         cur.close()
-        conn.close()
         
-        return jsonify({'success': True, 'data': timeline})
+        return jsonify({'success': True, 'data': timeline, 'range': totals})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -266,38 +449,18 @@ def get_timeline_data():
 # 5. BOOKS BY GRADE
 # ============================================================================
 @app.route('/api/analytics/books/by-grade', methods=['GET'])
+@conditional
+@cached('books_by_grade')
 def get_books_by_grade():
     try:
-        conn = get_db_connection()
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        cur.execute("""
-            WITH grade_stats AS (
-                SELECT 
-                    book_id AS grade,
-                    COUNT(*) AS count,
-                    SUM(total_active_time_ms) AS total_reading_time_ms
-                FROM books
-                WHERE book_id BETWEEN 3 AND 10
-                GROUP BY book_id
-            ),
-            total_count AS (
-                SELECT SUM(count) AS total FROM grade_stats
-            )
-            SELECT 
-                gs.grade,
-                gs.count,
-                gs.total_reading_time_ms AS "totalReadingTimeMs",
-                ROUND((gs.count::numeric / NULLIF(tc.total, 0) * 100), 1) AS percentage
-            FROM grade_stats gs
-            CROSS JOIN total_count tc
-            ORDER BY gs.grade;
-        """)
+        cur.execute(BOOKS_BY_GRADE_SQL)
         
         grades = cur.fetchall()
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': grades})
     
@@ -308,36 +471,33 @@ def get_books_by_grade():
 # 6. SYNC LOGS
 # ============================================================================
 @app.route('/api/analytics/sync/logs', methods=['GET'])
+@conditional
+@cached('sync_logs')
 def get_sync_logs():
     try:
         limit = request.args.get('limit', 50, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        query, params, scope = sync_logs_query(limit, offset, cursor)
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
         
-        cur.execute("""
-            SELECT 
-                sl.id,
-                sl.school_id AS "schoolId",
-                s.school_name AS "schoolName",
-                sl.sync_timestamp AS "syncTimestamp",
-                sl.records_processed AS "recordsProcessed",
-                sl.success,
-                sl.error_message AS "errorMessage",
-                sl.created_at AS "createdAt"
-            FROM sync_logs sl
-            LEFT JOIN schools s ON sl.school_id = s.id
-            ORDER BY sl.created_at DESC
-            LIMIT %s;
-        """, (limit,))
-        
-        logs = cur.fetchall()
+        cur.execute(query, params)
+        
+        logs = fetch_dicts(cur)
         
         cur.close()
-        conn.close()
         
-        return jsonify({'success': True, 'data': logs})
+        return jsonify({
+            'success': True,
+            'data': logs,
+            'nextCursor': next_cursor(logs, limit, scope, 'createdAt'),
+        })
     
+    except InvalidCursor as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -345,39 +505,18 @@ def get_sync_logs():
 # 7. DEVICE STATS
 # ============================================================================
 @app.route('/api/analytics/device/stats', methods=['GET'])
+@conditional
+@cached('device_stats')
 def get_device_stats():
     try:
-        conn = get_db_connection()
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        cur.execute("""
-            WITH platform_counts AS (
-                SELECT 
-                    platform,
-                    COUNT(*) AS count,
-                    MAX(app_version) AS app_version,
-                    MAX(last_seen_at) AS last_seen_at
-                FROM device_info
-                GROUP BY platform
-            ),
-            total_devices AS (
-                SELECT SUM(count) AS total FROM platform_counts
-            )
-            SELECT 
-                pc.platform,
-                pc.count,
-                ROUND((pc.count::numeric / NULLIF(td.total, 0) * 100), 1) AS percentage,
-                pc.app_version AS "appVersion",
-                pc.last_seen_at AS "lastSeenAt"
-            FROM platform_counts pc
-            CROSS JOIN total_devices td
-            ORDER BY pc.count DESC;
-        """)
+        cur.execute(DEVICE_STATS_SQL)
         
         devices = cur.fetchall()
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': devices})
     
@@ -388,56 +527,55 @@ def get_device_stats():
 # 8. SYNC STATUS
 # ============================================================================
 @app.route('/api/analytics/sync/status', methods=['GET'])
+@conditional
+@cached('sync_status', jobs=True)
 def get_sync_status():
     try:
-        conn = get_db_connection()
+        conn = get_read_db_connection()
+        cur = conn.cursor()
+        
+        cur.execute(SYNC_STATUS_SQL, sync_status_params())
+        row = cur.fetchone()
+        
+        # All-history totals from the sync_totals job; inline until it has run
+        totals, job = job_output(cur, 'sync_totals')
+        if totals is None:
+            cur.execute(SYNC_TOTALS_SQL)
+            totals = cur.fetchone()
+        
+        # Mean and p95 duration from the sync duration aggregate
+        cur.execute(DURATION_HISTOGRAM_SQL, (ALL_HISTORY,))
+        durations = duration_summary(cur.fetchall())
+        
+        cur.close()
+        
+        data = sync_status_payload(row, totals, durations)
+        return jsonify({'success': True, 'data': data, 'job': job})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/analytics/sync/durations', methods=['GET'])
+@conditional
+@cached('sync_durations')
+def get_sync_durations():
+    try:
+        range_str = request.args.get('range', '30d')
+        limit = request.args.get('limit', 10, type=int)
+        sort_by = request.args.get('sortBy', 'averageDuration')
+        start_time, _ = get_time_range_ms(range_str)
+        since = since_day(start_time)
+        
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        # Overall sync stats
-        cur.execute("""
-            SELECT 
-                COUNT(*) AS "totalSyncs",
-                SUM(CASE WHEN success THEN 1 ELSE 0 END) AS "successfulSyncs",
-                SUM(CASE WHEN NOT success THEN 1 ELSE 0 END) AS "failedSyncs",
-                ROUND((SUM(CASE WHEN success THEN 1 ELSE 0 END)::numeric / NULLIF(COUNT(*), 0) * 100), 2) AS "successRate",
-                MAX(sync_timestamp) AS "lastSyncTime"
-            FROM sync_logs;
-        """)
-        stats = cur.fetchone()
-        
-        # Schools pending sync
-        cur.execute("""
-            SELECT COUNT(*) AS "schoolsPendingSync"
-            FROM schools
-            WHERE last_sync_time < EXTRACT(EPOCH FROM NOW() - INTERVAL '24 hours') * 1000
-                OR last_sync_time IS NULL;
-        """)
-        pending = cur.fetchone()
-        
-        # Recent errors
-        cur.execute("""
-            SELECT 
-                sl.school_id AS "schoolId",
-                s.school_name AS "schoolName",
-                sl.error_message AS "errorMessage",
-                sl.sync_timestamp AS timestamp
-            FROM sync_logs sl
-            JOIN schools s ON sl.school_id = s.id
-            WHERE sl.success = false
-            ORDER BY sl.sync_timestamp DESC
-            LIMIT 5;
-        """)
-        errors = cur.fetchall()
-        
-        data = {
-            **stats,
-            'schoolsPendingSync': pending['schoolsPendingSync'],
-            'averageSyncTime': 2500,  # Placeholder - calculate from actual data
-            'recentErrors': errors
-        }
+        cur.execute(DURATION_HISTOGRAM_SQL, (since,))
+        data = duration_summary(cur.fetchall())
+        
+        cur.execute(*slowest_schools_query(since, limit, sort_by))
+        data['slowestSchools'] = cur.fetchall()
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': data})
     
@@ -448,51 +586,163 @@ def get_sync_status():
 # 9. PAGE ENGAGEMENT
 # ============================================================================
 @app.route('/api/analytics/pages/engagement', methods=['GET'])
+@conditional
+@cached('page_engagement')
 def get_page_engagement():
     try:
         book_id = request.args.get('bookId', type=int)
+        window = request.args.get('window')
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        # Top pages of a window (ignored with bookId)
+        if window is not None and not book_id:
+            window_first_day(window)
+            limit = request.args.get('limit', 50, type=int)
+            if request.args.get('exact') != 'true' and topk_ready(limit):
+                return no_store(jsonify({'success': True, 'data': topk.top_pages(window, limit), 'window': window}))
+            cur = get_read_db_connection().cursor(cursor_factory=InstrumentedTupleCursor)
+            cur.execute(*top_pages_query(window, limit))
+            pages = fetch_dicts(cur)
+            cur.close()
+            return jsonify({'success': True, 'data': pages, 'window': window})
+        
+        if columnar_ready():
+            return no_store(jsonify({'success': True, 'data': columnar.page_engagement(book_id or None)}))
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
         
         if book_id:
-            cur.execute("""
-                SELECT 
-                    ps.book_id AS "bookId",
-                    b.book_title AS "bookTitle",
-                    ps.page_number AS "pageNumber",
-                    COUNT(*) AS "totalSessions",
-                    ROUND(AVG(ps.active_time_ms)) AS "avgActiveTimeMs",
-                    SUM(ps.active_time_ms) AS "totalActiveTimeMs"
-                FROM page_sessions ps
-                JOIN books b ON ps.book_record_id = b.id
-                WHERE ps.book_id = %s
-                GROUP BY ps.book_id, b.book_title, ps.page_number
-                ORDER BY ps.page_number;
-            """, (book_id,))
+            cur.execute(PAGE_ENGAGEMENT_BOOK_SQL, (book_id,))
         else:
-            cur.execute("""
-                SELECT 
-                    ps.book_id AS "bookId",
-                    b.book_title AS "bookTitle",
-                    ps.page_number AS "pageNumber",
-                    COUNT(*) AS "totalSessions",
-                    ROUND(AVG(ps.active_time_ms)) AS "avgActiveTimeMs",
-                    SUM(ps.active_time_ms) AS "totalActiveTimeMs"
-                FROM page_sessions ps
-                JOIN books b ON ps.book_record_id = b.id
-                GROUP BY ps.book_id, b.book_title, ps.page_number
-                ORDER BY "totalActiveTimeMs" DESC
-                LIMIT 50;
-            """)
-        
-        engagement = cur.fetchall()
+            cur.execute(PAGE_ENGAGEMENT_TOP_SQL)
+        
+        engagement = fetch_dicts(cur)
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': engagement})
     
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# 10. DASHBOARD BUNDLE
+# ============================================================================
+@app.route('/api/analytics/dashboard', methods=['GET'])
+@conditional
+def get_dashboard_bundle():
+    try:
+        started = time.perf_counter()
+        sections = request.args.get('sections')
+        sections = [name.strip() for name in sections.split(',')] if sections else None
+        unknown = [name for name in sections or [] if name not in DASHBOARD_SECTIONS]
+        if unknown:
+            return jsonify({'success': False, 'error': 'Unknown sections: %s' % ', '.join(unknown)}), 400
+        
+        data, errors, timings, volatile = dashboard.build(sections, request.args.get('range'))
+        
+        response = jsonify({
+            'success': len(errors) < len(data),
+            'partial': bool(errors) and len(errors) < len(data),
+            'data': data,
+            'errors': errors,
+            'timings': timings,
+            'totalMs': round((time.perf_counter() - started) * 1000, 1),
+        })
+        if errors or volatile:
+            # Never revalidate a partial bundle, or one holding engine
+            # answers (no_store), with a 304
+            response.headers['Cache-Control'] = 'no-store'
+        return response, 200 if len(errors) < len(data) else 500
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# 11. SYNC INGEST
+# ============================================================================
+@app.route('/api/analytics/sync/<int:school_id>', methods=['POST'])
+def ingest_school_sync(school_id):
+    started = time.perf_counter()
+    started_at = int(time.time() * 1000)
+    conn = get_db_connection()
+    sync_timestamp = None
+    bytes_received = None
+    try:
+        body = request.get_data(cache=False)
+        bytes_received = len(body)
+        sync_timestamp, books, sessions = parse_sync_payload(
+            body,
+            request.content_type,
+            request.headers.get('Content-Encoding'),
+        )
+        result = ingest_sync(conn, school_id, sync_timestamp, books, sessions)
+        inserted_pages = result.pop('insertedPages')
+        book_ids = result.pop('bookIds')
+        add_sync_to_sketches(conn, school_id, sessions)
+        result['durationMs'] = int((time.perf_counter() - started) * 1000)
+        sync_id = record_sync_log(conn, school_id, result['syncTimestamp'], result['sessionsInserted'],
+                                  True, result['durationMs'], started_at=started_at,
+                                  bytes_received=bytes_received)
+        topk.add(sync_id, school_id, inserted_pages)
+        if replicas is not None:
+            # Before invalidating, so lagging replicas cannot refill the caches
+            replicas.note_write()
+        memo.invalidate('school', [school_id])
+        memo.invalidate('book', book_ids)
+        get_cache(app).invalidate()
+        overview_snapshotter.request_refresh()
+        job_scheduler.request_sync_jobs()
+        
+        return jsonify({'success': True, 'data': result})
+    
+    except SyncPayloadError as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except LookupError as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except Exception as e:
+        conn.rollback()
+        try:
+            record_sync_log(conn, school_id, int(sync_timestamp or time.time() * 1000), 0, False,
+                            int((time.perf_counter() - started) * 1000), str(e),
+                            started_at=started_at, bytes_received=bytes_received)
+        except Exception:
+            conn.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# 12. STREAMING EXPORTS
+# ============================================================================
+@app.route('/api/analytics/export/<dataset>', methods=['GET'])
+def export_dataset(dataset):
+    try:
+        if dataset not in EXPORTS:
+            return jsonify({'success': False, 'error': 'Unknown export %r' % dataset}), 404
+        fmt = request.args.get('format', 'csv')
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'success': False, 'error': 'Unsupported format %r' % fmt}), 400
+        
+        range_str = request.args.get('range', '30d')
+        start_time, end_time = get_time_range_ms(range_str)
+        query, params = EXPORTS[dataset](
+            start_time,
+            end_time,
+            school_id=request.args.get('schoolId', type=int),
+            book_id=request.args.get('bookId', type=int),
+        )
+        
+        conn = get_read_db_connection()
+        filename = '%s_%s.%s' % (dataset.replace('-', '_'), range_str, fmt)
+        return Response(
+            stream_with_context(stream_rows(conn, query, params, fmt)),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers={'Content-Disposition': 'attachment; filename="%s"' % filename},
+        )
+    
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -501,34 +751,30 @@ def get_page_engagement():
 # ============================================================================
 
 @app.route('/api/analytics/schools/<int:school_id>/timeline', methods=['GET'])
+@conditional
+@cached('school_timeline')
+@memoized('school', 'school_id', CACHE_TTLS['school_timeline'])
 def get_school_timeline(school_id):
     try:
         range_str = request.args.get('range', '30d')
         start_time, end_time = get_time_range_ms(range_str)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        if columnar_ready():
+            return no_store(jsonify({'success': True, 'data': columnar.timeline(start_time, end_time, school_id)}))
+        
+        conn = get_read_db_connection()
+        cur = conn.cursor(cursor_factory=InstrumentedTupleCursor)
         
-        cur.execute("""
-            SELECT 
-                TO_CHAR(TO_TIMESTAMP(ps.session_start_time / 1000.0), 'YYYY-MM-DD') AS date,
-                (EXTRACT(EPOCH FROM DATE_TRUNC('day', TO_TIMESTAMP(ps.session_start_time / 1000.0))) * 1000)::bigint AS timestamp,
-                COUNT(*) AS "totalSessions",
-                SUM(ps.active_time_ms) AS "totalActiveTimeMs",
-                COUNT(DISTINCT ps.book_id) AS "uniqueBooks"
-            FROM page_sessions ps
-            JOIN books b ON ps.book_record_id = b.id
-            WHERE b.school_id = %s
-                AND ps.session_start_time >= %s
-                AND ps.session_start_time <= %s
-            GROUP BY date, timestamp
-            ORDER BY timestamp;
-        """, (school_id, start_time, end_time))
-        
-        timeline = cur.fetchall()
+        if USE_ROLLUPS:
+            timeline = rollup_school_timeline(cur, school_id, start_time, end_time)
+            cur.close()
+            return jsonify({'success': True, 'data': timeline})
+        
+        cur.execute(SCHOOL_TIMELINE_SQL, (school_id, start_time, end_time))
+        
+        timeline = fetch_dicts(cur)
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': timeline})
     
@@ -536,60 +782,26 @@ def get_school_timeline(school_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/analytics/books/<int:book_id>/details', methods=['GET'])
+@conditional
+@cached('book_details')
+@memoized('book', 'book_id', CACHE_TTLS['book_details'])
 def get_book_details(book_id):
     try:
-        conn = get_db_connection()
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        cur.execute("""
-            SELECT 
-                b.book_id AS "bookId",
-                b.book_title AS "bookTitle",
-                b.book_id AS grade,
-                SUM(b.total_active_time_ms) AS "totalActiveTimeMs",
-                COUNT(ps.id) AS "totalAccessCount",
-                COUNT(DISTINCT b.school_id) AS "uniqueSchools",
-                ROUND(AVG(ps.active_time_ms)) AS "avgSessionTimeMs",
-                MIN(b.first_access_time) AS "firstAccessTime",
-                MAX(b.last_access_time) AS "lastAccessTime",
-                MAX(b.total_pages) AS "totalPages"
-            FROM books b
-            LEFT JOIN page_sessions ps ON ps.book_record_id = b.id
-            WHERE b.book_id = %s
-            GROUP BY b.book_id, b.book_title;
-        """, (book_id,))
+        cur.execute(BOOK_DETAILS_SQL, (book_id, book_id))
         
         book = cur.fetchone()
         
         if not book:
             return jsonify({'success': False, 'error': 'Book not found'}), 404
         
-        # Get pages accessed
-        cur.execute("""
-            SELECT ARRAY_AGG(DISTINCT page_num ORDER BY page_num) as pages
-            FROM books b, unnest(b.pages_accessed) as page_num
-            WHERE b.book_id = %s;
-        """, (book_id,))
-        pages_result = cur.fetchone()
-        book['pagesAccessed'] = pages_result['pages'] if pages_result and pages_result['pages'] else []
-        
         # Get schools using this book
-        cur.execute("""
-            SELECT 
-                s.id AS "schoolId",
-                s.school_name AS "schoolName",
-                b.total_active_time_ms AS "totalTime",
-                ARRAY_LENGTH(b.pages_accessed, 1) AS "accessCount"
-            FROM books b
-            JOIN schools s ON b.school_id = s.id
-            WHERE b.book_id = %s
-            ORDER BY b.total_active_time_ms DESC
-            LIMIT 10;
-        """, (book_id,))
+        cur.execute(BOOK_SCHOOLS_SQL, (book_id,))
         book['schoolsUsing'] = cur.fetchall()
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': book})
     
@@ -597,33 +809,75 @@ def get_book_details(book_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/analytics/reading-patterns', methods=['GET'])
+@conditional
+@cached('reading_patterns')
 def get_reading_patterns():
     try:
-        conn = get_db_connection()
+        # Epoch-ms bounds computed here (not NOW() in SQL) so the planner can
+        # prune page_sessions partitions and use the time index
+        start_time, end_time = get_time_range_ms('30d')
+        
+        if columnar_ready():
+            return no_store(jsonify({'success': True, 'data': columnar.reading_patterns(start_time, end_time)}))
+        
+        conn = get_read_db_connection()
         cur = conn.cursor()
         
-        cur.execute("""
-            SELECT 
-                EXTRACT(HOUR FROM TO_TIMESTAMP(session_start_time / 1000.0))::integer AS hour,
-                EXTRACT(DOW FROM TO_TIMESTAMP(session_start_time / 1000.0))::integer AS "dayOfWeek",
-                COUNT(*) AS "totalSessions",
-                ROUND(AVG(active_time_ms)) AS "avgSessionTimeMs"
-            FROM page_sessions
-            WHERE session_start_time >= EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000
-            GROUP BY hour, "dayOfWeek"
-            ORDER BY "dayOfWeek", hour;
-        """)
+        if USE_ROLLUPS:
+            patterns = rollup_reading_patterns(cur, start_time, end_time)
+            cur.close()
+            return jsonify({'success': True, 'data': patterns})
+        
+        cur.execute(READING_PATTERNS_SQL, (start_time,))
         
         patterns = cur.fetchall()
         
         cur.close()
-        conn.close()
         
         return jsonify({'success': True, 'data': patterns})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/analytics/_pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify({'success': True, 'data': get_pool(app).stats()})
+
+@app.route('/api/analytics/_replicas', methods=['GET'])
+def get_replica_stats():
+    data = replicas.stats() if replicas is not None else {'enabled': False}
+    return jsonify({'success': True, 'data': data})
+
+@app.route('/api/analytics/_cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'success': True, 'data': get_cache(app).stats()})
+
+@app.route('/api/analytics/_columnar', methods=['GET'])
+def get_columnar_stats():
+    data = columnar.stats() if columnar is not None else {'enabled': False}
+    return jsonify({'success': True, 'data': data})
+
+@app.route('/api/analytics/_memo', methods=['GET'])
+def get_memo_stats():
+    return jsonify({'success': True, 'data': memo.stats()})
+
+@app.route('/api/analytics/_topk', methods=['GET'])
+def get_topk_stats():
+    return jsonify({'success': True, 'data': topk.stats()})
+
+@app.route('/api/analytics/_jobs', methods=['GET'])
+def get_job_stats():
+    try:
+        data = job_status(get_db_connection())
+        return jsonify({'success': True, 'data': data, 'schedulerError': job_scheduler.last_error})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/analytics/_metrics', methods=['GET'])
+def get_metrics():
+    """Per-route latency histograms in Prometheus text format"""
+    return Response(app.extensions['metrics'].render() + memo.render(), mimetype='text/plain; version=0.0.4')
+
 # ============================================================================
 # ERROR HANDLERS
 # ============================================================================
@@ -636,9 +890,165 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
+# ============================================================================
+# CLI COMMANDS (FLASK_APP=analytics_backend_example flask ...)
+# ============================================================================
+
+@app.cli.group('db')
+def db_cli():
+    """Manage the analytics schema"""
+
+@db_cli.command('migrate')
+@click.option('--to', 'target', type=int, default=None, help='Stop at this migration version')
+def db_migrate(target):
+    """Apply pending schema migrations"""
+    with get_pool(app).connection() as conn:
+        applied = migrate(conn, target)
+    for version, name in applied:
+        click.echo('Applied %03d %s' % (version, name))
+    if not applied:
+        click.echo('Schema is up to date')
+
+@db_cli.command('status')
+def db_status():
+    """List migrations and whether they are applied"""
+    with get_pool(app).connection() as conn:
+        for version, name, applied in migration_status(conn):
+            click.echo('%03d %-30s %s' % (version, name, 'applied' if applied else 'pending'))
+
+@app.cli.group()
+def rollups():
+    """Manage the analytics rollup tables"""
+
+@rollups.command('rebuild')
+@click.option('--since', 'since_days', type=int, default=None,
+              help='Only rebuild the last N days (backfill); default rebuilds everything')
+def rollups_rebuild(since_days):
+    """Regenerate rollups from raw page_sessions"""
+    since_ms = None
+    if since_days is not None:
+        since_ms = int(time.time() * 1000) - since_days * 24 * 60 * 60 * 1000
+    with get_pool(app).connection() as conn:
+        result = rebuild_rollups(conn, since_ms)
+    click.echo('Rebuilt %(dailyRows)d daily, %(hourlyRows)d hourly and %(pageRows)d page rollup rows' % result)
+
+@app.cli.command('datagen')
+@click.option('--schools', type=int, default=5000)
+@click.option('--books', type=int, default=50, help='Catalogue size (grades 3-10)')
+@click.option('--sessions', type=int, default=500_000_000, help='Approximate page_sessions rows')
+@click.option('--days', type=int, default=400, help='Days of history before --end-date')
+@click.option('--seed', type=int, default=42)
+@click.option('--end-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Last day of data (exclusive); default today (UTC)')
+@click.option('--workers', type=int, default=None, help='Generator processes (default: CPU count)')
+def datagen(schools, books, sessions, days, seed, end_date, workers):
+    """Load a deterministic synthetic dataset into an empty database"""
+    with get_pool(app).connection() as conn:
+        migrate(conn)
+    counts = generate_dataset(DB_CONFIG, schools=schools, books=books, sessions=sessions, days=days,
+                              seed=seed, end_date=end_date.date() if end_date else None,
+                              workers=workers, log=click.echo)
+    click.echo(', '.join('%s: %d' % item for item in counts.items()))
+
+@app.cli.group('sketches')
+def sketches_cli():
+    """Manage the HyperLogLog distinct-count sketches"""
+
+@sketches_cli.command('rebuild')
+def sketches_rebuild():
+    """Regenerate sketches from the daily rollups and books"""
+    with get_pool(app).connection() as conn:
+        result = rebuild_sketches(conn)
+    click.echo('Rebuilt %(days)d daily and %(books)d book sketches' % result)
+
+@app.cli.group('overview')
+def overview_cli():
+    """Manage the overview snapshot"""
+
+@overview_cli.command('refresh')
+def overview_refresh():
+    """Recompute the overview snapshot now"""
+    with get_pool(app).connection() as conn:
+        compute_ms = refresh_overview_snapshot(conn)
+    click.echo('Overview snapshot refreshed (%d ms)' % compute_ms)
+
+@app.cli.group('jobs')
+def jobs_cli():
+    """Run and inspect background recomputation jobs"""
+
+@jobs_cli.command('list')
+def jobs_list():
+    """List registered jobs and the latest run of each"""
+    with get_pool(app).connection() as conn:
+        runs = {row['job']: row for row in job_status(conn)}
+    for job in JOBS.values():
+        run = runs.get(job.name)
+        last = 'never run' if run is None else '%s, %s ms' % (
+            'ok' if run['lastSuccess'] else 'failed: %s' % run['lastError'], run['lastDurationMs'])
+        click.echo('%-20s every %ds%s  %s' % (job.name, job.interval, ', on sync' if job.on_sync else '', last))
+
+@jobs_cli.command('run')
+@click.argument('name', type=click.Choice(sorted(JOBS)))
+def jobs_run(name):
+    """Run a job now and store its output"""
+    with get_pool(app).connection() as conn:
+        run = run_job(conn, name)
+    if run is None:
+        raise click.ClickException('%s is running in another process' % name)
+    if not run['success']:
+        raise click.ClickException(run['error'])
+    click.echo('%s finished in %d ms%s' % (name, run['durationMs'], '' if run['changed'] else ' (output unchanged)'))
+
+@app.cli.group('partitions')
+def partitions_cli():
+    """Manage page_sessions monthly partitions"""
+
+@partitions_cli.command('ensure')
+@click.option('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD)
+def partitions_ensure(months_ahead):
+    """Create partitions for the current and upcoming months"""
+    with get_pool(app).connection() as conn:
+        created = ensure_partitions(conn, months_ahead)
+    click.echo('Created %d partition(s)' % created)
+
+@partitions_cli.command('list')
+def partitions_list():
+    """List monthly partitions"""
+    with get_pool(app).connection() as conn:
+        for name, month_start in list_partitions(conn):
+            click.echo('%s  %s' % (name, month_start.strftime('%Y-%m')))
+
+@partitions_cli.command('prune')
+@click.option('--keep-months', type=int, required=True, help='Months of raw sessions to keep')
+@click.option('--archive-schema', default=None,
+              help='Move detached partitions to this schema instead of dropping them')
+def partitions_prune(keep_months, archive_schema):
+    """Detach partitions older than the retention window"""
+    with get_pool(app).connection() as conn:
+        pruned = prune_partitions(conn, keep_months, archive_schema)
+    action = 'Archived to %s' % archive_schema if archive_schema else 'Dropped'
+    for name in pruned:
+        click.echo('%s %s' % (action, name))
+    if not pruned:
+        click.echo('Nothing to prune')
+
+# ============================================================================
+# MEMO WARM-UP
+# ============================================================================
+
+# Started once every route is registered
+if MEMO_WARMUP:
+    start_memo_warmup(app, [
+        ('/api/analytics/books/%d/details', WARM_BOOKS_SQL, MEMO_WARM_BOOKS),
+        ('/api/analytics/schools/%d/timeline', WARM_SCHOOLS_SQL, MEMO_WARM_SCHOOLS),
+    ])
+
 # ============================================================================
 # RUN SERVER
 # ============================================================================
 
+# Development server only. In production run the async read API
+# (`python analytics_asgi.py`, uvicorn) or this app under a WSGI server, e.g.
+# `gunicorn -w 4 --threads 8 -b :8080 analytics_backend_example:app`.
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
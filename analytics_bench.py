@@ -0,0 +1,856 @@
+# Benchmarks for the analytics backend
+# Runs against the database configured in analytics_backend_example.DB_CONFIG
+#
+# Usage:
+#   python analytics_bench.py query-count    # round trips per route vs. limit
+#   python analytics_bench.py explain-check  # fail on seq scans of large tables
+#   python analytics_bench.py loadtest [--clients 200] [--duration 30] URL [URL ...]
+#                                            # concurrent dashboard clients per server
+#   python analytics_bench.py hll-accuracy   # HLL estimates vs. exact counts
+#   python analytics_bench.py routes [--iterations 30] [--out FILE] [--compare FILE]
+#                                            # p50/p95/p99 and DB time per route
+#   python analytics_bench.py encoding [--iterations 50]
+#                                            # JSON encode CPU and compressed sizes
+#   python analytics_bench.py columnar-check # columnar engine vs. SQL results
+#   python analytics_bench.py page-bitmaps   # page coverage bitmaps vs. integer[] arrays
+#   python analytics_bench.py topk-check     # windowed top-K engine vs. SQL rankings
+#   python analytics_bench.py replica-check [--port 5433 ...]
+#                                            # replica routing, lag and read-your-writes
+#
+# Load a dataset first with `flask datagen` (analytics_datagen).
+
+import argparse
+import http.client
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+from analytics_datagen import generate_dataset
+from analytics_db import ConnectionPool, ReplicaRouter
+from analytics_hll import HyperLogLog, PRECISION, merged_count
+from analytics_json import ENCODER, brotli, compress, dumps, json_default
+from analytics_memo import disable_warmup
+from analytics_metrics import InstrumentedCursor
+from analytics_migrations import migrate
+from analytics_queries import popular_books_query
+
+# Before any benchmark imports the app: a memo warm-up would compete for the
+# pool with the requests being measured
+disable_warmup()
+
+
+class RecordingCursor(InstrumentedCursor):
+    """App cursor that also records every statement sent to the server
+
+    `db_ms` accumulates the time spent in execute(), i.e. waiting on the
+    server (results of client-side cursors arrive with execute()).
+    """
+    statements = []
+    db_ms = 0.0
+
+    def execute(self, query, vars=None):
+        RecordingCursor.statements.append((query, vars))
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            RecordingCursor.db_ms += (time.perf_counter() - started) * 1000
+
+
+def use_recording_pool():
+    """Swap the app's pool for one whose connections record statements
+
+    The response cache and the entity memo are detached as well so every
+    request reaches the database.
+    """
+    from analytics_backend_example import app, DB_CONFIG, DB_POOL_CONFIG
+    app.extensions.pop('response_cache', None)
+    app.extensions.pop('entity_memo', None)
+    app.extensions['db_pool'].closeall()
+    app.extensions['db_pool'] = ConnectionPool(
+        DB_CONFIG, cursor_factory=RecordingCursor, **DB_POOL_CONFIG
+    )
+    return app.extensions['db_pool']
+
+
+def run_route(client, url):
+    """GET `url`, returning (statements, rows, elapsed_ms)"""
+    RecordingCursor.statements = []
+    RecordingCursor.db_ms = 0.0
+    started = time.perf_counter()
+    response = client.get(url)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %s: %s' % (url, response.status_code, response.get_json()))
+    data = response.get_json()['data']
+    return list(RecordingCursor.statements), len(data) if isinstance(data, list) else 1, elapsed_ms
+
+
+# ============================================================================
+# QUERY COUNT
+# ============================================================================
+
+def bench_query_count(limits=(1, 10, 50, 200)):
+    """Fail if the number of statements per request grows with `limit`"""
+    from analytics_backend_example import app
+    use_recording_pool()
+    client = app.test_client()
+    counts = set()
+
+    print('%-40s %8s %8s %10s' % ('url', 'queries', 'rows', 'ms'))
+    for limit in limits:
+        # exact=true: the default answer comes from the book_popularity job
+        url = '/api/analytics/books/popular?limit=%d&exact=true' % limit
+        statements, rows, elapsed_ms = run_route(client, url)
+        counts.add(len(statements))
+        print('%-40s %8d %8d %10.1f' % (url, len(statements), rows, elapsed_ms))
+
+    if len(counts) != 1:
+        print('FAIL: query count depends on limit: %s' % sorted(counts))
+        return 1
+    print('OK: %d statement(s) per request regardless of limit' % counts.pop())
+    return 0
+
+
+# ============================================================================
+# EXPLAIN CHECK
+# ============================================================================
+
+# Tables smaller than this are cheaper to scan than to index; ignore them
+SEQ_SCAN_MIN_ROWS = 100_000
+
+# Route -> tables it may legitimately scan in full, because the statement
+# aggregates every row of that table
+EXPLAIN_ROUTES = [
+    ('/api/analytics/overview', set()),
+    ('/api/analytics/schools/stats?limit=50', set()),
+    ('/api/analytics/schools/stats?limit=50&offset=1000', set()),
+    ('/api/analytics/books/popular?limit=20&exact=true', {'books', 'page_sessions'}),
+    ('/api/analytics/timeline?range=30d', set()),
+    ('/api/analytics/timeline?range=365d', set()),
+    ('/api/analytics/books/by-grade', {'books'}),
+    ('/api/analytics/sync/logs?limit=50', set()),
+    ('/api/analytics/device/stats', set()),
+    ('/api/analytics/sync/status', {'sync_logs'}),
+    ('/api/analytics/pages/engagement', {'books', 'page_sessions'}),
+    ('/api/analytics/pages/engagement?bookId=5', set()),
+    ('/api/analytics/reading-patterns', set()),
+    ('/api/analytics/books/5/details', set()),
+    ('/api/analytics/schools/1/timeline?range=30d', set()),
+]
+
+# Background job statements (analytics_jobs) the routes above serve from:
+# (name, (query, params), tables it may scan in full)
+EXPLAIN_JOB_QUERIES = [
+    ('job book_popularity', popular_books_query(None), {'books', 'page_sessions'}),
+]
+
+def seed_explain_dataset(conn, schools=2000, books=8, sessions=2_000_000):
+    """Fill an empty database with enough rows for realistic plans"""
+    from analytics_backend_example import DB_CONFIG
+    cur = conn.cursor()
+    cur.execute("SELECT EXISTS (SELECT 1 FROM page_sessions) AS seeded;")
+    seeded = cur.fetchone()['seeded']
+    conn.commit()
+    cur.close()
+    if seeded:
+        return False
+    generate_dataset(DB_CONFIG, schools=schools, books=books, sessions=sessions)
+    return True
+
+
+def seq_scans(plan):
+    """Yield relation names of every Seq Scan node in an EXPLAIN JSON plan"""
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def bench_explain_check():
+    """Fail if any analytics route or job plans a Seq Scan on a large table"""
+    from analytics_backend_example import app
+    pool = use_recording_pool()
+    with pool.connection() as conn:
+        migrate(conn)
+        if seed_explain_dataset(conn):
+            print('Seeded explain dataset')
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute('VACUUM ANALYZE;')
+        # Plans name partitions (page_sessions_p202401, page_sessions_default);
+        # compare by their parent, sized as the sum of its partitions
+        cur.execute("""
+            SELECT c.relname AS child, p.relname AS parent
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relkind IN ('r', 'p');
+        """)
+        parents = {row['child']: row['parent'] for row in cur.fetchall()}
+        cur.execute("""
+            SELECT COALESCE(p.relname, c.relname) AS relname
+            FROM pg_class c
+            LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+            LEFT JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relkind IN ('r', 'p')
+            GROUP BY 1
+            HAVING SUM(GREATEST(c.reltuples, 0)) >= %s;
+        """, (SEQ_SCAN_MIN_ROWS,))
+        large_tables = {row['relname'] for row in cur.fetchall()}
+        conn.autocommit = False
+        cur.close()
+
+    client = app.test_client()
+    checks = [(url, run_route(client, url)[0], allowed) for url, allowed in EXPLAIN_ROUTES]
+    checks += [(name, [statement], allowed) for name, statement, allowed in EXPLAIN_JOB_QUERIES]
+    failures = []
+    for url, statements, allowed in checks:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            for query, params in statements:
+                if not query.lstrip().upper().startswith(('SELECT', 'WITH')):
+                    continue
+                cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+                plan = cur.fetchone()['QUERY PLAN'][0]['Plan']
+                scanned = ({parents.get(name, name) for name in seq_scans(plan)} & large_tables) - allowed
+                if scanned:
+                    failures.append((url, sorted(scanned), ' '.join(query.split())[:120]))
+            cur.close()
+        print('%-50s %s' % (url, 'FAIL' if failures and failures[-1][0] == url else 'ok'))
+
+    if failures:
+        print(json.dumps(failures, indent=2))
+        print('FAIL: %d statement(s) fall back to sequential scans' % len(failures))
+        return 1
+    print('OK: no sequential scans on tables over %d rows' % SEQ_SCAN_MIN_ROWS)
+    return 0
+
+
+# ============================================================================
+# ROUTE BENCHMARK
+# ============================================================================
+
+# Every analytics read route, response cache detached
+BENCH_ROUTES = [
+    '/api/analytics/overview',
+    '/api/analytics/schools/stats?limit=50',
+    '/api/analytics/books/popular?limit=20',
+    '/api/analytics/timeline?range=30d',
+    '/api/analytics/timeline?range=365d',
+    '/api/analytics/books/by-grade',
+    '/api/analytics/device/stats',
+    '/api/analytics/sync/status',
+    '/api/analytics/pages/engagement',
+    '/api/analytics/pages/engagement?bookId={book_id}',
+    '/api/analytics/reading-patterns',
+    '/api/analytics/books/{book_id}/details',
+    '/api/analytics/schools/{school_id}/timeline?range=30d',
+    '/api/analytics/dashboard',
+]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _dataset_size(pool):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT relname, GREATEST(reltuples, 0)::bigint AS rows
+            FROM pg_class
+            WHERE relname IN ('schools', 'books', 'page_sessions', 'sync_logs', 'device_info')
+                AND relkind IN ('r', 'p');
+        """)
+        size = {row['relname']: row['rows'] for row in cur.fetchall()}
+        cur.close()
+    return size
+
+
+def _summary(values):
+    values = sorted(values)
+    return {
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'mean': round(sum(values) / len(values), 2),
+    }
+
+
+def bench_routes(*argv):
+    """Time every analytics route and write the results to JSON"""
+    parser = argparse.ArgumentParser(prog='analytics_bench.py routes')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--book-id', type=int, default=1)
+    parser.add_argument('--school-id', type=int, default=1)
+    parser.add_argument('--label', default=None, help='Free-form tag stored with the results')
+    parser.add_argument('--out', default='bench-results.json')
+    parser.add_argument('--compare', default=None, help='Earlier results file to diff p95 against')
+    args = parser.parse_args(argv)
+
+    from analytics_backend_example import app
+    pool = use_recording_pool()
+    client = app.test_client()
+
+    results = {}
+    print('%-55s %8s %8s %8s %8s %6s' % ('url', 'p50 ms', 'p95 ms', 'p99 ms', 'db p95', 'stmts'))
+    for template in BENCH_ROUTES:
+        url = template.format(book_id=args.book_id, school_id=args.school_id)
+        for _ in range(args.warmup):
+            run_route(client, url)
+        latencies, db_times = [], []
+        for _ in range(args.iterations):
+            statements, rows, elapsed_ms = run_route(client, url)
+            latencies.append(elapsed_ms)
+            db_times.append(RecordingCursor.db_ms)
+        latency, db = _summary(latencies), _summary(db_times)
+        results[url] = {
+            'p50Ms': latency['p50'], 'p95Ms': latency['p95'], 'p99Ms': latency['p99'],
+            'meanMs': latency['mean'],
+            'dbP50Ms': db['p50'], 'dbP95Ms': db['p95'], 'dbP99Ms': db['p99'],
+            'statements': len(statements),
+            'rows': rows,
+        }
+        print('%-55s %8.1f %8.1f %8.1f %8.1f %6d' % (
+            url, latency['p50'], latency['p95'], latency['p99'], db['p95'], len(statements)))
+
+    report = {
+        'label': args.label,
+        'commit': _git_commit(),
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+        'iterations': args.iterations,
+        'dataset': _dataset_size(pool),
+        'routes': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote %s' % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print('\np95 vs %s (%s):' % (args.compare, previous.get('commit')))
+        for url, result in results.items():
+            before = previous.get('routes', {}).get(url)
+            if before:
+                change = (result['p95Ms'] - before['p95Ms']) / before['p95Ms'] * 100 if before['p95Ms'] else 0
+                print('%-55s %8.1f -> %8.1f  %+6.1f%%' % (url, before['p95Ms'], result['p95Ms'], change))
+    return 0
+
+
+# ============================================================================
+# LOAD TEST
+# ============================================================================
+# Compares servers under many concurrent dashboard clients, e.g. the Flask
+# app under a threaded WSGI server against the async variant:
+#
+#   gunicorn -w 4 --threads 8 -b :8080 analytics_backend_example:app
+#   ANALYTICS_PORT=8081 ANALYTICS_WORKERS=4 python analytics_asgi.py
+#   python analytics_bench.py loadtest --clients 200 http://localhost:8080 http://localhost:8081
+#
+# The Flask sections are served from its response cache after the first
+# load; for a like-for-like comparison of the database path set its
+# CACHE_TTLS to 0 first.
+
+LOADTEST_PATH = '/api/analytics/dashboard'
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _load_client(base_url, path, deadline, latencies, errors):
+    """One client: request `path` back to back until `deadline`"""
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            ok = False
+        (latencies if ok else errors).append((time.perf_counter() - started) * 1000)
+    conn.close()
+
+
+def run_loadtest(base_url, clients, duration, path=LOADTEST_PATH):
+    """Hammer one server with `clients` concurrent clients for `duration` seconds"""
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=_load_client, args=(base_url, path, deadline, latencies, errors), daemon=True)
+        for _ in range(clients)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'url': base_url + path,
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50Ms': percentile(latencies, 50),
+        'p95Ms': percentile(latencies, 95),
+        'p99Ms': percentile(latencies, 99),
+    }
+
+
+def bench_loadtest(*argv):
+    """Report throughput and latency percentiles for each server URL"""
+    parser = argparse.ArgumentParser(prog='analytics_bench.py loadtest')
+    parser.add_argument('urls', nargs='+', help='Base URL of each server to compare')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds per server')
+    parser.add_argument('--path', default=LOADTEST_PATH)
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    print('%-45s %8s %8s %8s %10s %10s %10s' % ('url', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for base_url in args.urls:
+        result = run_loadtest(base_url.rstrip('/'), args.clients, args.duration, args.path)
+        results.append(result)
+        print('%-45s %8d %8d %8.1f %10s %10s %10s' % (
+            result['url'], result['requests'], result['errors'], result['rps'],
+            *('%.1f' % result[key] if result[key] is not None else '-' for key in ('p50Ms', 'p95Ms', 'p99Ms'))
+        ))
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+# ============================================================================
+# HLL ACCURACY
+# ============================================================================
+
+HLL_SIZES = (10, 50, 1_000, 5_000, 20_000, 100_000, 1_000_000)
+HLL_SEED = 20240601
+
+
+def bench_hll_accuracy():
+    """Fail if any HLL estimate is outside 3 standard errors of the exact count
+
+    Checks single sketches at each size and the union of overlapping
+    sketches (as when merging day sketches over a range) on generated data.
+    """
+    rng = random.Random(HLL_SEED)
+    bound = 3 * 1.04 / math.sqrt(1 << PRECISION)
+    failures = 0
+
+    print('%-30s %10s %10s %8s' % ('case', 'exact', 'estimate', 'error'))
+
+    def check(case, exact, estimate):
+        nonlocal failures
+        error = (estimate - exact) / exact
+        ok = abs(error) <= bound
+        failures += not ok
+        print('%-30s %10d %10d %+7.2f%%%s' % (case, exact, estimate, error * 100, '' if ok else '  FAIL'))
+
+    for size in HLL_SIZES:
+        values = rng.sample(range(10 ** 12), size)
+        check('single n=%d' % size, size, HyperLogLog().update(values).count())
+
+    # 365 "days" drawing from a population of 5000 schools, as in the
+    # per-day school sketches merged over a year
+    population = rng.sample(range(10 ** 9), 5_000)
+    days = [rng.sample(population, rng.randint(50, 800)) for _ in range(365)]
+    blobs = [HyperLogLog().update(day).to_bytes() for day in days]
+    check('merged 365 days', len(set().union(*days)), merged_count(blobs))
+
+    if failures:
+        print('FAIL: %d estimate(s) outside +/-%.2f%%' % (failures, bound * 100))
+        return 1
+    print('OK: all estimates within +/-%.2f%% (3 standard errors, p=%d)' % (bound * 100, PRECISION))
+    return 0
+
+
+# ============================================================================
+# JSON ENCODING / COMPRESSION
+# ============================================================================
+
+def _flask_default_dumps(obj):
+    """What jsonify produced before analytics_json: stdlib, Decimal as string"""
+    def default(value):
+        if isinstance(value, Decimal):
+            return str(value)
+        return json_default(value)
+    return json.dumps(obj, default=default, sort_keys=True, separators=(',', ':')).encode()
+
+
+def _encoding_payloads():
+    from analytics_queries import get_time_range_ms
+    from analytics_rollups import rollup_timeline_query
+    return [
+        ('books/popular?limit=100', popular_books_query(100)),
+        ('timeline?range=365d', rollup_timeline_query(*get_time_range_ms('365d'))),
+    ]
+
+
+def bench_encoding(*argv):
+    """CPU time to fetch + serialize the largest payloads, and bytes saved
+
+    Compares the previous path (RealDictCursor rows through the stdlib
+    encoder) with tuple rows through fetch_dicts and analytics_json.dumps,
+    then compresses the new body with gzip and brotli.
+    """
+    parser = argparse.ArgumentParser(prog='analytics_bench.py encoding')
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    from analytics_backend_example import DB_CONFIG
+    from analytics_queries import fetch_dicts
+
+    variants = [
+        ('dict rows + json', RealDictCursor, _flask_default_dumps),
+        ('tuple rows + %s' % ENCODER, extensions.cursor, dumps),
+    ]
+    conn = psycopg2.connect(**DB_CONFIG)
+    print('%-26s %-22s %10s %10s' % ('payload', 'path', 'cpu ms', 'bytes'))
+    for name, (query, params) in _encoding_payloads():
+        for label, cursor_factory, encode in variants:
+            started = time.process_time()
+            for _ in range(args.iterations):
+                cur = conn.cursor(cursor_factory=cursor_factory)
+                cur.execute(query, params)
+                body = encode({'success': True, 'data': fetch_dicts(cur)})
+                cur.close()
+            cpu_ms = (time.process_time() - started) * 1000 / args.iterations
+            print('%-26s %-22s %10.2f %10d' % (name, label, cpu_ms, len(body)))
+        conn.rollback()
+
+        for encoding in ('gzip', 'br') if brotli is not None else ('gzip',):
+            started = time.process_time()
+            for _ in range(args.iterations):
+                compressed = compress(body, encoding)
+            cpu_ms = (time.process_time() - started) * 1000 / args.iterations
+            print('%-26s %-22s %10.2f %10d  (-%.0f%%)' % (
+                name, '  + ' + encoding, cpu_ms, len(compressed), (1 - len(compressed) / len(body)) * 100))
+    conn.close()
+    return 0
+
+
+# ============================================================================
+# COLUMNAR ENGINE
+# ============================================================================
+
+def bench_columnar_check():
+    """Load the columnar engine and fail on any result differing from SQL"""
+    from analytics_backend_example import DB_CONFIG
+    from analytics_columnar import ColumnarEngine
+    from analytics_queries import (
+        get_time_range_ms, fetch_dicts, PAGE_ENGAGEMENT_BOOK_SQL, PAGE_ENGAGEMENT_TOP_SQL,
+    )
+    from analytics_rollups import (
+        rollup_timeline_query, rollup_school_timeline_query, rollup_reading_patterns_query,
+    )
+
+    engine = ColumnarEngine(DB_CONFIG, autostart=False)
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    started = time.perf_counter()
+    engine.refresh(conn)
+    print('Loaded %(rows)d rows in %(chunks)d chunks, %(bytes)d bytes' % engine.stats(),
+          'in %.1fs' % (time.perf_counter() - started))
+
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(school_id) AS school_id, MIN(book_id) AS book_id FROM books;")
+    school_id, book_id = cur.fetchone()
+
+    cases = []
+    for range_str in ('24h', '30d', '365d'):
+        start, end = get_time_range_ms(range_str)
+        cases += [
+            ('timeline %s' % range_str, rollup_timeline_query(start, end),
+             lambda start=start, end=end: engine.timeline(start, end)),
+            ('school timeline %s' % range_str, rollup_school_timeline_query(school_id, start, end),
+             lambda start=start, end=end: engine.timeline(start, end, school_id)),
+        ]
+    start, end = get_time_range_ms('30d')
+    cases += [
+        ('reading patterns 30d', rollup_reading_patterns_query(start, end),
+         lambda: engine.reading_patterns(start, end)),
+        ('page engagement book %s' % book_id, (PAGE_ENGAGEMENT_BOOK_SQL, (book_id,)),
+         lambda: engine.page_engagement(book_id)),
+        ('page engagement top', (PAGE_ENGAGEMENT_TOP_SQL, None),
+         lambda: engine.page_engagement()),
+    ]
+
+    failures = 0
+    print('%-28s %10s %10s %6s' % ('case', 'sql ms', 'engine ms', 'rows'))
+    for name, (query, params), run in cases:
+        started = time.perf_counter()
+        cur.execute(query, params)
+        expected = json.loads(dumps(fetch_dicts(cur)))
+        sql_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        actual = json.loads(dumps(run()))
+        engine_ms = (time.perf_counter() - started) * 1000
+        if name.startswith('page engagement'):
+            # Ties in the SQL ORDER BY come back in any order
+            expected.sort(key=lambda row: json.dumps(row, sort_keys=True))
+            actual.sort(key=lambda row: json.dumps(row, sort_keys=True))
+        ok = actual == expected
+        failures += not ok
+        print('%-28s %10.1f %10.1f %6d%s' % (name, sql_ms, engine_ms, len(expected), '' if ok else '  MISMATCH'))
+    conn.close()
+
+    if failures:
+        print('%d case(s) differ from SQL' % failures)
+        return 1
+    return 0
+
+
+# ============================================================================
+# PAGE COVERAGE BITMAPS
+# ============================================================================
+
+# (name, array query, bitmap query); both return (book_id, value) rows
+PAGE_BITMAP_CASES = [
+    ('totalAccessCount per book',
+     "SELECT book_id, COALESCE(SUM(ARRAY_LENGTH(pages_accessed, 1)), 0) FROM analytics_pages_accessed_archive "
+     "GROUP BY book_id ORDER BY book_id;",
+     "SELECT book_id, SUM(access_count) FROM bench_page_bitmaps GROUP BY book_id ORDER BY book_id;"),
+    ('pagesAccessed per book',
+     "SELECT b.book_id, ARRAY_AGG(DISTINCT page_num ORDER BY page_num) FROM analytics_pages_accessed_archive b "
+     "CROSS JOIN LATERAL unnest(b.pages_accessed) AS page_num GROUP BY b.book_id ORDER BY b.book_id;",
+     "SELECT book_id, analytics_varbit_pages(analytics_bit_union(pages_bitmap)) FROM bench_page_bitmaps "
+     "WHERE pages_count > 0 GROUP BY book_id ORDER BY book_id;"),
+]
+
+
+def bench_page_bitmaps():
+    """Compare the bitmap queries with the integer[] queries they replaced
+
+    The array side reads the original arrays, which the bitmaps migration
+    keeps in analytics_pages_accessed_archive; the bitmap side converts
+    those same rows into a temp table shaped like books. Checks results and
+    measures time and storage on the data as it was at migration time.
+    """
+    from analytics_backend_example import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('analytics_pages_accessed_archive') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        print('analytics_pages_accessed_archive not found; run `flask db migrate` first')
+        conn.close()
+        return 1
+    cur.execute("""
+        CREATE TEMP TABLE bench_page_bitmaps (
+            id integer,
+            book_id integer,
+            pages_bitmap varbit NOT NULL,
+            pages_count integer GENERATED ALWAYS AS (analytics_varbit_count(pages_bitmap)) STORED,
+            access_count integer NOT NULL
+        );
+        INSERT INTO bench_page_bitmaps (id, book_id, pages_bitmap, access_count)
+        SELECT id, book_id, COALESCE(analytics_pages_varbit(pages_accessed), B''),
+               COALESCE(cardinality(pages_accessed), 0)
+        FROM analytics_pages_accessed_archive;
+        ANALYZE bench_page_bitmaps;
+    """)
+    cur.execute("""
+        SELECT
+            (SELECT SUM(pg_column_size(pages_accessed)) FROM analytics_pages_accessed_archive),
+            (SELECT SUM(pg_column_size(pages_bitmap)) FROM bench_page_bitmaps);
+    """)
+    array_bytes, bitmap_bytes = cur.fetchone()
+    print('storage: arrays %d bytes, bitmaps %d bytes' % (array_bytes or 0, bitmap_bytes or 0))
+
+    failures = 0
+    print('%-28s %10s %10s %6s' % ('case', 'array ms', 'bitmap ms', 'rows'))
+    for name, array_sql, bitmap_sql in PAGE_BITMAP_CASES:
+        timings, results = [], []
+        for query in (array_sql, bitmap_sql):
+            started = time.perf_counter()
+            cur.execute(query)
+            results.append(cur.fetchall())
+            timings.append((time.perf_counter() - started) * 1000)
+        ok = results[0] == results[1]
+        failures += not ok
+        print('%-28s %10.1f %10.1f %6d%s' % (name, timings[0], timings[1], len(results[0]),
+                                            '' if ok else '  MISMATCH'))
+    conn.close()
+
+    if failures:
+        print('%d case(s) differ' % failures)
+        return 1
+    return 0
+
+
+# ============================================================================
+# TOP-K RANKINGS
+# ============================================================================
+
+def bench_topk_check():
+    """Load the top-K engine and fail on any ranking differing from SQL"""
+    from analytics_backend_example import DB_CONFIG
+    from analytics_queries import fetch_dicts
+    from analytics_topk import WINDOW_DAYS, TopKEngine, top_books_query, top_pages_query
+
+    engine = TopKEngine(DB_CONFIG, autostart=False)
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    engine.refresh(conn)
+    print('Loaded %(days)d days, %(pageCounters)d page counters in %(lastRefreshMs)d ms' % engine.stats())
+
+    cur = conn.cursor()
+    failures = 0
+    print('%-14s %10s %10s %6s' % ('case', 'sql ms', 'engine ms', 'rows'))
+    for window in WINDOW_DAYS:
+        for kind, query, run in (
+            ('books', top_books_query(window, engine.k), engine.top_books),
+            ('pages', top_pages_query(window, engine.k), engine.top_pages),
+        ):
+            started = time.perf_counter()
+            cur.execute(*query)
+            expected = json.loads(dumps(fetch_dicts(cur)))
+            sql_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            actual = json.loads(dumps(run(window, engine.k)))
+            engine_ms = (time.perf_counter() - started) * 1000
+            ok = actual == expected
+            failures += not ok
+            print('%-14s %10.1f %10.3f %6d%s' % ('%s %s' % (kind, window), sql_ms, engine_ms, len(expected),
+                                                '' if ok else '  MISMATCH'))
+    conn.close()
+
+    if failures:
+        print('%d case(s) differ from SQL' % failures)
+        return 1
+    return 0
+
+
+# ============================================================================
+# READ REPLICAS
+# ============================================================================
+
+def bench_replica_check(*argv):
+    """Check replica routing against running standbys
+
+    Uses REPLICA_CONFIGS, or DB_CONFIG on each --port (standbys of the local
+    server). Fails if a routed checkout lands on a server that is not in
+    recovery, or if a replica is used before it replayed a fresh commit.
+    """
+    from analytics_backend_example import DB_CONFIG, REPLICA_CONFIGS, REPLICA_MAX_LAG_SECONDS
+    parser = argparse.ArgumentParser(prog='analytics_bench.py replica-check')
+    parser.add_argument('--port', type=int, action='append', default=[])
+    parser.add_argument('--checkouts', type=int, default=20)
+    args = parser.parse_args(argv)
+    configs = [dict(DB_CONFIG, port=port) for port in args.port] or REPLICA_CONFIGS
+    if not configs:
+        print('No replicas: set REPLICA_CONFIGS or pass --port')
+        return 2
+
+    primary = ConnectionPool(DB_CONFIG, minconn=1, maxconn=2)
+    router = ReplicaRouter(primary, configs, REPLICA_MAX_LAG_SECONDS, autostart=False, maxconn=2)
+    router.check()
+    for replica in router.stats()['replicas']:
+        print('%-20s healthy=%-5s lag=%ss %s' % (replica['name'], replica['healthy'], replica['lagSeconds'],
+                                                 replica['lastError'] or ''))
+
+    failures = 0
+    served = {}
+    for _ in range(args.checkouts):
+        routed = router.getconn()
+        if routed is None:
+            served['primary'] = served.get('primary', 0) + 1
+            continue
+        replica, conn = routed
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        cur.execute("SELECT pg_is_in_recovery();")
+        failures += not cur.fetchone()[0]
+        cur.close()
+        conn.rollback()
+        replica.pool.putconn(conn)
+        served[replica.name] = served.get(replica.name, 0) + 1
+    print('checkouts:', ', '.join('%s=%d' % item for item in sorted(served.items())))
+
+    # A commit on the primary (txid_current() forces a commit record), then
+    # wait for the first replica checkout after it
+    with primary.connection() as conn:
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        cur.execute("SELECT txid_current();")
+        conn.commit()
+        cur.execute("SELECT pg_current_wal_lsn()::text;")
+        written = cur.fetchone()[0]
+        cur.close()
+    router.note_write()
+    started = time.perf_counter()
+    while time.perf_counter() - started < REPLICA_MAX_LAG_SECONDS:
+        routed = router.getconn()
+        if routed is not None:
+            replica, conn = routed
+            cur = conn.cursor(cursor_factory=extensions.cursor)
+            cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn;", (written,))
+            caught_up = cur.fetchone()[0]
+            cur.close()
+            conn.rollback()
+            replica.pool.putconn(conn)
+            failures += not caught_up
+            print('after a commit: %s served again in %.1f ms%s' % (
+                replica.name, (time.perf_counter() - started) * 1000, '' if caught_up else '  NOT CAUGHT UP'))
+            break
+        time.sleep(0.01)
+    else:
+        print('after a commit: no replica caught up within %ss' % REPLICA_MAX_LAG_SECONDS)
+
+    primary.closeall()
+    for replica in router.replicas:
+        replica.pool.closeall()
+    if failures:
+        print('%d check(s) failed' % failures)
+        return 1
+    return 0
+
+
+COMMANDS = {
+    'query-count': bench_query_count,
+    'explain-check': bench_explain_check,
+    'loadtest': bench_loadtest,
+    'hll-accuracy': bench_hll_accuracy,
+    'routes': bench_routes,
+    'encoding': bench_encoding,
+    'columnar-check': bench_columnar_check,
+    'page-bitmaps': bench_page_bitmaps,
+    'topk-check': bench_topk_check,
+    'replica-check': bench_replica_check,
+}
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'query-count'
+    if command not in COMMANDS:
+        print('Unknown command %r, expected one of: %s' % (command, ', '.join(COMMANDS)))
+        sys.exit(2)
+    sys.exit(COMMANDS[command](*sys.argv[2:]))
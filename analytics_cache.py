@@ -0,0 +1,425 @@
+# Response cache for the analytics endpoints
+#
+# Successful JSON responses are cached per route + normalized query args with
+# a per-endpoint TTL. Only one request recomputes an expired key; concurrent
+# requests for the same key wait for it instead of hitting the database.
+#
+# All analytics data changes only when a school syncs, so invalidation is a
+# single generation bump: a trigger on sync_logs sends NOTIFY and a listener
+# thread bumps the generation, which orphans every cached key at once (old
+# entries age out of the LRU or expire in Redis). Endpoints that serve
+# background job output (cached(..., jobs=True)) also key on the latest job
+# run id, announced on analytics_jobs.JOB_NOTIFY_CHANNEL, so a new job
+# result only orphans those.
+#
+# The Flask side of conditional GET (analytics_etag) and response encoding
+# (analytics_json) lives here as well: both wrap the same responses.
+
+import select
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+import psycopg2
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+from analytics_db import PoolTimeout, get_read_connection
+from analytics_etag import CACHE_CONTROL, SYNC_WATERMARK_SQL, etag_matches, make_etag
+from analytics_jobs import JOB_NOTIFY_CHANNEL
+from analytics_json import compress, dumps, negotiate_encoding
+
+SYNC_NOTIFY_CHANNEL = 'analytics_sync'
+
+SYNC_NOTIFY_SQL = """
+    CREATE OR REPLACE FUNCTION analytics_notify_sync() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('analytics_sync', '');
+        RETURN NULL;
+    END;
+    $$;
+
+    DROP TRIGGER IF EXISTS trg_sync_logs_notify ON sync_logs;
+    CREATE TRIGGER trg_sync_logs_notify
+        AFTER INSERT ON sync_logs
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_notify_sync();
+"""
+
+
+# ============================================================================
+# BACKENDS
+# ============================================================================
+
+class MemoryLRUBackend:
+    """In-process LRU bounded by entry count and total payload bytes"""
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}  # key -> [lock, requests holding or waiting for it]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def generation(self):
+        return self._generation
+
+    def bump_generation(self):
+        with self._lock:
+            self._generation += 1
+            # Nothing can read the old generation again, free it right away
+            self._entries.clear()
+            self._bytes = 0
+
+    def lock(self, key):
+        """Per-key lock; every call must be paired with release_lock(key)"""
+        with self._lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release_lock(self, key):
+        # Dropped only when no request holds or waits for it: a waiter must
+        # keep serializing with the holder, not with a fresh lock
+        with self._lock:
+            entry = self._key_locks.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def info(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxEntries': self.max_entries,
+                'maxBytes': self.max_bytes,
+                'generation': self._generation,
+            }
+
+
+class RedisBackend:
+    """Redis-backed cache shared by every worker process
+
+    Works against any Redis-compatible server (e.g. a local redis-server or
+    a stand-in such as KeyDB). Requires the optional `redis` package.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='analytics:', lock_timeout=30):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RedisBackend requires the redis package (pip install redis)')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def generation(self):
+        return int(self.client.get(self.prefix + 'generation') or 0)
+
+    def bump_generation(self):
+        self.client.incr(self.prefix + 'generation')
+
+    def lock(self, key):
+        return self.client.lock(self.prefix + 'lock:' + key, timeout=self.lock_timeout)
+
+    def release_lock(self, key):
+        pass
+
+    def info(self):
+        return {
+            'backend': 'redis',
+            'entries': self.client.dbsize(),
+            'generation': self.generation(),
+        }
+
+
+# ============================================================================
+# CACHE
+# ============================================================================
+
+class ResponseCache:
+    def __init__(self, backend, ttls=None, default_ttl=60):
+        self.backend = backend
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.job_watermark = 0  # latest job run id announced
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'coalesced': 0})
+        self._stats_lock = threading.Lock()
+
+    def _count(self, endpoint, field):
+        with self._stats_lock:
+            self._stats[endpoint][field] += 1
+
+    def make_key(self, path, args, jobs=False):
+        normalized = '&'.join(
+            '%s=%s' % (k, v) for k, v in sorted(args.items(multi=True))
+        )
+        if jobs:
+            return '%d:j%d:%s?%s' % (self.backend.generation(), self.job_watermark, path, normalized)
+        return '%d:%s?%s' % (self.backend.generation(), path, normalized)
+
+    def get_or_compute(self, endpoint, key, compute):
+        """Return cached bytes for `key`, computing them at most once at a time
+
+        `compute` returns bytes to cache, or None to skip caching (errors).
+        Returns (value, status) where status is 'hit', 'coalesced' or 'miss'.
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            self._count(endpoint, 'hits')
+            return value, 'hit'
+
+        try:
+            with self.backend.lock(key):
+                # Another request may have filled the key while we waited
+                value = self.backend.get(key)
+                if value is not None:
+                    self._count(endpoint, 'coalesced')
+                    return value, 'coalesced'
+                self._count(endpoint, 'misses')
+                value = compute()
+                if value is not None:
+                    self.backend.set(key, value, self.ttls.get(endpoint, self.default_ttl))
+                return value, 'miss'
+        finally:
+            self.backend.release_lock(key)
+
+    def invalidate(self):
+        """Drop every cached response (new sync data has landed)"""
+        self.backend.bump_generation()
+
+    def advance_job_watermark(self, run_id):
+        """Drop responses built from older job output (a job stored a new result)"""
+        self.job_watermark = max(self.job_watermark, run_id)
+
+    def stats(self):
+        with self._stats_lock:
+            endpoints = {}
+            for endpoint, counts in self._stats.items():
+                lookups = counts['hits'] + counts['coalesced'] + counts['misses']
+                endpoints[endpoint] = dict(
+                    counts,
+                    ttl=self.ttls.get(endpoint, self.default_ttl),
+                    hitRate=round((counts['hits'] + counts['coalesced']) / lookups, 4) if lookups else 0,
+                )
+        return {'backend': self.backend.info(), 'endpoints': endpoints}
+
+
+# ============================================================================
+# FLASK INTEGRATION
+# ============================================================================
+
+def init_cache(app, backend, ttls=None, default_ttl=60):
+    cache = ResponseCache(backend, ttls, default_ttl)
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def get_cache(app):
+    return app.extensions['response_cache']
+
+
+def cached(endpoint, jobs=False):
+    """Cache a view's successful JSON responses under `endpoint`'s TTL
+
+    `jobs`: the view serves background job output, so new results of any
+    job invalidate its entries too.
+
+    Responses that set Cache-Control themselves (no-store answers from the
+    in-memory engines) are passed through uncached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None:
+                return view(*args, **kwargs)
+
+            uncached = []
+
+            def compute():
+                rv = current_app.make_response(view(*args, **kwargs))
+                uncached.append(rv)
+                return rv.get_data() if rv.status_code == 200 and 'Cache-Control' not in rv.headers else None
+
+            key = cache.make_key(request.path, request.args, jobs)
+            body, status = cache.get_or_compute(endpoint, key, compute)
+            if uncached:
+                response = uncached[0]
+            else:
+                response = Response(body, mimetype='application/json')
+            response.headers['X-Cache'] = status.upper()
+            return response
+        return wrapper
+    return decorator
+
+
+def init_conditional_get(app, time_bucket=3600):
+    """Enable ETag / If-None-Match on views decorated with `conditional`"""
+    app.extensions['etag_time_bucket'] = time_bucket
+
+
+def conditional(view):
+    """Tag successful responses with the sync watermark ETag (analytics_etag)
+
+    A matching If-None-Match is answered with 304 before the view, and the
+    response cache, run. Responses that already set Cache-Control (partial
+    dashboard bundles) are passed through untagged.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        time_bucket = current_app.extensions.get('etag_time_bucket')
+        if time_bucket is None:
+            return view(*args, **kwargs)
+
+        # On database errors, let the view report the problem itself. The
+        # watermark comes from the server the view will read from.
+        try:
+            conn = get_read_connection(current_app)
+        except PoolTimeout:
+            return view(*args, **kwargs)
+        try:
+            cur = conn.cursor()
+            cur.execute(SYNC_WATERMARK_SQL)
+            watermark = cur.fetchone()['watermark']
+            cur.close()
+        except psycopg2.Error:
+            if not conn.closed:
+                conn.rollback()
+            return view(*args, **kwargs)
+
+        etag = make_etag(watermark, request.path, request.args.items(multi=True), time_bucket)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response = Response(status=304)
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or 'Cache-Control' in response.headers:
+                return response
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
+    return wrapper
+
+
+# ============================================================================
+# RESPONSE ENCODING
+# ============================================================================
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through analytics_json.dumps (orjson when installed)"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b'\n', mimetype=self.mimetype)
+
+
+def init_response_encoding(app, compress_min_size=1024):
+    """Serialize with FastJSONProvider and compress bodies of at least
+    `compress_min_size` bytes as the client's Accept-Encoding allows
+
+    Streamed responses (exports) and non-200 responses are left alone. The
+    response cache keeps uncompressed bodies, since the encoding depends on
+    the client.
+    """
+    app.json = FastJSONProvider(app)
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        body = response.get_data()
+        if encoding is None or len(body) < compress_min_size:
+            return response
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def start_sync_listener(cache, db_config, reconnect_delay=5.0, on_sync=None):
+    """LISTEN for sync_logs inserts on a dedicated connection and invalidate
+
+    Runs in a daemon thread; reconnects if the connection drops. Pending
+    notifications are collapsed into one invalidation. `on_sync()` is called
+    before each invalidation (ReplicaRouter.note_write, TopKEngine.request_refresh).
+    Job results (JOB_NOTIFY_CHANNEL) only advance the cache's job watermark.
+    """
+    def synced():
+        if on_sync is not None:
+            on_sync()
+        cache.invalidate()
+
+    def listen():
+        while True:
+            try:
+                conn = psycopg2.connect(**db_config)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute('LISTEN %s;' % SYNC_NOTIFY_CHANNEL)
+                cur.execute('LISTEN %s;' % JOB_NOTIFY_CHANNEL)
+                # Anything may have synced while we were disconnected
+                synced()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    notifies, conn.notifies[:] = list(conn.notifies), []
+                    for notify in notifies:
+                        if notify.channel == JOB_NOTIFY_CHANNEL and notify.payload.isdigit():
+                            cache.advance_job_watermark(int(notify.payload))
+                    if any(notify.channel == SYNC_NOTIFY_CHANNEL for notify in notifies):
+                        synced()
+            except psycopg2.Error:
+                time.sleep(reconnect_delay)
+
+    thread = threading.Thread(target=listen, name='analytics-sync-listener', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,481 @@
+# Columnar in-memory engine for page_sessions
+#
+# Optional backend (ANALYTICS_ENGINE = 'columnar') for the routes that slice
+# raw sessions: page engagement, reading patterns and the global / per-school
+# timelines. page_sessions is held in NumPy column arrays, about 29 bytes a
+# row:
+#
+#   start    int64   session_start_time (epoch ms)
+#   record   int32   book_record_id (school and title are looked up through
+#                    the small books arrays, so book edits apply at once)
+#   book     int32   book_id
+#   page     int32   page_number
+#   active   int64   active_time_ms (0 where NULL)
+#   timed    bool    active_time_ms IS NOT NULL
+#
+# and queries are vectorized group-bys (bincount over dense keys) instead of
+# SQL GROUP BYs. Results match the SQL path exactly, including NULL sums and
+# ROUND() half-away-from-zero (sums are accumulated in float64, exact up to
+# 2^53 ms per group); `python analytics_bench.py columnar-check` compares the
+# two on the loaded database.
+#
+# Loading uses COPY (FORMAT binary) in id ranges, parsed straight into arrays.
+# page_sessions is insert-only, so a refresh only loads ids above the last
+# settled id. Ids are not committed in order, so rows become "settled" only
+# once every transaction that was running when their max id was read has
+# finished; newer rows are kept in a tail chunk that is reloaded on every
+# refresh. When partitions are pruned (the oldest session disappears) the
+# engine reloads from scratch in the background and swaps the new state in.
+
+import io
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from zoneinfo import ZoneInfo
+
+import psycopg2
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from analytics_rollups import ROLLUP_TIMEZONE
+
+DAY_MS = 24 * 60 * 60 * 1000
+# Local day / hour / weekday are resolved per 15-minute slot, which covers
+# every current UTC offset and DST rule
+SLOT_MS = 15 * 60 * 1000
+SLOTS_PER_DAY = DAY_MS // SLOT_MS
+
+LOAD_BATCH_IDS = 2_000_000
+SETTLE_TIMEOUT = 30.0  # seconds to wait for in-flight syncs before settling
+MAX_CHUNKS = 64
+# Not `ready` once the last successful refresh is this many intervals old
+STALE_REFRESHES = 3
+# Group-bys over key spaces up to this size use dense bincounts
+DENSE_KEYS = 1 << 24
+
+BOUNDS_SQL = """
+    SELECT
+        MAX(id) AS max_id,
+        MIN(session_start_time) AS min_start,
+        pg_snapshot_xmax(pg_current_snapshot())::text::bigint AS xmax
+    FROM page_sessions;
+"""
+
+XMIN_SQL = "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS xmin;"
+
+COPY_SESSIONS_SQL = """
+    COPY (
+        SELECT
+            session_start_time, book_record_id, book_id, page_number,
+            COALESCE(active_time_ms, 0), active_time_ms IS NOT NULL
+        FROM page_sessions
+        WHERE id > %s AND id <= %s
+    ) TO STDOUT (FORMAT binary)
+"""
+
+BOOKS_SQL = "SELECT id, school_id, book_title FROM books;"
+
+# COPY binary: 19-byte header, then per row a field count and a length
+# before every field, all big-endian; 2-byte trailer
+_COPY_HEADER = 19
+_COPY_TRAILER = 2
+_COPY_FIELDS = [('start', '>i8'), ('record', '>i4'), ('book', '>i4'), ('page', '>i4'),
+                ('active', '>i8'), ('timed', 'u1')]
+
+_MAX_ID = 2 ** 63 - 1
+
+Chunk = namedtuple('Chunk', 'start record book page active timed min_start max_start')
+
+State = namedtuple('State', 'chunks tail settled_upto min_start school_of title_of titles max_book max_page memo')
+
+
+def _copy_dtype():
+    fields = [('fields', '>i2')]
+    for name, kind in _COPY_FIELDS:
+        fields += [('len_' + name, '>i4'), (name, kind)]
+    return np.dtype(fields)
+
+
+def _make_chunk(start, record, book, page, active, timed):
+    return Chunk(start, record, book, page, active, timed,
+                 int(start.min()) if len(start) else 0, int(start.max()) if len(start) else -1)
+
+
+def _concat(chunks):
+    columns = [np.concatenate([getattr(c, name) for c in chunks]) for name, _ in _COPY_FIELDS]
+    return _make_chunk(*columns)
+
+
+def _round_half_up(total, count):
+    """ROUND(total / count) as numeric ROUND() does"""
+    return int((Decimal(total) / Decimal(count)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+# ============================================================================
+# LOADING
+# ============================================================================
+
+def load_sessions(conn, after_id, upto_id):
+    """Sessions with after_id < id <= upto_id as one Chunk"""
+    dtype = _copy_dtype()
+    cur = conn.cursor()
+    buf = io.BytesIO()
+    cur.copy_expert(cur.mogrify(COPY_SESSIONS_SQL, (after_id, upto_id)).decode(), buf)
+    cur.close()
+    data = buf.getbuffer()
+    rows = np.frombuffer(data, dtype, count=(len(data) - _COPY_HEADER - _COPY_TRAILER) // dtype.itemsize,
+                         offset=_COPY_HEADER)
+    return _make_chunk(
+        rows['start'].astype(np.int64), rows['record'].astype(np.int32), rows['book'].astype(np.int32),
+        rows['page'].astype(np.int32), rows['active'].astype(np.int64), rows['timed'].astype(bool),
+    )
+
+
+def load_books(conn):
+    """(school_of, title_of, titles): arrays indexed by books.id"""
+    cur = conn.cursor()
+    cur.execute(BOOKS_SQL)
+    rows = cur.fetchall()
+    cur.close()
+    size = max((row[0] for row in rows), default=0) + 1
+    school_of = np.zeros(size, np.int32)
+    title_of = np.zeros(size, np.int32)
+    titles, codes = [None], {None: 0}
+    for record_id, school_id, title in rows:
+        school_of[record_id] = school_id or 0
+        if title not in codes:
+            codes[title] = len(titles)
+            titles.append(title)
+        title_of[record_id] = codes[title]
+    return school_of, title_of, titles
+
+
+def _compact(chunks, max_chunks=MAX_CHUNKS):
+    """Merge the smallest adjacent pairs until at most `max_chunks` remain"""
+    chunks = list(chunks)
+    while len(chunks) > max_chunks:
+        i = min(range(len(chunks) - 1), key=lambda i: len(chunks[i].start) + len(chunks[i + 1].start))
+        chunks[i:i + 2] = [_concat(chunks[i:i + 2])]
+    return chunks
+
+
+# ============================================================================
+# ENGINE
+# ============================================================================
+
+class ColumnarEngine:
+    """page_sessions in column arrays, refreshed every `refresh_interval` seconds
+
+    Uses its own connection (`db_config`) since loads run for minutes on
+    large tables. Not `ready` until the first load has finished, nor while
+    refreshes keep failing (STALE_REFRESHES intervals since the last good
+    one); callers use the SQL path then.
+    """
+
+    def __init__(self, db_config, refresh_interval=60, autostart=True):
+        if np is None:
+            raise RuntimeError('ColumnarEngine requires numpy (pip install numpy)')
+        self.db_config = dict(db_config)
+        self.refresh_interval = refresh_interval
+        self.state = None
+        self.last_error = None
+        self.last_refresh_ms = None
+        self.refreshed_at = None  # time.monotonic() of the last successful refresh
+        self._tz = ZoneInfo(ROLLUP_TIMEZONE)
+        self._slots = {}  # UTC day number -> (local ordinal, hour, weekday) per slot
+        if autostart:
+            thread = threading.Thread(target=self._run, name='analytics-columnar', daemon=True)
+            thread.start()
+
+    @property
+    def ready(self):
+        if self.state is None:
+            return False
+        if self.refreshed_at is None:
+            return True  # refreshed by the caller (autostart=False)
+        stale_after = STALE_REFRESHES * self.refresh_interval + (self.last_refresh_ms or 0) / 1000.0
+        return time.monotonic() - self.refreshed_at <= stale_after
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**self.db_config)
+                    conn.autocommit = True
+                self.refresh(conn)
+                self.refreshed_at = time.monotonic()
+                self.last_error = None
+            except Exception as e:
+                # Any failure (not only database errors) must not end the
+                # thread, or the engine would serve its last state forever
+                self.last_error = str(e)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            time.sleep(self.refresh_interval)
+
+    def _wait_settled(self, conn, xmax):
+        """True once every transaction running at `xmax` has finished"""
+        deadline = time.monotonic() + SETTLE_TIMEOUT
+        cur = conn.cursor()
+        try:
+            while True:
+                cur.execute(XMIN_SQL)
+                if cur.fetchone()[0] >= xmax:
+                    return True
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.5)
+        finally:
+            cur.close()
+
+    def refresh(self, conn):
+        """Load new sessions (all of them on first use or after pruning)
+
+        `conn` must be in autocommit mode so every statement sees new commits.
+        """
+        started = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute(BOUNDS_SQL)
+        max_id, min_start, xmax = cur.fetchone()
+        cur.close()
+        max_id = max_id or 0
+
+        state = self.state
+        if state is None or (min_start is not None and min_start > state.min_start):
+            chunks, settled_upto = [], 0
+        else:
+            chunks, settled_upto = list(state.chunks), state.settled_upto
+
+        if max_id > settled_upto and self._wait_settled(conn, xmax):
+            for after_id in range(settled_upto, max_id, LOAD_BATCH_IDS):
+                chunk = load_sessions(conn, after_id, min(after_id + LOAD_BATCH_IDS, max_id))
+                if len(chunk.start):
+                    chunks = _compact(chunks + [chunk])
+            settled_upto = max_id
+        tail = load_sessions(conn, settled_upto, _MAX_ID)
+        # Books after sessions: every loaded record id has its books row
+        school_of, title_of, titles = load_books(conn)
+
+        everything = chunks + [tail]
+        self.state = State(
+            chunks=chunks,
+            tail=tail,
+            settled_upto=settled_upto,
+            min_start=min(c.min_start for c in everything if len(c.start)) if any(len(c.start) for c in everything) else 0,
+            school_of=school_of,
+            title_of=title_of,
+            titles=titles,
+            max_book=max((int(c.book.max()) for c in everything if len(c.book)), default=0),
+            max_page=max((int(c.page.max()) for c in everything if len(c.page)), default=0),
+            memo={},
+        )
+        self.last_refresh_ms = round((time.perf_counter() - started) * 1000)
+
+    def stats(self):
+        state = self.state
+        if state is None:
+            return {'ready': False, 'lastError': self.last_error}
+        everything = state.chunks + [state.tail]
+        return {
+            'ready': self.ready,
+            'rows': sum(len(c.start) for c in everything),
+            'tailRows': len(state.tail.start),
+            'chunks': len(everything),
+            'bytes': sum(sum(getattr(c, name).nbytes for name, _ in _COPY_FIELDS) for c in everything),
+            'settledUpto': state.settled_upto,
+            'lastRefreshMs': self.last_refresh_ms,
+            'lastError': self.last_error,
+        }
+
+    # ------------------------------------------------------------------
+    # Local time
+    # ------------------------------------------------------------------
+
+    def _day_slots(self, utc_day):
+        slots = self._slots.get(utc_day)
+        if slots is None:
+            ordinals, hours, weekdays = [], [], []
+            for i in range(SLOTS_PER_DAY):
+                local = datetime.fromtimestamp((utc_day * SLOTS_PER_DAY + i) * SLOT_MS / 1000.0, self._tz)
+                ordinals.append(local.toordinal())
+                hours.append(local.hour)
+                weekdays.append(local.isoweekday() % 7)  # DOW: Sunday = 0
+            slots = (np.array(ordinals, np.int64), np.array(hours, np.int64), np.array(weekdays, np.int64))
+            self._slots[utc_day] = slots
+        return slots
+
+    def _local_time(self, start, first_slot, last_slot):
+        """(local day ordinal, hour, weekday) arrays for `start` values"""
+        days = range(first_slot // SLOTS_PER_DAY, last_slot // SLOTS_PER_DAY + 1)
+        tables = [self._day_slots(day) for day in days]
+        index = start // SLOT_MS - days[0] * SLOTS_PER_DAY
+        return tuple(np.concatenate([t[i] for t in tables])[index] for i in range(3))
+
+    def _day_start_ms(self, ordinal):
+        day = date.fromordinal(ordinal)
+        midnight = datetime(day.year, day.month, day.day, tzinfo=self._tz)
+        return int(midnight.astimezone(timezone.utc).timestamp() * 1000)
+
+    # ------------------------------------------------------------------
+    # Group-by
+    # ------------------------------------------------------------------
+
+    def _window(self, state, start_time, end_time):
+        """Yield (chunk, mask) for rows with start_time <= start <= end_time"""
+        for chunk in state.chunks + [state.tail]:
+            if len(chunk.start) and chunk.max_start >= start_time and chunk.min_start <= end_time:
+                yield chunk, (chunk.start >= start_time) & (chunk.start <= end_time)
+
+    @staticmethod
+    def _aggregate(parts, space):
+        """Sum per-chunk (keys, timed, active) into (keys, sessions, timed, total)"""
+        if space <= DENSE_KEYS:
+            sessions = np.zeros(space, np.int64)
+            timed = np.zeros(space, np.int64)
+            total = np.zeros(space, np.float64)
+            for keys, timed_mask, active in parts:
+                sessions += np.bincount(keys, minlength=space)
+                timed += np.bincount(keys[timed_mask], minlength=space)
+                total += np.bincount(keys[timed_mask], weights=active[timed_mask], minlength=space)
+            present = np.nonzero(sessions)[0]
+            return present, sessions[present], timed[present], total[present]
+        keys = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, np.int64)
+        timed_mask = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, bool)
+        active = np.concatenate([p[2] for p in parts]) if parts else np.zeros(0, np.int64)
+        present, inverse = np.unique(keys, return_inverse=True)
+        return (present, np.bincount(inverse, minlength=len(present)),
+                np.bincount(inverse[timed_mask], minlength=len(present)),
+                np.bincount(inverse[timed_mask], weights=active[timed_mask], minlength=len(present)))
+
+    @staticmethod
+    def _distinct_per_group(pairs, per_group):
+        """Distinct (group * per_group + value) pairs counted per group"""
+        if not pairs:
+            return {}
+        unique = np.unique(np.concatenate(pairs))
+        groups, counts = np.unique(unique // per_group, return_counts=True)
+        return dict(zip(groups.tolist(), counts.tolist()))
+
+    # ------------------------------------------------------------------
+    # Routes
+    # ------------------------------------------------------------------
+
+    def timeline(self, start_time, end_time, school_id=None):
+        """Rows of the /timeline query, or /schools/<id>/timeline with `school_id`"""
+        state = self.state
+        first_slot, last_slot = start_time // SLOT_MS, end_time // SLOT_MS
+        first_day = self._day_slots(first_slot // SLOTS_PER_DAY)[0].min()
+        ndays = int(self._day_slots(last_slot // SLOTS_PER_DAY)[0].max() - first_day + 1)
+        books_per_day = state.max_book + 1
+        schools_per_day = len(state.school_of)
+
+        parts, book_pairs, school_pairs = [], [], []
+        for chunk, mask in self._window(state, start_time, end_time):
+            if school_id is not None:
+                mask &= state.school_of[chunk.record] == school_id
+            day, _, _ = self._local_time(chunk.start[mask], first_slot, last_slot)
+            day = day - first_day
+            parts.append((day, chunk.timed[mask], chunk.active[mask]))
+            book = chunk.book[mask].astype(np.int64)
+            school = state.school_of[chunk.record[mask]].astype(np.int64)
+            book_pairs.append((day * books_per_day + book)[book != 0])
+            school_pairs.append((day * schools_per_day + school)[school != 0])
+
+        days, sessions, timed, total = self._aggregate(parts, ndays)
+        unique_books = self._distinct_per_group(book_pairs, books_per_day)
+        unique_schools = self._distinct_per_group(school_pairs, schools_per_day)
+
+        rows = []
+        for day, day_sessions, day_timed, day_total in zip(days.tolist(), sessions.tolist(), timed.tolist(), total.tolist()):
+            ordinal = int(first_day) + day
+            row = {
+                'timestamp': self._day_start_ms(ordinal),
+                'date': date.fromordinal(ordinal).isoformat(),
+                'totalSessions': day_sessions,
+                'totalActiveTimeMs': round(day_total) if day_timed else None,
+                'uniqueBooks': unique_books.get(day, 0),
+            }
+            if school_id is None:
+                row['uniqueSchools'] = unique_schools.get(day, 0)
+            else:
+                row = {key: row[key] for key in ('date', 'timestamp', 'totalSessions', 'totalActiveTimeMs', 'uniqueBooks')}
+            rows.append(row)
+        return rows
+
+    def timeline_range(self, start_time, end_time):
+        """Distinct books and schools over a whole /timeline window"""
+        state = self.state
+        books, schools = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)]
+        for chunk, mask in self._window(state, start_time, end_time):
+            books.append(chunk.book[mask].astype(np.int64))
+            schools.append(state.school_of[chunk.record[mask]].astype(np.int64))
+        return {
+            'uniqueBooks': int(np.count_nonzero(np.unique(np.concatenate(books)))),
+            'uniqueSchools': int(np.count_nonzero(np.unique(np.concatenate(schools)))),
+        }
+
+    def reading_patterns(self, start_time, end_time):
+        """Rows of the /reading-patterns query"""
+        state = self.state
+        first_slot, last_slot = start_time // SLOT_MS, end_time // SLOT_MS
+        parts = []
+        for chunk, mask in self._window(state, start_time, end_time):
+            _, hour, weekday = self._local_time(chunk.start[mask], first_slot, last_slot)
+            parts.append((weekday * 24 + hour, chunk.timed[mask], chunk.active[mask]))
+
+        keys, sessions, timed, total = self._aggregate(parts, 7 * 24)
+        return [
+            {
+                'hour': key % 24,
+                'dayOfWeek': key // 24,
+                'totalSessions': key_sessions,
+                'avgSessionTimeMs': _round_half_up(round(key_total), key_timed) if key_timed else None,
+            }
+            for key, key_sessions, key_timed, key_total in zip(keys.tolist(), sessions.tolist(), timed.tolist(), total.tolist())
+        ]
+
+    def page_engagement(self, book_id=None):
+        """Rows of the /pages/engagement query (one book, or the top 50 pages)"""
+        state = self.state
+        memo_key = ('page_engagement', book_id)
+        if memo_key in state.memo:
+            return state.memo[memo_key]
+
+        ntitles, npages = len(state.titles), state.max_page + 1
+        parts = []
+        for chunk in state.chunks + [state.tail]:
+            mask = chunk.book == book_id if book_id is not None else slice(None)
+            key = ((chunk.book[mask].astype(np.int64) * ntitles + state.title_of[chunk.record[mask]])
+                   * npages + chunk.page[mask])
+            parts.append((key, chunk.timed[mask], chunk.active[mask]))
+
+        keys, sessions, timed, total = self._aggregate(parts, (state.max_book + 1) * ntitles * npages)
+        rows = []
+        for key, key_sessions, key_timed, key_total in zip(keys.tolist(), sessions.tolist(), timed.tolist(), total.tolist()):
+            rest, page = divmod(key, npages)
+            book, title = divmod(rest, ntitles)
+            key_total = round(key_total)
+            rows.append({
+                'bookId': book,
+                'bookTitle': state.titles[title],
+                'pageNumber': page,
+                'totalSessions': key_sessions,
+                'avgActiveTimeMs': _round_half_up(key_total, key_timed) if key_timed else None,
+                'totalActiveTimeMs': key_total if key_timed else None,
+            })
+
+        if book_id is not None:
+            rows.sort(key=lambda row: row['pageNumber'])
+        else:
+            # ORDER BY "totalActiveTimeMs" DESC: NULLs first in Postgres
+            rows.sort(key=lambda row: (row['totalActiveTimeMs'] is not None, -(row['totalActiveTimeMs'] or 0)))
+            rows = rows[:50]
+        state.memo[memo_key] = rows
+        return rows
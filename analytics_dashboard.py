@@ -0,0 +1,112 @@
+# Single-request dashboard bundle
+#
+# AnalyticsDashboard needs about eight analytics routes on first paint. The
+# bundle dispatches each of them through the normal Flask routing (so the
+# response cache, rollups etc. all apply) on a worker thread with its own
+# request context, and therefore its own pooled connection. Total latency is
+# bounded by the slowest section instead of the sum of all of them, and each
+# section's statements are cancelled by Postgres (statement_timeout) once the
+# section timeout has passed, so a timed-out section frees its connection.
+# The timeout runs from when a worker picks the section up, so sections
+# queued behind other bundles are not charged for the wait; a section that
+# waits a whole timeout for a worker is dropped without running.
+
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from analytics_db import set_request_statement_timeout
+
+# Section name -> (route, fixed query args). `range` from the bundle request
+# is forwarded to the sections that take it.
+DASHBOARD_SECTIONS = {
+    'overview': ('/api/analytics/overview', {}),
+    'schoolsStats': ('/api/analytics/schools/stats', {'limit': 100}),
+    'popularBooks': ('/api/analytics/books/popular', {'limit': 20}),
+    'timeline': ('/api/analytics/timeline', {}),
+    'booksByGrade': ('/api/analytics/books/by-grade', {}),
+    'deviceStats': ('/api/analytics/device/stats', {}),
+    'syncStatus': ('/api/analytics/sync/status', {}),
+    'syncLogs': ('/api/analytics/sync/logs', {'limit': 50}),
+    'readingPatterns': ('/api/analytics/reading-patterns', {}),
+}
+
+RANGE_SECTIONS = {'timeline'}
+
+
+def _run_section(app, path, args, timeout, start_times, name):
+    """Dispatch one route; returns (data, error, elapsed_ms, no_store)
+
+    Records its start (time.monotonic()) in `start_times[name]`; statements
+    still running `timeout` seconds later are cancelled.
+    """
+    start_times[name] = time.monotonic()
+    deadline = start_times[name] + timeout
+    started = time.perf_counter()
+    try:
+        with app.test_request_context(path, query_string=args):
+            set_request_statement_timeout(deadline - time.monotonic())
+            response = app.full_dispatch_request()
+            body = response.get_json(silent=True) or {}
+        no_store = response.headers.get('Cache-Control') == 'no-store'
+        if response.status_code == 200 and body.get('success'):
+            data, error = body['data'], None
+        else:
+            data, error = None, body.get('error') or 'HTTP %d' % response.status_code
+    except Exception as e:
+        data, error, no_store = None, str(e), False
+    return data, error, round((time.perf_counter() - started) * 1000, 1), no_store
+
+
+class DashboardBundler:
+    def __init__(self, app, max_workers=8, section_timeout=10.0):
+        self.app = app
+        self.section_timeout = section_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dashboard')
+
+    def build(self, sections=None, range_str=None):
+        """Run the requested sections concurrently
+
+        Returns (data, errors, timings, volatile). A failing or timed-out
+        section is reported in `errors` and does not affect the others;
+        `volatile` lists the sections whose routes answered no-store.
+        """
+        names = [name for name in (sections or DASHBOARD_SECTIONS) if name in DASHBOARD_SECTIONS]
+        futures, start_times = {}, {}
+        submitted = time.monotonic()
+        for name in names:
+            path, args = DASHBOARD_SECTIONS[name]
+            args = dict(args)
+            if range_str and name in RANGE_SECTIONS:
+                args['range'] = range_str
+            future = self.executor.submit(_run_section, self.app, path, args, self.section_timeout, start_times, name)
+            futures[future] = name
+
+        # Each section gets section_timeout from its own start (or from
+        # submission while it is still queued)
+        pending, expired = set(futures), set()
+        while pending:
+            now = time.monotonic()
+            deadlines = {f: start_times.get(futures[f], submitted) + self.section_timeout for f in pending}
+            late = {f for f, deadline in deadlines.items() if deadline <= now}
+            expired |= late
+            pending -= late
+            if pending:
+                done, _ = wait(pending, timeout=min(deadlines[f] for f in pending) - now,
+                               return_when=FIRST_COMPLETED)
+                pending -= done
+
+        data, errors, timings, volatile = {}, {}, {}, []
+        for future, name in futures.items():
+            if future in expired and not future.done():
+                if future.cancel():
+                    error = 'Not started within %.1fs' % self.section_timeout
+                else:
+                    error = 'Timed out after %.1fs' % self.section_timeout
+                data[name], timings[name] = None, round(self.section_timeout * 1000, 1)
+            else:
+                data[name], error, timings[name], no_store = future.result()
+                if no_store:
+                    volatile.append(name)
+            if error:
+                errors[name] = error
+        return data, errors, timings, volatile
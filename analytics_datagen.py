@@ -0,0 +1,404 @@
+# Deterministic synthetic dataset for benchmarks
+#
+#   FLASK_APP=analytics_backend_example flask datagen \
+#       --schools 5000 --books 50 --sessions 500000000 --seed 42
+#
+# The same sizes, seed and end date always produce the same rows, so
+# benchmark runs on different machines or commits are comparable. The
+# shape follows what tablets report:
+#
+#   * school activity is log-normal and book popularity Zipf-like, so a few
+#     schools and books dominate as in production
+#   * reading happens mostly on school days and school hours (WEEKDAY_WEIGHTS,
+#     HOUR_WEIGHTS) with usage growing over the window
+#   * a reading session walks consecutive pages, each page session starting
+#     when the previous one ended
+#
+# page_sessions are generated by worker processes, each owning a chunk of
+# book records with its own seeded RNG, and loaded with COPY. The rollup
+# trigger is disabled during the load; rollups, sketches and the overview
+# snapshot are rebuilt once at the end. The target database must be
+# migrated and empty.
+
+import io
+import multiprocessing
+import os
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from analytics_hll import rebuild_sketches
+from analytics_overview import refresh_overview_snapshot
+from analytics_rollups import rebuild_rollups
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Monday .. Sunday
+WEEKDAY_WEIGHTS = [1.0, 1.0, 1.0, 0.95, 0.85, 0.2, 0.1]
+
+# 00:00 .. 23:00 UTC; school hours dominate, some evening reading
+HOUR_WEIGHTS = [
+    0.1, 0.05, 0.05, 0.05, 0.1, 0.3, 0.8, 2.5, 6.0, 8.0, 8.5, 7.5,
+    5.0, 6.5, 6.0, 4.0, 2.5, 2.0, 2.5, 2.5, 1.5, 0.8, 0.4, 0.2,
+]
+
+PLATFORM_WEIGHTS = [('android', 0.82), ('ios', 0.1), ('web', 0.08)]
+
+SYNC_ERRORS = ['Connection reset', 'Timeout while uploading', 'Server returned 502', 'Payload too large']
+
+# Page sessions generated (and COPYed) per task
+CHUNK_SESSIONS = 1_000_000
+COPY_BATCH_ROWS = 100_000
+
+
+def _rng(seed, *parts):
+    return random.Random('%s:%s' % (seed, ':'.join(str(p) for p in parts)))
+
+
+def _copy(cur, table, columns, buf):
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '')" % (table, ', '.join(columns)), buf
+    )
+
+
+# ============================================================================
+# DIMENSIONS
+# ============================================================================
+
+def build_catalogue(seed, books):
+    """[(book_id, grade, title, total_pages, popularity)] for the book catalogue"""
+    rng = _rng(seed, 'catalogue')
+    ranks = list(range(1, books + 1))
+    rng.shuffle(ranks)
+    catalogue = []
+    for i in range(1, books + 1):
+        grade = 3 + (i - 1) % 8
+        catalogue.append((
+            i, grade, 'Grade %d Reader %d' % (grade, i), rng.randint(16, 48), 1.0 / ranks[i - 1] ** 0.8,
+        ))
+    return catalogue
+
+
+def build_schools(seed, schools, start_ms, end_ms):
+    """[dict] with a school row and its activity weight"""
+    rng = _rng(seed, 'schools')
+    rows = []
+    for school_id in range(1, schools + 1):
+        province = rng.randint(1, 9)
+        district = rng.randint(1, 3)
+        zone = rng.randint(1, 4)
+        active = rng.random() > 0.05
+        rows.append({
+            'id': school_id,
+            'school_name': 'School %05d' % school_id,
+            'census_no': 'C%06d' % rng.randint(0, 999999),
+            'serial_number': 'SN-%05d' % school_id,
+            'province': 'Province %d' % province,
+            'district': 'District %d-%d' % (province, district),
+            'zone': 'Zone %d-%d-%d' % (province, district, zone),
+            'installation_date': start_ms - rng.randint(0, 180) * DAY_MS,
+            'is_active': active,
+            'weight': rng.lognormvariate(0, 0.8) * (1.0 if active else 0.05),
+        })
+    return rows
+
+
+def build_book_records(seed, schools, catalogue, sessions):
+    """[(record_id, school_id, book_id, total_pages, session_count)]
+
+    Each school holds most of the catalogue; sessions are shared out in
+    proportion to school activity x book popularity.
+    """
+    rng = _rng(seed, 'books')
+    records = []
+    for school in schools:
+        for book_id, _, _, total_pages, popularity in catalogue:
+            if rng.random() < 0.85:
+                records.append([len(records) + 1, school['id'], book_id, total_pages,
+                                school['weight'] * popularity])
+    total_weight = sum(r[4] for r in records) or 1.0
+    for record in records:
+        record[4] = int(sessions * record[4] / total_weight + 0.5)
+    return [tuple(r) for r in records]
+
+
+# ============================================================================
+# PAGE SESSIONS (worker processes)
+# ============================================================================
+
+def _cum(weights):
+    total = 0.0
+    for w in weights:
+        total += w
+        yield total
+
+
+def _day_weights(start_day, days):
+    # Weekday pattern with usage growing from 60% to 100% over the window
+    return [
+        WEEKDAY_WEIGHTS[(start_day + timedelta(days=i)).weekday()] * (0.6 + 0.4 * i / max(1, days - 1))
+        for i in range(days)
+    ]
+
+
+def _generate_chunk(task):
+    """Generate and COPY the sessions of one chunk of book records"""
+    db_config, seed, start_day, days, records = task
+    start_ms = int(datetime(start_day.year, start_day.month, start_day.day, tzinfo=timezone.utc).timestamp() * 1000)
+    day_cum = list(_cum(_day_weights(start_day, days)))
+    hour_cum = list(_cum(HOUR_WEIGHTS))
+    day_index = range(days)
+    hours = range(24)
+
+    conn = psycopg2.connect(**db_config)
+    cur = conn.cursor()
+    buf, totals, rows = io.StringIO(), io.StringIO(), 0
+    for record_id, school_id, book_id, total_pages, count in records:
+        rng = _rng(seed, 'sessions', record_id)
+        seen = set()
+        pages = set()
+        total_active = emitted = 0
+        first = last = None
+        while emitted < count:
+            day = rng.choices(day_index, cum_weights=day_cum)[0]
+            hour = rng.choices(hours, cum_weights=hour_cum)[0]
+            t = start_ms + day * DAY_MS + hour * 3600000 + rng.randrange(3600000)
+            page = rng.randint(1, total_pages)
+            for _ in range(min(count - emitted, rng.randint(1, 12))):
+                while (page, t) in seen:
+                    t += 1
+                seen.add((page, t))
+                active = None if rng.random() < 0.01 else int(rng.lognormvariate(10.0, 0.7))
+                buf.write('%d,%d,%d,%d,%s\n' % (record_id, book_id, page, t, '' if active is None else active))
+                pages.add(page)
+                total_active += active or 0
+                first = t if first is None or t < first else first
+                last = t if last is None or t > last else last
+                emitted += 1
+                rows += 1
+                t += (active or 30000) + rng.randint(200, 5000)
+                page = page + 1 if page < total_pages else 1
+            if rows >= COPY_BATCH_ROWS:
+                _copy(cur, 'page_sessions', ('book_record_id', 'book_id', 'page_number',
+                                              'session_start_time', 'active_time_ms'), buf)
+                buf, rows = io.StringIO(), 0
+        if count:
+            totals.write('%d,%d,%d,"{%s}",%d,%d\n' % (
+                record_id, count, total_active, ','.join(map(str, sorted(pages))), first, last))
+    if rows:
+        _copy(cur, 'page_sessions', ('book_record_id', 'book_id', 'page_number',
+                                      'session_start_time', 'active_time_ms'), buf)
+    _copy(cur, 'datagen_book_totals', ('book_record_id', 'sessions', 'total_active_time_ms',
+                                        'pages', 'first_access', 'last_access'), totals)
+    conn.commit()
+    conn.close()
+    return sum(r[4] for r in records)
+
+
+def _chunks(records, size=CHUNK_SESSIONS):
+    chunk, sessions = [], 0
+    for record in records:
+        chunk.append(record)
+        sessions += record[4]
+        if sessions >= size:
+            yield chunk
+            chunk, sessions = [], 0
+    if chunk:
+        yield chunk
+
+
+# ============================================================================
+# SYNC LOGS / DEVICES
+# ============================================================================
+
+def _sync_rows(seed, schools, sessions_by_school, start_ms, end_ms):
+    """sync_logs CSV and {school_id: last successful sync} for every school"""
+    buf = io.StringIO()
+    last_sync = {}
+    for school in schools:
+        rng = _rng(seed, 'syncs', school['id'])
+        interval_days = 1.0 + rng.random() * 3.0 if school['is_active'] else 20.0
+        stops_at = end_ms if school['is_active'] else start_ms + int(rng.random() * (end_ms - start_ms))
+        syncs = []
+        t = start_ms + int(rng.expovariate(1.0 / interval_days) * DAY_MS)
+        while t < stops_at:
+            syncs.append(t)
+            t += int(rng.expovariate(1.0 / interval_days) * DAY_MS) + 60000
+        per_sync = sessions_by_school.get(school['id'], 0) // max(1, len(syncs))
+        for ts in syncs:
+            ok = rng.random() > 0.04
+            created = datetime.fromtimestamp(ts / 1000.0, timezone.utc).isoformat()
+            duration = int(rng.lognormvariate(8.0, 0.9))
+            # ~30 bytes per gzipped session
+            size = int((per_sync * 30 + 2048) * rng.uniform(0.8, 1.2)) if ok else int(rng.random() * 65536)
+            buf.write('%d,%d,%d,%s,%s,%s,%d,%d,%d,%d\n' % (
+                school['id'], ts, per_sync if ok else 0, 't' if ok else 'f',
+                '' if ok else '"%s"' % rng.choice(SYNC_ERRORS), created,
+                duration, ts - duration, ts, size,
+            ))
+            if ok:
+                last_sync[school['id']] = ts
+    return buf, last_sync
+
+
+def _device_rows(seed, schools, last_sync):
+    rng = _rng(seed, 'devices')
+    platforms = [p for p, _ in PLATFORM_WEIGHTS]
+    weights = [w for _, w in PLATFORM_WEIGHTS]
+    rows = []
+    for school in schools:
+        for n in range(rng.randint(1, 3)):
+            rows.append((
+                school['id'], 'tablet-%d-%d' % (school['id'], n + 1), rng.choices(platforms, weights)[0],
+                '2.%d.%d' % (rng.randint(0, 6), rng.randint(0, 9)), last_sync.get(school['id']),
+            ))
+    return rows
+
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def generate_dataset(db_config, schools=5000, books=50, sessions=500_000_000, days=400, seed=42,
+                     end_date=None, workers=None, log=print):
+    """Load a synthetic dataset into an empty, migrated database
+
+    Sessions cover the `days` days before `end_date` (default: today, UTC).
+    Returns a dict of row counts.
+    """
+    end_day = end_date or datetime.now(timezone.utc).date()
+    start_day = end_day - timedelta(days=days)
+    start_ms = int(datetime(start_day.year, start_day.month, start_day.day, tzinfo=timezone.utc).timestamp() * 1000)
+    end_ms = start_ms + days * DAY_MS
+    workers = workers or os.cpu_count() or 1
+
+    conn = psycopg2.connect(cursor_factory=RealDictCursor, **db_config)
+    cur = conn.cursor()
+    cur.execute("SELECT EXISTS (SELECT 1 FROM schools) OR EXISTS (SELECT 1 FROM page_sessions) AS used;")
+    if cur.fetchone()['used']:
+        conn.close()
+        raise RuntimeError('Target database already has data; datagen needs an empty, migrated schema')
+
+    catalogue = build_catalogue(seed, books)
+    school_rows = build_schools(seed, schools, start_ms, end_ms)
+    records = build_book_records(seed, school_rows, catalogue, sessions)
+    log('Generating %d schools, %d book records, ~%d sessions (%s .. %s)' % (
+        len(school_rows), len(records), sum(r[4] for r in records), start_day, end_day))
+
+    # Dimensions with explicit ids so they are identical on every run
+    execute_values(cur, """
+        INSERT INTO schools (id, school_name, census_no, serial_number, province, district, zone,
+                             installation_date, is_active)
+        VALUES %s
+    """, [(s['id'], s['school_name'], s['census_no'], s['serial_number'], s['province'], s['district'],
+           s['zone'], s['installation_date'], s['is_active']) for s in school_rows], page_size=5000)
+    titles = {book_id: (title, total_pages) for book_id, _, title, total_pages, _ in catalogue}
+    execute_values(cur, """
+        INSERT INTO books (id, school_id, book_id, book_title, total_pages)
+        VALUES %s
+    """, [(r[0], r[1], r[2], titles[r[2]][0], r[3]) for r in records], page_size=5000)
+    cur.execute("SELECT setval(pg_get_serial_sequence('schools', 'id'), %s);", (max(schools, 1),))
+    cur.execute("SELECT setval(pg_get_serial_sequence('books', 'id'), %s);", (max(len(records), 1),))
+
+    # Monthly partitions for the whole window, so nothing lands in DEFAULT
+    month = date(start_day.year, start_day.month, 1)
+    while month <= end_day:
+        cur.execute("SELECT analytics_create_page_sessions_partition(%s);", (month,))
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS datagen_book_totals (
+            book_record_id integer PRIMARY KEY,
+            sessions bigint,
+            total_active_time_ms bigint,
+            pages integer[],
+            first_access bigint,
+            last_access bigint
+        );
+    """)
+    cur.execute("ALTER TABLE page_sessions DISABLE TRIGGER trg_page_sessions_rollup;")
+    conn.commit()
+
+    try:
+        tasks = [(db_config, seed, start_day, days, chunk) for chunk in _chunks(records)]
+        loaded = 0
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            for n, count in enumerate(pool.imap_unordered(_generate_chunk, tasks), 1):
+                loaded += count
+                log('  chunk %d/%d loaded (%d sessions)' % (n, len(tasks), loaded))
+    finally:
+        cur.execute("ALTER TABLE page_sessions ENABLE TRIGGER trg_page_sessions_rollup;")
+        conn.commit()
+
+    # Book and school totals consistent with the generated sessions
+    cur.execute("""
+        UPDATE books b SET
+            total_active_time_ms = t.total_active_time_ms,
+            pages_bitmap = analytics_pages_varbit(t.pages),
+            access_count = cardinality(t.pages),
+            first_access_time = t.first_access,
+            last_access_time = t.last_access
+        FROM datagen_book_totals t
+        WHERE t.book_record_id = b.id;
+    """)
+    cur.execute("""
+        SELECT b.school_id, SUM(t.sessions) AS sessions
+        FROM datagen_book_totals t
+        JOIN books b ON b.id = t.book_record_id
+        GROUP BY b.school_id;
+    """)
+    sessions_by_school = {row['school_id']: int(row['sessions']) for row in cur.fetchall()}
+
+    sync_buf, last_sync = _sync_rows(seed, school_rows, sessions_by_school, start_ms, end_ms)
+    _copy(cur, 'sync_logs', ('school_id', 'sync_timestamp', 'records_processed', 'success',
+                             'error_message', 'created_at', 'duration_ms', 'started_at', 'finished_at',
+                             'bytes_received'), sync_buf)
+    execute_values(cur, """
+        INSERT INTO device_info (school_id, device_id, platform, app_version, last_seen_at) VALUES %s
+    """, _device_rows(seed, school_rows, last_sync), page_size=5000)
+
+    cur.execute("""
+        UPDATE schools s SET
+            total_reading_time_ms = agg.total_reading_time_ms,
+            total_books_accessed = agg.total_books_accessed,
+            total_records = agg.total_records,
+            last_sync_time = l.last_sync_time
+        FROM (
+            SELECT
+                sc.id AS school_id,
+                COALESCE(SUM(b.total_active_time_ms), 0) AS total_reading_time_ms,
+                COUNT(b.id) AS total_books_accessed,
+                COALESCE(SUM(t.sessions), 0) AS total_records
+            FROM schools sc
+            LEFT JOIN books b ON b.school_id = sc.id
+            LEFT JOIN datagen_book_totals t ON t.book_record_id = b.id
+            GROUP BY sc.id
+        ) agg
+        LEFT JOIN (SELECT * FROM unnest(%s::integer[], %s::bigint[]) AS u (school_id, last_sync_time)) l
+            ON l.school_id = agg.school_id
+        WHERE s.id = agg.school_id;
+    """, (list(last_sync), list(last_sync.values())))
+    cur.execute("DROP TABLE datagen_book_totals;")
+    conn.commit()
+
+    log('Rebuilding rollups, sketches and overview snapshot')
+    rebuild_rollups(conn)
+    rebuild_sketches(conn)
+    refresh_overview_snapshot(conn)
+
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE;")
+    cur.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM schools) AS schools,
+            (SELECT COUNT(*) FROM books) AS books,
+            (SELECT COUNT(*) FROM page_sessions) AS page_sessions,
+            (SELECT COUNT(*) FROM sync_logs) AS sync_logs,
+            (SELECT COUNT(*) FROM device_info) AS device_info;
+    """)
+    counts = dict(cur.fetchone())
+    conn.close()
+    return counts
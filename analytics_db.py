@@ -0,0 +1,484 @@
+# Database connection pooling for the analytics backend
+# Replaces the psycopg2.connect() per request pattern with a shared pool
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from flask import g
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out in time"""
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool
+
+    Keeps between `minconn` and `maxconn` open connections. Checkouts wait up
+    to `checkout_timeout` seconds for a free connection, and connections that
+    sat idle longer than `health_check_interval` seconds are pinged before
+    being handed out. With `timezone`, every connection opens with that
+    session TimeZone.
+    """
+
+    def __init__(self, db_config, minconn=2, maxconn=20, checkout_timeout=5.0,
+                 health_check_interval=30.0, cursor_factory=RealDictCursor, timezone=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('Invalid pool size: min=%s max=%s' % (minconn, maxconn))
+        self.db_config = dict(db_config)
+        if timezone:
+            options = '%s -c TimeZone=%s' % (self.db_config.get('options', ''), timezone)
+            self.db_config['options'] = options.strip()
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.cursor_factory = cursor_factory
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at)
+        self._in_use = set()
+        self._pending = 0  # connections being opened outside the lock
+        self._closed = False
+
+        # Counters for pool stats
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._total_wait_s = 0.0
+        self._max_wait_s = 0.0
+        self._discarded = 0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(**self.db_config, cursor_factory=self.cursor_factory)
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._in_use) + self._pending
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to `timeout` seconds"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout('Connection pool is closed')
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._in_use.add(conn)
+                    break
+                if self.size < self.maxconn:
+                    # Reserve the slot before connecting outside the lock
+                    conn, returned_at = None, None
+                    self._pending += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        'Timed out after %.1fs waiting for a database connection' % timeout
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+        if conn is not None and not self._is_healthy(conn, time.monotonic() - returned_at):
+            with self._cond:
+                self._in_use.discard(conn)
+                self._discard(conn)
+                self._pending += 1
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._pending -= 1
+                self._in_use.add(conn)
+
+        wait_s = time.monotonic() - started
+        with self._cond:
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._total_wait_s += wait_s
+            self._max_wait_s = max(self._max_wait_s, wait_s)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool, resetting any open transaction"""
+        if not close and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed or self._closed or self.size >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that always returns the connection to the pool"""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except psycopg2.InterfaceError:
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'inUse': len(self._in_use),
+                'idle': len(self._idle),
+                'size': self.size,
+                'minSize': self.minconn,
+                'maxSize': self.maxconn,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'avgWaitMs': round(self._total_wait_s / self._checkouts * 1000, 2) if self._checkouts else 0,
+                'maxWaitMs': round(self._max_wait_s * 1000, 2),
+            }
+
+
+# ============================================================================
+# READ REPLICAS
+# ============================================================================
+#
+# Read-only analytics routes can run on streaming replicas so dashboard
+# queries do not compete with sync ingest on the primary. A daemon thread
+# checks every replica's health and replay lag; checkouts go round-robin over
+# the replicas that are up and no more than `max_lag_seconds` behind, and
+# fall back to the primary when none is. Writes always use the primary pool.
+#
+# After a sync commits, note_write() records the primary's WAL position, and
+# a replica is only used again once it has replayed past it. Otherwise a
+# response built on a replica that has not seen the sync yet could be
+# cached (or ETag-tagged) as current.
+#
+# To try it locally, start a standby of the local server on port 5433:
+#   pg_basebackup -h localhost -U postgres -D standby -R
+#   pg_ctl -D standby -o '-p 5433' start
+
+REPLICA_STATUS_SQL = """
+    SELECT
+        pg_is_in_recovery() AS in_recovery,
+        pg_last_wal_replay_lsn()::text AS replay_lsn,
+        CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END AS lag_seconds;
+"""
+
+# A busy replica is skipped rather than waited for
+REPLICA_CHECKOUT_TIMEOUT = 0.5
+
+
+def parse_lsn(text):
+    """pg_lsn text ('16/B374D848') as an integer, 0 for None"""
+    if not text:
+        return 0
+    hi, lo = text.split('/')
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = False
+        self.lag_seconds = None
+        self.replay_lsn = 0
+        self.last_error = None
+        self.checked_at = None
+        self.checkouts = 0
+
+
+class ReplicaRouter:
+    """Routes read-only checkouts to replicas, falling back to the primary"""
+
+    def __init__(self, primary, replica_configs, max_lag_seconds=10.0, check_interval=5.0,
+                 autostart=True, **pool_options):
+        self.primary = primary
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        # Replicas may be down at startup, so they connect lazily
+        pool_options['minconn'] = 0
+        self.replicas = [
+            Replica('%s:%s' % (config.get('host', 'localhost'), config.get('port', 5432)),
+                    ConnectionPool(config, **pool_options))
+            for config in replica_configs
+        ]
+        self._lock = threading.Lock()
+        self._next = 0
+        self._min_lsn = 0
+        self._primary_fallbacks = 0
+        if autostart:
+            threading.Thread(target=self._run, name='analytics-replica-checks', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def check(self):
+        """Refresh health, lag and replay position of every replica"""
+        for replica in self.replicas:
+            try:
+                with replica.pool.connection(timeout=self.check_interval) as conn:
+                    cur = conn.cursor(cursor_factory=RealDictCursor)
+                    cur.execute(REPLICA_STATUS_SQL)
+                    row = cur.fetchone()
+                    cur.close()
+                if not row['in_recovery']:
+                    raise psycopg2.OperationalError('not a standby (pg_is_in_recovery() is false)')
+                replica.replay_lsn = parse_lsn(row['replay_lsn'])
+                replica.lag_seconds = float(row['lag_seconds']) if row['lag_seconds'] is not None else None
+                replica.healthy, replica.last_error = True, None
+            except (psycopg2.Error, PoolTimeout) as e:
+                replica.healthy, replica.last_error = False, str(e).strip()
+            replica.checked_at = time.time()
+
+    def note_write(self):
+        """Keep reads off replicas until they have replayed the primary's current WAL position"""
+        try:
+            with self.primary.connection() as conn:
+                cur = conn.cursor(cursor_factory=extensions.cursor)
+                cur.execute("SELECT pg_current_wal_lsn()::text;")
+                lsn = parse_lsn(cur.fetchone()[0])
+                cur.close()
+        except (psycopg2.Error, PoolTimeout):
+            # Position unknown: require every replica to catch up with the next check
+            lsn = max((r.replay_lsn for r in self.replicas), default=0) + 1
+        with self._lock:
+            self._min_lsn = max(self._min_lsn, lsn)
+
+    def _usable(self, replica):
+        return (replica.healthy and replica.lag_seconds is not None
+                and replica.lag_seconds <= self.max_lag_seconds)
+
+    def _caught_up(self, replica, conn):
+        """Whether `replica` has replayed past the last noted write, re-checking on `conn`"""
+        if replica.replay_lsn >= self._min_lsn:
+            return True
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        cur.execute("SELECT pg_last_wal_replay_lsn()::text;")
+        replica.replay_lsn = max(replica.replay_lsn, parse_lsn(cur.fetchone()[0]))
+        cur.close()
+        conn.rollback()
+        return replica.replay_lsn >= self._min_lsn
+
+    def getconn(self):
+        """(replica, connection) for a read-only request, or None to use the primary"""
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(1, len(self.replicas))
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if not self._usable(replica):
+                continue
+            try:
+                conn = replica.pool.getconn(timeout=REPLICA_CHECKOUT_TIMEOUT)
+            except PoolTimeout:
+                continue
+            except psycopg2.Error as e:
+                self.mark_failed(replica, e)
+                continue
+            try:
+                caught_up = self._caught_up(replica, conn)
+            except psycopg2.Error as e:
+                replica.pool.putconn(conn, close=True)
+                self.mark_failed(replica, e)
+                continue
+            if not caught_up:
+                replica.pool.putconn(conn)
+                continue
+            replica.checkouts += 1
+            return replica, conn
+        with self._lock:
+            self._primary_fallbacks += 1
+        return None
+
+    def mark_failed(self, replica, error):
+        """Take `replica` out of rotation until the next successful check"""
+        replica.healthy, replica.last_error = False, str(error).strip()
+
+    def stats(self):
+        return {
+            'maxLagSeconds': self.max_lag_seconds,
+            'primaryFallbacks': self._primary_fallbacks,
+            'replicas': [{
+                'name': r.name,
+                'healthy': r.healthy,
+                'usable': self._usable(r),
+                'lagSeconds': round(r.lag_seconds, 3) if r.lag_seconds is not None else None,
+                'checkouts': r.checkouts,
+                'lastError': r.last_error,
+                'checkedAt': int(r.checked_at * 1000) if r.checked_at else None,
+                'pool': r.pool.stats(),
+            } for r in self.replicas],
+        }
+
+
+# ============================================================================
+# FLASK INTEGRATION
+# ============================================================================
+
+def init_pool(app, db_config, **pool_options):
+    """Create the pool and attach it to the Flask app lifecycle
+
+    Each request checks out at most one connection (lazily, on first use) and
+    the teardown handler returns it, including when the route raised.
+    """
+    pool = ConnectionPool(db_config, **pool_options)
+    app.extensions['db_pool'] = pool
+
+    @app.teardown_appcontext
+    def return_db_connection(exc):
+        conn = g.pop('db_conn', None)
+        if conn is not None:
+            close = isinstance(exc, psycopg2.InterfaceError) or _reset_statement_timeout(conn)
+            get_pool(app).putconn(conn, close=close)
+
+    return pool
+
+
+def get_pool(app):
+    return app.extensions['db_pool']
+
+
+def get_request_connection(app):
+    """Connection bound to the current request, checked out on first use"""
+    if 'db_conn' not in g:
+        g.db_conn = get_pool(app).getconn()
+        _apply_statement_timeout(g.db_conn)
+    return g.db_conn
+
+
+def set_request_statement_timeout(seconds):
+    """Cancel any statement of the current request running past `seconds` from now
+
+    Call before the request's first query. Applied to its connections as
+    they are checked out and reset before they go back to the pool.
+    """
+    g.statement_deadline = time.monotonic() + seconds
+
+
+def _apply_statement_timeout(conn):
+    deadline = g.get('statement_deadline')
+    if deadline is not None:
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s;", (max(1, int((deadline - time.monotonic()) * 1000)),))
+        cur.close()
+        # Committed, so a rollback inside the route does not undo it
+        conn.commit()
+
+
+def _reset_statement_timeout(conn):
+    """Undo _apply_statement_timeout; True if the connection should be discarded"""
+    if g.get('statement_deadline') is None or conn.closed:
+        return False
+    try:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute("RESET statement_timeout;")
+        cur.close()
+        conn.commit()
+        return False
+    except psycopg2.Error:
+        return True
+
+
+def init_replicas(app, replica_configs, max_lag_seconds=10.0, check_interval=5.0, **pool_options):
+    """Route get_read_connection() to `replica_configs`; call after init_pool"""
+    router = ReplicaRouter(get_pool(app), replica_configs, max_lag_seconds, check_interval, **pool_options)
+    app.extensions['db_replicas'] = router
+
+    @app.teardown_appcontext
+    def return_read_connection(exc):
+        routed = g.pop('db_read_replica', None)
+        if routed is not None:
+            replica, conn = routed
+            close = isinstance(exc, psycopg2.InterfaceError) or _reset_statement_timeout(conn)
+            replica.pool.putconn(conn, close=close)
+            if isinstance(exc, psycopg2.OperationalError):
+                router.mark_failed(replica, exc)
+
+    return router
+
+
+def get_read_connection(app):
+    """Connection for read-only queries of the current request
+
+    A replica connection when replicas are configured and one is usable,
+    otherwise the request's primary connection. Never use it for writes.
+    """
+    router = app.extensions.get('db_replicas')
+    if router is None:
+        return get_request_connection(app)
+    if 'db_read_replica' not in g:
+        g.db_read_replica = router.getconn()
+        if g.db_read_replica is not None:
+            _apply_statement_timeout(g.db_read_replica[1])
+    if g.db_read_replica is None:
+        return get_request_connection(app)
+    return g.db_read_replica[1]
@@ -0,0 +1,52 @@
+# Conditional GET for the analytics endpoints
+#
+# Analytics data only changes when a school syncs, and every sync (failed
+# ones included) inserts a sync_logs row; figures precomputed by background
+# jobs (analytics_jobs) change when a job stores a new result. The ETag of a
+# response is a hash of the newest sync_logs id and job run id, the request
+# path and its normalized query args, so a client that sends If-None-Match
+# gets a 304 after two index lookups, without running the route's queries
+# or building the JSON body.
+#
+# Windowed figures (active schools in the last 7 days, relative time
+# ranges, the periodically refreshed overview snapshot) drift without any
+# sync, so the tag also rolls over every `time_bucket` seconds.
+#
+# Used by analytics_cache.conditional (Flask) and analytics_asgi.endpoint.
+
+import hashlib
+import time
+
+SYNC_WATERMARK_SQL = """
+    SELECT concat_ws(':',
+        (SELECT COALESCE(MAX(id), 0) FROM sync_logs),
+        (SELECT COALESCE(MAX(run_id), 0) FROM analytics_job_results)
+    ) AS watermark;
+"""
+
+# Responses may be stored but must be revalidated before every use
+CACHE_CONTROL = 'no-cache'
+
+
+def make_etag(watermark, path, args, time_bucket=3600):
+    """Weak ETag for `path` + `args` ((key, value) pairs) at `watermark`"""
+    normalized = '&'.join('%s=%s' % (k, v) for k, v in sorted(args))
+    bucket = int(time.time() // time_bucket) if time_bucket else 0
+    raw = '%s|%s|%s?%s' % (watermark, bucket, path, normalized)
+    return 'W/"%s"' % hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against `etag`"""
+    if not if_none_match:
+        return False
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
@@ -0,0 +1,150 @@
+# Streaming CSV / NDJSON exports
+#
+# Rows are read through a server-side (named) cursor in fixed-size batches
+# and written straight into the response, so memory stays flat regardless of
+# how many rows the export covers.
+
+import csv
+import io
+import json
+import uuid
+from decimal import Decimal
+
+from psycopg2 import extensions
+
+EXPORT_BATCH_SIZE = 5000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+def stream_rows(conn, query, params, fmt='csv', batch_size=EXPORT_BATCH_SIZE):
+    """Yield `query` results as CSV or NDJSON text chunks, one per batch"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Unsupported export format %r' % fmt)
+
+    # Tuple rows are cheaper than RealDictRow for bulk output
+    cur = conn.cursor(name='export_%s' % uuid.uuid4().hex, cursor_factory=extensions.cursor)
+    cur.itersize = batch_size
+    try:
+        cur.execute(query, params)
+        rows = cur.fetchmany(batch_size)
+        columns = [col.name for col in cur.description]
+
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(columns)
+            while True:
+                writer.writerows(rows)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+                if len(rows) < batch_size:
+                    break
+                rows = cur.fetchmany(batch_size)
+        else:
+            while True:
+                if rows:
+                    yield ''.join(
+                        json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+                        for row in rows
+                    )
+                if len(rows) < batch_size:
+                    break
+                rows = cur.fetchmany(batch_size)
+    finally:
+        cur.close()
+        # Named cursors live inside a transaction; end it so the pooled
+        # connection goes back clean
+        conn.rollback()
+
+
+# ============================================================================
+# EXPORT QUERIES
+# ============================================================================
+
+def page_sessions_query(start_time, end_time, school_id=None, book_id=None):
+    """Raw page sessions with school and book context, oldest first"""
+    conditions = ['ps.session_start_time >= %(start)s', 'ps.session_start_time <= %(end)s']
+    params = {'start': start_time, 'end': end_time}
+    if school_id is not None:
+        conditions.append('b.school_id = %(school_id)s')
+        params['school_id'] = school_id
+    if book_id is not None:
+        conditions.append('ps.book_id = %(book_id)s')
+        params['book_id'] = book_id
+
+    query = """
+        SELECT
+            ps.id,
+            b.school_id AS "schoolId",
+            s.school_name AS "schoolName",
+            ps.book_id AS "bookId",
+            b.book_title AS "bookTitle",
+            ps.page_number AS "pageNumber",
+            ps.session_start_time AS "sessionStartTime",
+            ps.active_time_ms AS "activeTimeMs"
+        FROM page_sessions ps
+        JOIN books b ON ps.book_record_id = b.id
+        LEFT JOIN schools s ON b.school_id = s.id
+        WHERE {conditions}
+        ORDER BY ps.session_start_time, ps.id;
+    """.format(conditions='\n            AND '.join(conditions))
+    return query, params
+
+
+def school_stats_query(start_time, end_time, school_id=None, book_id=None):
+    """Per-school totals plus activity within the requested window"""
+    session_conditions = ['ps.session_start_time >= %(start)s', 'ps.session_start_time <= %(end)s']
+    school_conditions = ['TRUE']
+    params = {'start': start_time, 'end': end_time}
+    if school_id is not None:
+        school_conditions.append('s.id = %(school_id)s')
+        params['school_id'] = school_id
+    if book_id is not None:
+        session_conditions.append('ps.book_id = %(book_id)s')
+        params['book_id'] = book_id
+
+    query = """
+        SELECT
+            s.id,
+            s.school_name AS "schoolName",
+            s.serial_number AS "serialNumber",
+            s.total_reading_time_ms AS "totalReadingTimeMs",
+            ROUND((s.total_reading_time_ms / (1000.0 * 60 * 60))::numeric, 2) AS "totalReadingTimeHours",
+            s.total_books_accessed AS "totalBooksAccessed",
+            s.total_records AS "totalRecords",
+            s.last_sync_time AS "lastSyncTime",
+            s.is_active AS "isActive",
+            COALESCE(w.sessions, 0) AS "rangeSessions",
+            COALESCE(w.active_time_ms, 0) AS "rangeActiveTimeMs"
+        FROM schools s
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*) AS sessions, SUM(ps.active_time_ms) AS active_time_ms
+            FROM books b
+            JOIN page_sessions ps ON ps.book_record_id = b.id
+            WHERE b.school_id = s.id
+                AND {session_conditions}
+        ) w ON TRUE
+        WHERE {school_conditions}
+        ORDER BY s.id;
+    """.format(
+        session_conditions='\n                AND '.join(session_conditions),
+        school_conditions=' AND '.join(school_conditions),
+    )
+    return query, params
+
+
+EXPORTS = {
+    'page-sessions': page_sessions_query,
+    'schools': school_stats_query,
+}
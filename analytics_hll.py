@@ -0,0 +1,277 @@
+# HyperLogLog sketches for approximate distinct counts
+#
+#   analytics_daily_sketch  one row per day: distinct books and schools read
+#   analytics_book_sketch   one row per book_id: distinct schools holding it
+#
+# The timeline's uniqueBooks / uniqueSchools per day and popular books'
+# uniqueSchools are read from these sketches instead of COUNT(DISTINCT ...)
+# over the rollups / books; `exact=true` on those routes keeps the SQL
+# counts. Sketches are mergeable (register-wise max), so a distinct count
+# over any range of days is the count of the merged day sketches: the
+# timeline's "range" figure (books / schools over the whole window) is the
+# merged sketches plus the IDs of the edge days (range_counts).
+#
+# Error bound: with PRECISION = 12 (4096 registers) the relative standard
+# error is 1.04 / sqrt(4096) ~= 1.6%, so 99.7% of estimates are within
+# +/-4.9% (3 sigma). Below 2.5 * 4096 distinct values the linear counting
+# estimator is used, which is exact or nearly so for tens of values (books
+# per day) and around 1% at a few thousand (schools). `python
+# analytics_bench.py hll-accuracy` checks the bound against exact counts on
+# generated data.
+#
+# Sketches are updated by every sync, in its transaction
+# (add_sync_to_sketches), so they never miss a committed upload; they can be
+# regenerated from the rollups with `flask sketches rebuild`.
+
+import hashlib
+import math
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from psycopg2.extras import execute_values
+
+from analytics_rollups import ROLLUP_TIMEZONE
+
+PRECISION = 12
+
+# Applied by analytics_migrations (executed without params, so % is literal)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_daily_sketch (
+        day date PRIMARY KEY,
+        books_hll bytea NOT NULL,
+        schools_hll bytea NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS analytics_book_sketch (
+        book_id integer PRIMARY KEY,
+        schools_hll bytea NOT NULL
+    );
+"""
+
+
+# ============================================================================
+# SKETCH
+# ============================================================================
+
+_INV_POW2 = [2.0 ** -r for r in range(65)]
+
+
+class HyperLogLog:
+    """HyperLogLog over 64-bit blake2b hashes with one byte per register"""
+
+    def __init__(self, precision=PRECISION, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        """Union in place; both sketches must have the same precision"""
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of precision %d and %d' % (self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(_INV_POW2.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting for small cardinalities
+            return round(m * math.log(m / zeros))
+        return round(estimate)
+
+    def to_bytes(self):
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], zlib.decompress(data[1:]))
+
+
+def merged_count(blobs, values=()):
+    """Distinct count of the union of serialized sketches and `values`"""
+    merged = HyperLogLog()
+    for blob in blobs:
+        merged.merge(HyperLogLog.from_bytes(blob))
+    return merged.update(values).count()
+
+
+# ============================================================================
+# MAINTENANCE
+# ============================================================================
+
+def _merge_into(cur, table, key, columns, additions):
+    """Merge `additions` {key: {column: set(values)}} into `table`
+
+    Missing rows are created empty first, then every affected row is locked
+    in key order, merged in Python and written back, so concurrent syncs
+    never overwrite each other's registers.
+    """
+    if not additions:
+        return
+    keys = sorted(additions)
+    empty = HyperLogLog().to_bytes()
+    execute_values(cur,
+        "INSERT INTO {table} ({key}, {cols}) VALUES %s ON CONFLICT ({key}) DO NOTHING".format(
+            table=table, key=key, cols=', '.join(columns)),
+        [(k,) + (empty,) * len(columns) for k in keys])
+    cur.execute(
+        "SELECT {key} AS key, {cols} FROM {table} WHERE {key} = ANY(%s) ORDER BY {key} FOR UPDATE".format(
+            table=table, key=key, cols=', '.join(columns)),
+        (keys,))
+    rows = []
+    for row in cur.fetchall():
+        values = [row['key']]
+        for column in columns:
+            sketch = HyperLogLog.from_bytes(row[column]).update(additions[row['key']].get(column, ()))
+            values.append(sketch.to_bytes())
+        rows.append(tuple(values))
+    execute_values(cur,
+        "UPDATE {table} t SET {sets} FROM (VALUES %s) AS v ({key}, {cols}) WHERE t.{key} = v.{key}".format(
+            table=table, key=key, cols=', '.join(columns),
+            sets=', '.join('%s = v.%s' % (c, c) for c in columns)),
+        rows)
+
+
+def add_sync_to_sketches(conn, school_id, sessions):
+    """Add one sync upload to the day and book sketches
+
+    Call inside the ingest transaction, after ingest_sync and before
+    record_sync_log commits, so the sketches commit (or roll back) with the
+    upload. Sessions for books the school has no record of were not
+    ingested and are ignored.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT book_id FROM books WHERE school_id = %s;", (school_id,))
+    known_books = {row['book_id'] for row in cur.fetchall()}
+
+    tz = ZoneInfo(ROLLUP_TIMEZONE)
+    days = defaultdict(lambda: {'books_hll': set(), 'schools_hll': {school_id}})
+    for s in sessions:
+        book_id = int(s['bookId'])
+        if book_id in known_books:
+            day = datetime.fromtimestamp(int(s['sessionStartTime']) / 1000.0, tz).date()
+            days[day]['books_hll'].add(book_id)
+
+    _merge_into(cur, 'analytics_daily_sketch', 'day', ('books_hll', 'schools_hll'), days)
+    _merge_into(cur, 'analytics_book_sketch', 'book_id', ('schools_hll',),
+                {book_id: {'schools_hll': {school_id}} for book_id in known_books})
+    cur.close()
+
+
+def rebuild_sketches(conn):
+    """Regenerate every sketch from the daily rollups and books
+
+    The rollups keep days whose raw partitions were pruned, so those days
+    keep their sketches too.
+    """
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE analytics_daily_sketch, analytics_book_sketch IN EXCLUSIVE MODE;")
+    cur.execute("TRUNCATE analytics_daily_sketch, analytics_book_sketch;")
+
+    cur.execute("""
+        SELECT
+            day,
+            ARRAY_AGG(DISTINCT book_id) FILTER (WHERE book_id <> 0) AS book_ids,
+            ARRAY_AGG(DISTINCT school_id) FILTER (WHERE school_id <> 0) AS school_ids
+        FROM analytics_daily_rollup
+        GROUP BY day;
+    """)
+    daily = [
+        (row['day'],
+         HyperLogLog().update(row['book_ids'] or ()).to_bytes(),
+         HyperLogLog().update(row['school_ids'] or ()).to_bytes())
+        for row in cur.fetchall()
+    ]
+    execute_values(cur, "INSERT INTO analytics_daily_sketch (day, books_hll, schools_hll) VALUES %s", daily)
+
+    cur.execute("SELECT book_id, ARRAY_AGG(DISTINCT school_id) AS school_ids FROM books GROUP BY book_id;")
+    books = [(row['book_id'], HyperLogLog().update(row['school_ids']).to_bytes()) for row in cur.fetchall()]
+    execute_values(cur, "INSERT INTO analytics_book_sketch (book_id, schools_hll) VALUES %s", books)
+
+    conn.commit()
+    cur.close()
+    return {'days': len(daily), 'books': len(books)}
+
+
+# ============================================================================
+# QUERY PATH
+# ============================================================================
+
+# COUNT(DISTINCT ...) filters for the rollup timeline / popular books
+# queries: exact counts are only computed for rows without a sketch (and the
+# partial edge days of a timeline window, which sketches cannot split)
+SKETCHED_DAYS_FILTER = """
+    FILTER (WHERE day NOT IN (
+        SELECT k.day FROM analytics_daily_sketch k
+        WHERE k.day > %(first_day)s AND k.day < %(last_day)s
+    ))
+"""
+
+SKETCHED_BOOKS_FILTER = """
+    FILTER (WHERE b.book_id NOT IN (SELECT k.book_id FROM analytics_book_sketch k))
+"""
+
+# Takes the rollup window params (first_day / last_day)
+DAILY_SKETCHES_SQL = """
+    SELECT day, books_hll, schools_hll
+    FROM analytics_daily_sketch
+    WHERE day > %(first_day)s AND day < %(last_day)s;
+"""
+
+BOOK_SKETCHES_SQL = """
+    SELECT book_id, schools_hll
+    FROM analytics_book_sketch
+    WHERE book_id = ANY(%s);
+"""
+
+
+def apply_daily_sketches(timeline, sketch_rows):
+    """Fill uniqueBooks / uniqueSchools of timeline days that have a sketch"""
+    by_date = {row['day'].isoformat(): row for row in sketch_rows}
+    for point in timeline:
+        row = by_date.get(point['date'])
+        if row is not None:
+            point['uniqueBooks'] = HyperLogLog.from_bytes(row['books_hll']).count()
+            point['uniqueSchools'] = HyperLogLog.from_bytes(row['schools_hll']).count()
+    return timeline
+
+
+def range_counts(sketch_rows, ids):
+    """uniqueBooks / uniqueSchools over a timeline window
+
+    `ids` is the rollup_range_query row for the days without a sketch.
+    """
+    return {
+        'uniqueBooks': merged_count((row['books_hll'] for row in sketch_rows),
+                                    [v for v in ids['bookIds'] or () if v]),
+        'uniqueSchools': merged_count((row['schools_hll'] for row in sketch_rows),
+                                      [v for v in ids['schoolIds'] or () if v]),
+    }
+
+
+def apply_book_sketches(books, sketch_rows):
+    """Fill uniqueSchools of popular books that have a sketch"""
+    by_book = {row['book_id']: row for row in sketch_rows}
+    for book in books:
+        row = by_book.get(book['bookId'])
+        if row is not None:
+            book['uniqueSchools'] = HyperLogLog.from_bytes(row['schools_hll']).count()
+    return books
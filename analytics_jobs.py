@@ -0,0 +1,365 @@
+# Background recomputation jobs
+#
+# Aggregates over all history (book popularity across schools, sync totals
+# and success rate) are too expensive to compute per request.
+# They are registered here as jobs: a function that runs its queries on a
+# cursor and returns a JSON-able output. JobScheduler runs each job every
+# `interval` seconds and, for jobs marked on_sync, right after a sync is
+# ingested. Outputs are stored in analytics_job_results, which the routes
+# read instead of running the queries themselves.
+#
+#   - Only one instance runs a job at a time: each run holds a session-level
+#     advisory lock for the job, so with several app processes a job that is
+#     already running elsewhere is skipped. Scheduled runs are also skipped
+#     when another process stored a result within the interval.
+#   - Every run is recorded in analytics_job_runs (trigger, start, duration,
+#     success, error); /api/analytics/_jobs reports the latest ones.
+#   - Storing a changed result bumps the ETag watermark (analytics_etag) and
+#     sends its run id on JOB_NOTIFY_CHANNEL, so response caches stop using
+#     entries built from the previous output (analytics_cache). An unchanged
+#     result only refreshes computed_at: ETags and cached responses stay.
+#
+#   FLASK_APP=analytics_backend_example flask jobs list
+#   FLASK_APP=analytics_backend_example flask jobs run book_popularity
+
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import Json
+
+from analytics_db import PoolTimeout
+from analytics_json import dumps
+from analytics_queries import SYNC_TOTALS_SQL, fetch_dicts, popular_books_query
+
+# Applied by analytics_migrations (executed without params, so % is literal)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_job_runs (
+        id bigserial PRIMARY KEY,
+        job text NOT NULL,
+        trigger text NOT NULL,
+        started_at timestamptz NOT NULL DEFAULT clock_timestamp(),
+        duration_ms integer,
+        success boolean,
+        error text
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_analytics_job_runs_job
+        ON analytics_job_runs (job, id DESC);
+
+    CREATE TABLE IF NOT EXISTS analytics_job_results (
+        job text PRIMARY KEY,
+        run_id bigint NOT NULL,
+        output json NOT NULL,
+        computed_at timestamptz NOT NULL,
+        duration_ms integer NOT NULL
+    );
+"""
+
+JOB_RESULT_SQL = """
+    SELECT
+        output,
+        run_id,
+        (EXTRACT(EPOCH FROM computed_at) * 1000)::bigint AS computed_at_ms,
+        duration_ms
+    FROM analytics_job_results
+    WHERE job = %s;
+"""
+
+# Latest run, latest result and 24h failure count per job
+JOB_STATUS_SQL = """
+    SELECT
+        r.job,
+        (EXTRACT(EPOCH FROM r.started_at) * 1000)::bigint AS "lastRunAt",
+        r.trigger AS "lastTrigger",
+        r.duration_ms AS "lastDurationMs",
+        r.success AS "lastSuccess",
+        r.error AS "lastError",
+        (EXTRACT(EPOCH FROM res.computed_at) * 1000)::bigint AS "computedAt",
+        res.duration_ms AS "computeMs",
+        (
+            SELECT COUNT(*)
+            FROM analytics_job_runs f
+            WHERE f.job = r.job
+                AND f.success = false
+                AND f.started_at >= now() - interval '24 hours'
+        ) AS "failuresLast24h"
+    FROM (
+        SELECT DISTINCT ON (job) *
+        FROM analytics_job_runs
+        ORDER BY job, id DESC
+    ) r
+    LEFT JOIN analytics_job_results res ON res.job = r.job
+    ORDER BY r.job;
+"""
+
+_START_RUN_SQL = """
+    INSERT INTO analytics_job_runs (job, trigger) VALUES (%s, %s) RETURNING id;
+"""
+
+_FINISH_RUN_SQL = """
+    UPDATE analytics_job_runs SET duration_ms = %s, success = %s, error = %s WHERE id = %s;
+"""
+
+_STORE_RESULT_SQL = """
+    INSERT INTO analytics_job_results AS r (job, run_id, output, computed_at, duration_ms)
+    VALUES (%s, %s, %s, now(), %s)
+    ON CONFLICT (job) DO UPDATE SET
+        run_id = EXCLUDED.run_id,
+        output = EXCLUDED.output,
+        computed_at = EXCLUDED.computed_at,
+        duration_ms = EXCLUDED.duration_ms;
+"""
+
+_STORED_OUTPUT_SQL = """
+    SELECT output::text AS output FROM analytics_job_results WHERE job = %s;
+"""
+
+_TOUCH_RESULT_SQL = """
+    UPDATE analytics_job_results SET computed_at = now(), duration_ms = %s WHERE job = %s;
+"""
+
+# Payload: the run id of the stored result. Separate from the sync channel,
+# since new job output is not new sync data.
+JOB_NOTIFY_CHANNEL = 'analytics_jobs'
+_NOTIFY_SQL = "SELECT pg_notify(%s, %s);"
+
+# First key of the two-key advisory locks held while a job runs; the second
+# is hashtext(job name). Separate from the single-key locks used elsewhere.
+JOB_LOCK_CLASS = 7200
+
+RUN_RETENTION_DAYS = 30
+
+# Seconds before retrying a sync / manual run whose job was locked elsewhere
+LOCK_RETRY_DELAY = 5.0
+
+
+# ============================================================================
+# REGISTRY
+# ============================================================================
+
+Job = namedtuple('Job', 'name compute interval on_sync')
+
+# name -> Job; compute(cur) returns the output stored for the job
+JOBS = {}
+
+
+def register_job(name, interval, on_sync=False):
+    """Decorator registering `compute(cur)` as a job run every `interval` seconds"""
+    def decorator(compute):
+        JOBS[name] = Job(name, compute, interval, on_sync)
+        return compute
+    return decorator
+
+
+@register_job('book_popularity', interval=900, on_sync=True)
+def compute_book_popularity(cur):
+    """Every book ranked by total active time, with exact uniqueSchools"""
+    cur.execute(*popular_books_query(None))
+    return fetch_dicts(cur)
+
+
+@register_job('sync_totals', interval=300, on_sync=True)
+def compute_sync_totals(cur):
+    """Sync counts and success rate over all history"""
+    cur.execute(SYNC_TOTALS_SQL)
+    return fetch_dicts(cur)[0]
+
+
+@register_job('job_runs_retention', interval=24 * 60 * 60)
+def prune_job_runs(cur):
+    """Drop run history older than RUN_RETENTION_DAYS"""
+    cur.execute("DELETE FROM analytics_job_runs WHERE started_at < now() - make_interval(days => %s);",
+                (RUN_RETENTION_DAYS,))
+    return {'deletedRuns': cur.rowcount}
+
+
+# ============================================================================
+# RUNNING
+# ============================================================================
+
+def run_job(conn, name, trigger='manual', fresh_within=None):
+    """Run job `name` once and store its output
+
+    Returns the run as a dict, or None when the job was skipped because
+    another process is running it or (with `fresh_within` seconds) stored a
+    result that recently. Failures are recorded and returned, not raised.
+    """
+    job = JOBS[name]
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s)) AS locked;", (JOB_LOCK_CLASS, name))
+    locked = _first(cur.fetchone())
+    conn.commit()
+    if not locked:
+        return None
+    try:
+        if fresh_within is not None:
+            cur.execute("SELECT computed_at > now() - make_interval(secs => %s) AS fresh "
+                        "FROM analytics_job_results WHERE job = %s;", (fresh_within, name))
+            row = cur.fetchone()
+            conn.commit()
+            if row is not None and _first(row):
+                return None
+
+        cur.execute(_START_RUN_SQL, (name, trigger))
+        run_id = _first(cur.fetchone())
+        conn.commit()
+
+        started = time.perf_counter()
+        error = None
+        changed = False
+        try:
+            output = job.compute(cur)
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            cur.execute(_STORED_OUTPUT_SQL, (name,))
+            row = cur.fetchone()
+            changed = row is None or _first(row) != _dumps(output)
+            if changed:
+                cur.execute(_STORE_RESULT_SQL, (name, run_id, Json(output, dumps=_dumps), duration_ms))
+                cur.execute(_NOTIFY_SQL, (JOB_NOTIFY_CHANNEL, str(run_id)))
+            else:
+                cur.execute(_TOUCH_RESULT_SQL, (duration_ms, name))
+            cur.execute(_FINISH_RUN_SQL, (duration_ms, True, None, run_id))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            error = '%s: %s' % (type(e).__name__, str(e).strip())
+            cur.execute(_FINISH_RUN_SQL, (duration_ms, False, error, run_id))
+            conn.commit()
+        return {'job': name, 'runId': run_id, 'trigger': trigger, 'durationMs': duration_ms,
+                'success': error is None, 'changed': changed, 'error': error}
+    finally:
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s, hashtext(%s));", (JOB_LOCK_CLASS, name))
+        conn.commit()
+        cur.close()
+
+
+def _first(row):
+    """First column of a dict or tuple row"""
+    return next(iter(row.values())) if isinstance(row, dict) else row[0]
+
+
+def _dumps(output):
+    return dumps(output).decode()
+
+
+def job_output(cur, name):
+    """(output, info) of the latest stored result of job `name`, or (None, None)"""
+    cur.execute(JOB_RESULT_SQL, (name,))
+    row = cur.fetchone()
+    if row is None:
+        return None, None
+    return row['output'], result_info(row)
+
+
+def result_info(row):
+    """Staleness metadata returned next to data read from a job result"""
+    return {
+        'computedAt': row['computed_at_ms'],
+        'computeMs': row['duration_ms'],
+        'ageMs': max(0, int(time.time() * 1000) - row['computed_at_ms']),
+    }
+
+
+def job_status(conn):
+    cur = conn.cursor()
+    cur.execute(JOB_STATUS_SQL)
+    rows = fetch_dicts(cur)
+    conn.commit()
+    cur.close()
+    return rows
+
+
+# ============================================================================
+# SCHEDULER
+# ============================================================================
+
+class JobScheduler:
+    """Runs registered jobs on their intervals and after syncs
+
+    A scheduler thread queues jobs as they come due; `workers` threads run
+    them on pooled connections. A job requested again before it started is
+    collapsed into the pending run; one requested while it runs in this
+    process gets one follow-up run, queued when the run finishes. A sync or
+    manual run skipped because another process holds the job's lock is
+    retried after LOCK_RETRY_DELAY seconds.
+    """
+
+    def __init__(self, pool, workers=2, jobs=None):
+        self.pool = pool
+        self.jobs = {name: JOBS[name] for name in (jobs or JOBS)}
+        self.last_error = None
+        self.last_runs = {}
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._running = set()
+        self._follow_ups = {}  # name -> trigger requested while running
+        self._lock = threading.Lock()
+        self._next_run = {name: 0.0 for name in self.jobs}
+        threading.Thread(target=self._schedule, name='analytics-jobs-scheduler', daemon=True).start()
+        for i in range(workers):
+            threading.Thread(target=self._work, name='analytics-jobs-%d' % i, daemon=True).start()
+
+    def request_sync_jobs(self):
+        """Queue every on_sync job (called after a sync is ingested)"""
+        for job in self.jobs.values():
+            if job.on_sync:
+                self.request(job.name, 'sync')
+
+    def request(self, name, trigger='manual'):
+        with self._lock:
+            if name in self._running:
+                # A sync or manual request outranks a scheduled one
+                if trigger != 'schedule' or name not in self._follow_ups:
+                    self._follow_ups[name] = trigger
+                return
+            if name in self._queued:
+                return
+            self._queued.add(name)
+        self._queue.put((name, trigger))
+
+    def _schedule(self):
+        while True:
+            now = time.monotonic()
+            for name, job in self.jobs.items():
+                if now >= self._next_run[name]:
+                    self._next_run[name] = now + job.interval
+                    self.request(name, 'schedule')
+            time.sleep(1.0)
+
+    def _work(self):
+        while True:
+            name, trigger = self._queue.get()
+            with self._lock:
+                self._queued.discard(name)
+                self._running.add(name)
+            # A scheduled run is redundant if another process just ran the job
+            fresh_within = self.jobs[name].interval / 2 if trigger == 'schedule' else None
+            run = None
+            try:
+                with self.pool.connection() as conn:
+                    run = run_job(conn, name, trigger, fresh_within)
+                if run is not None:
+                    self.last_runs[name] = run
+                elif trigger != 'schedule':
+                    # Running in another process, possibly on data from before
+                    # this request; try again once that run is likely done
+                    retry = threading.Timer(LOCK_RETRY_DELAY, self.request, (name, trigger))
+                    retry.daemon = True
+                    retry.start()
+                self.last_error = None
+            except (psycopg2.Error, PoolTimeout) as e:
+                # Not migrated yet or database unavailable; retried when next due
+                self.last_error = str(e)
+            finally:
+                with self._lock:
+                    self._running.discard(name)
+                    follow_up = self._follow_ups.pop(name, None)
+                if follow_up is not None:
+                    self.request(name, follow_up)
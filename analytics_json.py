@@ -0,0 +1,94 @@
+# JSON encoding and response compression for the analytics API
+#
+# Payloads are lists of flat rows (numbers, strings, Decimals from ROUND()
+# and AVG(), the odd timestamp), so serialization time is mostly per-value
+# overhead in the stdlib encoder. orjson, when installed, encodes them in C;
+# the stdlib encoder is the fallback and produces the same JSON.
+#
+#   Decimal          JSON number (int when integral), as the frontend's
+#                    types expect; Flask's default encoder sent strings
+#   datetime / date  HTTP date, as Flask's default encoder does
+#
+# Responses above a size threshold are compressed with brotli (optional
+# `brotli` package) or gzip, whichever the client accepts. Used by the Flask
+# app (analytics_cache.FastJSONProvider / init_response_encoding) and by
+# analytics_asgi.
+
+import gzip
+import json
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from email.utils import format_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # fast enough per request; higher levels barely shrink these payloads
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+    if isinstance(value, date):
+        return format_datetime(datetime(value.year, value.month, value.day, tzinfo=timezone.utc), usegmt=True)
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+
+if orjson is not None:
+    ENCODER = 'orjson'
+
+    def dumps(obj):
+        """Serialize `obj` to UTF-8 JSON bytes"""
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+else:
+    ENCODER = 'json'
+
+    def dumps(obj):
+        """Serialize `obj` to UTF-8 JSON bytes"""
+        return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# ============================================================================
+# COMPRESSION
+# ============================================================================
+
+def negotiate_encoding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header value"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    wildcard = accepted.get('*', 0.0)
+    if brotli is not None and accepted.get('br', wildcard) > 0:
+        return 'br'
+    if accepted.get('gzip', wildcard) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output identical for identical bodies
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
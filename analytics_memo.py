@@ -0,0 +1,347 @@
+# Per-entity memo for the book details and school timeline routes
+#
+# The response cache (analytics_cache) is dropped as a whole whenever any
+# school syncs, which on a busy day is every few seconds, so the book and
+# school pages admins keep clicking through are recomputed almost every
+# time. EntityMemo keeps those responses per entity instead:
+#
+#   ('book', book_id)      book details
+#   ('school', school_id)  school timeline, one entry per query string
+#
+# and drops only the entities a sync touched: the school, and every book
+# it sent records or new sessions for. ingest_sync announces them on the
+# analytics_entities channel in the sync's own transaction, so every
+# process invalidates after the commit. Entries also expire after the
+# route's TTL, since timeline windows move with the clock.
+#
+# Memory is bounded by `max_bytes` of response bodies, evicting the least
+# recently ('lru') or least frequently ('lfu', ties by recency) used entry.
+# start_memo_warmup (MEMO_WARMUP) fills the memo with the top books and
+# schools at startup; scripts that import the app without serving it call
+# disable_warmup() first. Hit rates and memory use are on /api/analytics/_memo and, in
+# Prometheus format, on /api/analytics/_metrics.
+
+import json
+import select
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+import psycopg2
+from flask import Response, current_app, request
+
+from analytics_db import PoolTimeout, get_pool
+
+ENTITY_NOTIFY_CHANNEL = 'analytics_entities'
+
+# Warm-up targets: the most read books and schools
+WARM_BOOKS_SQL = """
+    SELECT book_id
+    FROM books
+    GROUP BY book_id
+    ORDER BY SUM(total_active_time_ms) DESC NULLS LAST, book_id
+    LIMIT %s;
+"""
+
+WARM_SCHOOLS_SQL = """
+    SELECT id
+    FROM schools
+    ORDER BY COALESCE(total_reading_time_ms, 0) DESC, id DESC
+    LIMIT %s;
+"""
+
+POLICIES = ('lru', 'lfu')
+
+
+class EntityMemo:
+    """Response bodies per (kind, entity id, query string) within `max_bytes`
+
+    Entries sit in buckets by use count (always 1 under 'lru'), each bucket
+    ordered by recency, so lookups and evictions are O(1) apart from finding
+    the lowest bucket.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, policy='lru'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown eviction policy %r, expected one of: %s' % (policy, ', '.join(POLICIES)))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = {}  # key -> [value, expires_at, uses]
+        self._buckets = defaultdict(OrderedDict)  # uses -> keys, least recent first
+        self._by_entity = defaultdict(set)  # (kind, id) -> keys
+        self._versions = defaultdict(int)  # (kind, id) -> invalidation count
+        self._epoch = 0  # clear() count
+        self._bytes = 0
+        self._evictions = 0
+        self._warmed = 0
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+        self._lock = threading.Lock()
+
+    def get(self, entity, variant):
+        """Cached body, or None; counts a hit or miss for the entity's kind"""
+        key = entity + (variant,)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._stats[entity[0]]['misses'] += 1
+                return None
+            self._stats[entity[0]]['hits'] += 1
+            uses = entry[2]
+            if self.policy == 'lfu':
+                del self._buckets[uses][key]
+                if not self._buckets[uses]:
+                    del self._buckets[uses]
+                entry[2] = uses + 1
+                self._buckets[uses + 1][key] = None
+            else:
+                self._buckets[uses].move_to_end(key)
+            return entry[0]
+
+    def version(self, entity):
+        """Pass to set() to discard a body computed across an invalidation"""
+        with self._lock:
+            return self._epoch, self._versions[entity]
+
+    def set(self, entity, variant, value, ttl, version):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        key = entity + (variant,)
+        with self._lock:
+            if (self._epoch, self._versions[entity]) != version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            # Make room first: under 'lfu' the new entry (one use) would
+            # otherwise be the first candidate for eviction
+            while self._bytes + size > self.max_bytes:
+                victims = self._buckets[min(self._buckets)]
+                self._remove(next(iter(victims)))
+                self._evictions += 1
+            self._entries[key] = [value, time.monotonic() + ttl, 1]
+            self._buckets[1][key] = None
+            self._by_entity[entity].add(key)
+            self._bytes += size
+
+    def _remove(self, key):
+        value, _, uses = self._entries.pop(key)
+        del self._buckets[uses][key]
+        if not self._buckets[uses]:
+            del self._buckets[uses]
+        entity = key[:2]
+        self._by_entity[entity].discard(key)
+        if not self._by_entity[entity]:
+            del self._by_entity[entity]
+        self._bytes -= len(value)
+
+    def invalidate(self, kind, entity_ids):
+        """Drop every entry of the given entities (new sync data for them)"""
+        with self._lock:
+            for entity_id in entity_ids:
+                entity = (kind, entity_id)
+                self._versions[entity] += 1
+                self._stats[kind]['invalidations'] += 1
+                for key in list(self._by_entity.get(entity, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """Drop everything (invalidations may have been missed)"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._buckets.clear()
+            self._by_entity.clear()
+            self._bytes = 0
+
+    def count_warmed(self):
+        with self._lock:
+            self._warmed += 1
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for kind, counts in self._stats.items():
+                lookups = counts['hits'] + counts['misses']
+                kinds[kind] = dict(counts, hitRate=round(counts['hits'] / lookups, 4) if lookups else 0)
+            return {
+                'policy': self.policy,
+                'entries': len(self._entries),
+                'entities': len(self._by_entity),
+                'bytes': self._bytes,
+                'maxBytes': self.max_bytes,
+                'evictions': self._evictions,
+                'warmed': self._warmed,
+                'kinds': kinds,
+            }
+
+    def render(self):
+        """Prometheus text lines for /api/analytics/_metrics"""
+        stats = self.stats()
+        lines = []
+        for field, help_text in (
+            ('hits', 'Entity memo hits by kind'),
+            ('misses', 'Entity memo misses by kind'),
+            ('invalidations', 'Entities invalidated by new sync data, by kind'),
+        ):
+            name = 'analytics_memo_%s_total' % field
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name]
+            for kind, counts in sorted(stats['kinds'].items()):
+                lines.append('%s{kind="%s"} %d' % (name, kind, counts[field]))
+        for name, kind, help_text, value in (
+            ('analytics_memo_evictions_total', 'counter', 'Entries evicted for the memory budget',
+             stats['evictions']),
+            ('analytics_memo_entries', 'gauge', 'Entries held', stats['entries']),
+            ('analytics_memo_bytes', 'gauge', 'Response bytes held', stats['bytes']),
+            ('analytics_memo_max_bytes', 'gauge', 'Memory budget in bytes', stats['maxBytes']),
+        ):
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind),
+                      '%s %d' % (name, value)]
+        return '\n'.join(lines) + '\n'
+
+
+# ============================================================================
+# INVALIDATION
+# ============================================================================
+
+def notify_entities(cur, school_id, book_ids):
+    """Announce a sync's school and books (delivered when the sync commits)"""
+    payload = json.dumps({'schoolId': school_id, 'bookIds': sorted(book_ids)})
+    cur.execute("SELECT pg_notify(%s, %s);", (ENTITY_NOTIFY_CHANNEL, payload))
+
+
+def apply_notification(memo, payload):
+    changes = json.loads(payload)
+    memo.invalidate('school', [changes['schoolId']])
+    memo.invalidate('book', changes['bookIds'])
+
+
+def start_entity_listener(memo, db_config, reconnect_delay=5.0, on_sync=None):
+    """LISTEN for synced entities on a dedicated connection and invalidate them
+
+    Runs in a daemon thread; reconnects if the connection drops, clearing
+    the memo since notifications may have been missed meanwhile. `on_sync`,
+    if given, is called before each invalidation (e.g.
+    ReplicaRouter.note_write, so lagging replicas cannot refill the memo).
+    """
+    def listen():
+        while True:
+            try:
+                conn = psycopg2.connect(**db_config)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute('LISTEN %s;' % ENTITY_NOTIFY_CHANNEL)
+                memo.clear()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        if on_sync is not None:
+                            on_sync()
+                        try:
+                            apply_notification(memo, notify.payload)
+                        except (ValueError, KeyError, TypeError):
+                            memo.clear()
+            except psycopg2.Error:
+                time.sleep(reconnect_delay)
+
+    thread = threading.Thread(target=listen, name='analytics-entity-listener', daemon=True)
+    thread.start()
+    return thread
+
+
+# ============================================================================
+# FLASK INTEGRATION
+# ============================================================================
+
+def init_memo(app, memo):
+    app.extensions['entity_memo'] = memo
+    return memo
+
+
+def get_memo(app):
+    return app.extensions['entity_memo']
+
+
+def memoized(kind, id_arg, ttl):
+    """Memoize a view's successful JSON responses per entity (`kind`, kwargs[id_arg])
+
+    Like analytics_cache.cached, responses that set Cache-Control are not kept.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            memo = current_app.extensions.get('entity_memo')
+            if memo is None:
+                return view(*args, **kwargs)
+
+            entity = (kind, kwargs[id_arg])
+            variant = '&'.join('%s=%s' % (k, v) for k, v in sorted(request.args.items(multi=True)))
+            body = memo.get(entity, variant)
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+                response.headers['X-Memo'] = 'HIT'
+                return response
+
+            version = memo.version(entity)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and 'Cache-Control' not in response.headers:
+                memo.set(entity, variant, response.get_data(), ttl, version)
+            response.headers['X-Memo'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+_warmup_disabled = False
+
+
+def disable_warmup():
+    """Make later start_memo_warmup calls no-ops in this process
+
+    For scripts that import the app to measure it (analytics_bench), where
+    the warm-up would compete for the pool with what is being measured.
+    """
+    global _warmup_disabled
+    _warmup_disabled = True
+
+
+def start_memo_warmup(app, targets):
+    """Fill the memo in a daemon thread by requesting each target's top entities
+
+    `targets` is a list of (path template, ids query, limit); each id from
+    the query is formatted into the path and dispatched through the app,
+    so warmed entries are exactly what the route would have served. The
+    app's pool is looked up per target, not captured at startup. Returns
+    the thread, or None after disable_warmup().
+    """
+    if _warmup_disabled:
+        return None
+
+    def warm():
+        memo = get_memo(app)
+        for path, query, limit in targets:
+            try:
+                with get_pool(app).connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(query, (limit,))
+                    ids = [next(iter(row.values())) if isinstance(row, dict) else row[0]
+                           for row in cur.fetchall()]
+                    cur.close()
+            except (psycopg2.Error, PoolTimeout):
+                # Not migrated yet or database unavailable; entries fill on demand
+                continue
+            for entity_id in ids:
+                with app.test_request_context(path % entity_id):
+                    response = app.full_dispatch_request()
+                if response.status_code == 200:
+                    memo.count_warmed()
+
+    thread = threading.Thread(target=warm, name='analytics-memo-warmup', daemon=True)
+    thread.start()
+    return thread
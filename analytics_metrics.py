@@ -0,0 +1,273 @@
+# Query instrumentation and request metrics
+#
+# InstrumentedCursor (the pool's cursor factory) times every statement and
+# records its fingerprint, duration and row count against the route of the
+# current request. From that:
+#
+#   - every response carries a Server-Timing header (total database time,
+#     statement count and the slowest statements by fingerprint)
+#   - statements slower than the configured threshold are logged to the
+#     `analytics.slow_query` logger with their EXPLAIN plan
+#   - a 5xx response logs the statement that failed, which the routes'
+#     generic error handling otherwise reduces to str(e)
+#   - /api/analytics/_metrics exposes per-route request latency and database
+#     time histograms in Prometheus text format
+#
+# Metrics are per process; with several workers, scrape each one (or sum in
+# Prometheus). Statements issued outside a request (background threads) are
+# only subject to slow-query logging.
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from flask import g, has_app_context, request
+
+logger = logging.getLogger('analytics.slow_query')
+
+# Seconds; the default Prometheus client buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Slowest statements listed individually in Server-Timing
+SERVER_TIMING_STATEMENTS = 3
+
+
+# ============================================================================
+# FINGERPRINTS
+# ============================================================================
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def normalize_sql(query):
+    """Statement text with literals and placeholders replaced by ?"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = _LITERALS.sub('?', ' '.join(query.split()))
+    return _LISTS.sub('(?)', query)
+
+
+def fingerprint(query):
+    """Short stable id of a normalized statement"""
+    return hashlib.blake2b(normalize_sql(query).encode(), digest_size=6).hexdigest()
+
+
+# ============================================================================
+# CURSOR
+# ============================================================================
+
+class InstrumentedMixin:
+    """Times every statement executed by the cursor it is mixed into
+
+    Inside a request the statement is appended to g.query_log; slow
+    statements are logged with their plan wherever they run.
+    """
+
+    # Set by init_metrics; None disables slow-query logging
+    slow_query_ms = None
+    explain_interval = 300.0
+
+    _explained = {}  # fingerprint -> monotonic time of the last EXPLAIN
+    _explained_lock = threading.Lock()
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except psycopg2.Error as e:
+            error = '%s: %s' % (type(e).__name__, str(e).strip())
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            entry = {
+                'fingerprint': fingerprint(query),
+                'query': query,
+                'ms': elapsed_ms,
+                'rows': self.rowcount,
+                'error': error,
+            }
+            if has_app_context() and 'query_log' in g:
+                g.query_log.append(entry)
+            if error is None and self.slow_query_ms is not None and elapsed_ms >= self.slow_query_ms:
+                self._log_slow(query, vars, entry)
+
+    def _log_slow(self, query, vars, entry):
+        route = g.get('metrics_route') if has_app_context() else None
+        plan = self._explain(query, vars, entry['fingerprint'])
+        logger.warning(
+            'Slow query %s (%.1f ms, %s rows, route %s): %s%s',
+            entry['fingerprint'], entry['ms'], entry['rows'], route or '-',
+            normalize_sql(query), '\n' + plan if plan else '',
+        )
+
+    def _explain(self, query, vars, key):
+        """EXPLAIN plan of a slow SELECT, at most once per fingerprint per interval"""
+        text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else query
+        if not text.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return None
+        now = time.monotonic()
+        with self._explained_lock:
+            if now - self._explained.get(key, -self.explain_interval) < self.explain_interval:
+                return None
+            self._explained[key] = now
+
+        # A failed EXPLAIN must not abort the caller's transaction
+        conn = self.connection
+        in_transaction = conn.info.transaction_status == extensions.TRANSACTION_STATUS_INTRANS
+        cur = conn.cursor(cursor_factory=extensions.cursor)
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT analytics_explain')
+            cur.execute('EXPLAIN ' + text, vars)
+            plan = '\n'.join(row[0] for row in cur.fetchall())
+            if in_transaction:
+                cur.execute('RELEASE SAVEPOINT analytics_explain')
+            return plan
+        except psycopg2.Error as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT analytics_explain')
+            return 'EXPLAIN failed: %s' % str(e).strip()
+        finally:
+            cur.close()
+
+
+class InstrumentedCursor(InstrumentedMixin, RealDictCursor):
+    """The pool's cursor factory: dict rows"""
+
+
+class InstrumentedTupleCursor(InstrumentedMixin, extensions.cursor):
+    """Tuple rows, for large result sets shaped with analytics_queries.fetch_dicts"""
+
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+class Histogram:
+    """Prometheus-style cumulative histogram keyed by a label tuple"""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0.0, 0])  # counts, sum, count
+
+    def observe(self, labels, value):
+        series = self._series[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            base = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.label_names, labels))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, base, bound, bucket_count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, base, count))
+            lines.append('%s_sum{%s} %.6f' % (self.name, base, total))
+            lines.append('%s_count{%s} %d' % (self.name, base, count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Histogram(
+            'analytics_request_duration_seconds', 'Request latency by route',
+            ('route', 'method', 'status'))
+        self.db_time = Histogram(
+            'analytics_request_db_seconds', 'Database time per request by route', ('route',))
+        self.statements = defaultdict(lambda: [0, 0.0, 0])  # (route, fingerprint) -> calls, seconds, errors
+
+    def observe(self, route, method, status, seconds, query_log):
+        with self._lock:
+            self.requests.observe((route, method, str(status)), seconds)
+            self.db_time.observe((route,), sum(q['ms'] for q in query_log) / 1000.0)
+            for q in query_log:
+                stats = self.statements[(route, q['fingerprint'])]
+                stats[0] += 1
+                stats[1] += q['ms'] / 1000.0
+                stats[2] += 1 if q['error'] else 0
+
+    def render(self):
+        with self._lock:
+            lines = self.requests.render() + self.db_time.render()
+            for name, index, help_text in (
+                ('analytics_statement_calls_total', 0, 'Statements executed by route and fingerprint'),
+                ('analytics_statement_seconds_total', 1, 'Statement time by route and fingerprint'),
+                ('analytics_statement_errors_total', 2, 'Failed statements by route and fingerprint'),
+            ):
+                lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name]
+                for (route, fp), stats in sorted(self.statements.items()):
+                    value = '%.6f' % stats[index] if index == 1 else '%d' % stats[index]
+                    lines.append('%s{route="%s",fingerprint="%s"} %s' % (name, _escape(route), fp, value))
+        return '\n'.join(lines) + '\n'
+
+
+# ============================================================================
+# FLASK INTEGRATION
+# ============================================================================
+
+def server_timing(query_log, total_ms):
+    """Server-Timing header value for one request"""
+    db_ms = sum(q['ms'] for q in query_log)
+    parts = [
+        'total;dur=%.1f' % total_ms,
+        'db;dur=%.1f;desc="%d statements"' % (db_ms, len(query_log)),
+    ]
+    for q in sorted(query_log, key=lambda q: q['ms'], reverse=True)[:SERVER_TIMING_STATEMENTS]:
+        parts.append('sql;dur=%.1f;desc="%s"' % (q['ms'], q['fingerprint']))
+    return ', '.join(parts)
+
+
+def init_metrics(app, slow_query_ms=500, explain_interval=300.0):
+    """Attach request instrumentation and the Prometheus endpoint to `app`
+
+    The pool must use InstrumentedCursor (or a subclass) as cursor factory;
+    InstrumentedTupleCursor is instrumented the same way.
+    """
+    InstrumentedMixin.slow_query_ms = slow_query_ms
+    InstrumentedMixin.explain_interval = explain_interval
+    registry = MetricsRegistry()
+    app.extensions['metrics'] = registry
+
+    @app.before_request
+    def start_request_metrics():
+        g.query_log = []
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_started' not in g:
+            return response
+        total_ms = (time.perf_counter() - g.metrics_started) * 1000
+        query_log = g.query_log
+        registry.observe(g.metrics_route, request.method, response.status_code, total_ms / 1000.0, query_log)
+        response.headers['Server-Timing'] = server_timing(query_log, total_ms)
+        if response.status_code >= 500:
+            failed = [q for q in query_log if q['error']]
+            logger.error(
+                '%s %s returned %d%s', request.method, g.metrics_route, response.status_code,
+                ''.join('; statement %s failed (%s): %s' % (q['fingerprint'], q['error'], normalize_sql(q['query']))
+                        for q in failed),
+            )
+        return response
+
+    return registry
@@ -0,0 +1,229 @@
+# Versioned schema migrations for the analytics backend
+#
+# Each migration is applied once, in order, in its own transaction, and
+# recorded in schema_migrations. Statements use IF NOT EXISTS so running
+# against a database that already has the tables (created by the main
+# backend) only adds what is missing.
+#
+# A released migration's SQL never changes: databases that already applied
+# it would not run it again, and fresh ones would diverge from them. Every
+# constant listed in MIGRATIONS (several are reused, e.g. QUERY_INDEXES_SQL
+# and SYNC_KEYS_SQL by 7) is therefore frozen; schema changes get a new
+# constant and a new migration, as analytics_rollups does for migration 14.
+# Work that has to happen before a released migration (e.g. keeping data it
+# drops) goes in PREPARE instead, run in the same transaction just before it
+# on databases that have not applied it yet.
+#
+#   FLASK_APP=analytics_backend_example flask db migrate
+#   FLASK_APP=analytics_backend_example flask db status
+
+from analytics_cache import SYNC_NOTIFY_SQL
+from analytics_hll import SCHEMA_SQL as SKETCHES_SQL
+from analytics_jobs import SCHEMA_SQL as JOBS_SQL
+from analytics_overview import SCHEMA_SQL as OVERVIEW_SNAPSHOT_SQL
+from analytics_pages import SCHEMA_SQL as PAGE_BITMAPS_SQL, ARRAYS_ARCHIVE_SQL, ACCESS_COUNTS_SQL
+from analytics_pagination import SCHEMA_SQL as KEYSET_INDEXES_SQL, OFFSET_INDEXES_SQL
+from analytics_partitions import FUNCTIONS_SQL as PARTITION_FUNCTIONS_SQL, CONVERT_SQL
+from analytics_regions import SCHEMA_SQL as REGION_TOTALS_SQL
+from analytics_rollups import DAILY_ROLLUPS_SQL, PAGE_ROLLUP_SQL, PAGE_ROLLUP_BACKFILL_SQL
+from analytics_sync import SCHEMA_SQL as SYNC_KEYS_SQL
+from analytics_sync_stats import SCHEMA_SQL as SYNC_DURATIONS_SQL, AGGREGATE_RECORDS_SQL
+
+# Arbitrary key for pg_advisory_lock so concurrent deploys migrate serially
+MIGRATION_LOCK_KEY = 720001
+
+BASE_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS schools (
+        id serial PRIMARY KEY,
+        school_name text NOT NULL,
+        census_no text,
+        serial_number text,
+        province text,
+        district text,
+        zone text,
+        installation_date bigint,
+        total_reading_time_ms bigint NOT NULL DEFAULT 0,
+        total_books_accessed integer NOT NULL DEFAULT 0,
+        total_records bigint NOT NULL DEFAULT 0,
+        last_sync_time bigint,
+        is_active boolean NOT NULL DEFAULT true
+    );
+
+    CREATE TABLE IF NOT EXISTS books (
+        id serial PRIMARY KEY,
+        school_id integer NOT NULL REFERENCES schools (id),
+        book_id integer NOT NULL,
+        book_title text,
+        total_active_time_ms bigint NOT NULL DEFAULT 0,
+        pages_accessed integer[] NOT NULL DEFAULT '{}',
+        first_access_time bigint,
+        last_access_time bigint,
+        total_pages integer
+    );
+
+    CREATE TABLE IF NOT EXISTS page_sessions (
+        id bigserial PRIMARY KEY,
+        book_record_id integer NOT NULL REFERENCES books (id),
+        book_id integer NOT NULL,
+        page_number integer NOT NULL,
+        session_start_time bigint NOT NULL,
+        active_time_ms bigint
+    );
+
+    CREATE TABLE IF NOT EXISTS sync_logs (
+        id bigserial PRIMARY KEY,
+        school_id integer REFERENCES schools (id),
+        sync_timestamp bigint,
+        records_processed integer NOT NULL DEFAULT 0,
+        success boolean NOT NULL,
+        error_message text,
+        created_at timestamptz NOT NULL DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS device_info (
+        id serial PRIMARY KEY,
+        school_id integer REFERENCES schools (id),
+        device_id text,
+        platform text NOT NULL,
+        app_version text,
+        last_seen_at bigint
+    );
+"""
+
+# One index per access path the analytics routes use; INCLUDE columns let
+# the aggregates run as index-only scans (migrations 2 and 7; frozen)
+QUERY_INDEXES_SQL = """
+    -- timeline / reading-patterns / export: range on session_start_time
+    CREATE INDEX IF NOT EXISTS idx_page_sessions_start_time
+        ON page_sessions (session_start_time)
+        INCLUDE (book_record_id, book_id, active_time_ms);
+
+    -- popular books / book details: join from books
+    CREATE INDEX IF NOT EXISTS idx_page_sessions_book_record
+        ON page_sessions (book_record_id)
+        INCLUDE (active_time_ms);
+
+    -- page engagement for one book
+    CREATE INDEX IF NOT EXISTS idx_page_sessions_book_page
+        ON page_sessions (book_id, page_number)
+        INCLUDE (book_record_id, active_time_ms);
+
+    -- book details / books by grade / pagesAccessed lookups
+    CREATE INDEX IF NOT EXISTS idx_books_book_id
+        ON books (book_id)
+        INCLUDE (school_id, total_active_time_ms);
+
+    -- school timeline: books of one school
+    CREATE INDEX IF NOT EXISTS idx_books_school_id
+        ON books (school_id)
+        INCLUDE (book_id);
+
+    -- sync status: recent errors only ever look at failed syncs
+    CREATE INDEX IF NOT EXISTS idx_sync_logs_failed
+        ON sync_logs (sync_timestamp DESC)
+        INCLUDE (school_id, error_message)
+        WHERE success = false;
+
+    -- sync status totals as an index-only scan
+    CREATE INDEX IF NOT EXISTS idx_sync_logs_success
+        ON sync_logs (success)
+        INCLUDE (sync_timestamp);
+
+    -- schools pending sync / overview activity windows
+    CREATE INDEX IF NOT EXISTS idx_schools_last_sync
+        ON schools (last_sync_time)
+        INCLUDE (is_active, total_reading_time_ms, total_records);
+
+    -- device stats grouped by platform
+    CREATE INDEX IF NOT EXISTS idx_device_info_platform
+        ON device_info (platform)
+        INCLUDE (app_version, last_seen_at);
+"""
+
+MIGRATIONS = [
+    (1, 'base tables', BASE_TABLES_SQL),
+    (2, 'analytics query indexes', QUERY_INDEXES_SQL),
+    (3, 'sync ingest unique keys', SYNC_KEYS_SQL),
+    (4, 'keyset pagination indexes', KEYSET_INDEXES_SQL),
+    (5, 'daily rollups', DAILY_ROLLUPS_SQL),
+    (6, 'sync_logs notify trigger', SYNC_NOTIFY_SQL),
+    # Rebuilding the page_sessions indexes and rollup trigger on the new
+    # partitioned parent (they were dropped with the old table)
+    (7, 'monthly page_sessions partitions',
+        PARTITION_FUNCTIONS_SQL + CONVERT_SQL + QUERY_INDEXES_SQL + SYNC_KEYS_SQL + DAILY_ROLLUPS_SQL),
+    (8, 'overview snapshot', OVERVIEW_SNAPSHOT_SQL),
+    (9, 'distinct count sketches', SKETCHES_SQL),
+    (10, 'background job results', JOBS_SQL),
+    (11, 'sync duration aggregates', SYNC_DURATIONS_SQL),
+    (12, 'page coverage bitmaps', PAGE_BITMAPS_SQL),
+    (13, 'regional aggregate tree', REGION_TOTALS_SQL),
+    # Rollup trigger function replaced to also fill analytics_page_rollup
+    (14, 'daily page rollup', PAGE_ROLLUP_SQL + PAGE_ROLLUP_BACKFILL_SQL),
+    (15, 'page access counts', ACCESS_COUNTS_SQL),
+    (16, 'offset pagination indexes', OFFSET_INDEXES_SQL),
+    (17, 'sync aggregates without records_processed', AGGREGATE_RECORDS_SQL),
+]
+
+# version -> SQL run just before that migration, in its transaction
+PREPARE = {
+    # Keep the page arrays migration 12 drops (read by migration 15)
+    12: ARRAYS_ARCHIVE_SQL,
+}
+
+
+def _ensure_migrations_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+
+
+def applied_versions(conn):
+    cur = conn.cursor()
+    _ensure_migrations_table(cur)
+    cur.execute("SELECT version FROM schema_migrations ORDER BY version;")
+    versions = [row['version'] for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    return versions
+
+
+def migrate(conn, target=None):
+    """Apply pending migrations up to `target` (default: latest)
+
+    Returns the list of (version, name) applied by this call.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+    applied = []
+    try:
+        done = set(applied_versions(conn))
+        for version, name, sql in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            # DDL is executed without params so literal % signs are safe
+            if version in PREPARE:
+                cur.execute(PREPARE[version])
+            cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                (version, name),
+            )
+            conn.commit()
+            applied.append((version, name))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+    return applied
+
+
+def status(conn):
+    done = set(applied_versions(conn))
+    return [(version, name, version in done) for version, name, _ in MIGRATIONS]
@@ -0,0 +1,145 @@
+# Precomputed overview snapshot
+#
+# The overview numbers (current totals and the previous 30-day window used
+# for the percentage changes) are materialized into a single-row table by
+# one pass over schools. A daemon thread refreshes it on a schedule, and the
+# sync ingest route asks for an immediate refresh after every sync, so
+# /overview is a single-row read. The row records when it was computed and
+# how long that took, which the endpoint reports as staleness.
+
+import threading
+import time
+
+import psycopg2
+
+from analytics_db import PoolTimeout
+
+# Applied by analytics_migrations (executed without params, so % is literal)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_overview_snapshot (
+        id boolean PRIMARY KEY DEFAULT true CHECK (id),
+        total_active_schools bigint NOT NULL,
+        total_books bigint NOT NULL,
+        total_reading_time_ms bigint NOT NULL,
+        total_records bigint NOT NULL,
+        active_schools_last_7_days bigint NOT NULL,
+        active_schools_last_30_days bigint NOT NULL,
+        prev_schools bigint NOT NULL,
+        prev_reading_time bigint NOT NULL,
+        prev_records bigint NOT NULL,
+        computed_at timestamptz NOT NULL,
+        compute_ms integer NOT NULL
+    );
+"""
+
+# Both windows in a single scan of schools. The previous-window filters are
+# the ones the live queries used: schools last synced 30-60 days ago, and
+# totals of schools not synced in the last 30 days. clock_timestamp() in
+# the projection is evaluated after the aggregates, so compute_ms covers
+# the scan.
+REFRESH_SQL = """
+    INSERT INTO analytics_overview_snapshot AS o (
+        id, total_active_schools, total_books, total_reading_time_ms, total_records,
+        active_schools_last_7_days, active_schools_last_30_days,
+        prev_schools, prev_reading_time, prev_records, computed_at, compute_ms
+    )
+    SELECT
+        true,
+        COUNT(*) FILTER (WHERE is_active = true),
+        (SELECT COUNT(DISTINCT book_id) FROM books),
+        COALESCE(SUM(total_reading_time_ms), 0),
+        COALESCE(SUM(total_records), 0),
+        COUNT(*) FILTER (WHERE last_sync_time >= %(since_7d)s),
+        COUNT(*) FILTER (WHERE last_sync_time >= %(since_30d)s),
+        COUNT(*) FILTER (WHERE last_sync_time >= %(since_60d)s AND last_sync_time < %(since_30d)s),
+        COALESCE(SUM(total_reading_time_ms) FILTER (WHERE last_sync_time < %(since_30d)s), 0),
+        COALESCE(SUM(total_records) FILTER (WHERE last_sync_time < %(since_30d)s), 0),
+        statement_timestamp(),
+        (EXTRACT(EPOCH FROM clock_timestamp() - statement_timestamp()) * 1000)::integer
+    FROM schools
+    ON CONFLICT (id) DO UPDATE SET
+        total_active_schools = EXCLUDED.total_active_schools,
+        total_books = EXCLUDED.total_books,
+        total_reading_time_ms = EXCLUDED.total_reading_time_ms,
+        total_records = EXCLUDED.total_records,
+        active_schools_last_7_days = EXCLUDED.active_schools_last_7_days,
+        active_schools_last_30_days = EXCLUDED.active_schools_last_30_days,
+        prev_schools = EXCLUDED.prev_schools,
+        prev_reading_time = EXCLUDED.prev_reading_time,
+        prev_records = EXCLUDED.prev_records,
+        computed_at = EXCLUDED.computed_at,
+        compute_ms = EXCLUDED.compute_ms
+    RETURNING compute_ms;
+"""
+
+# Column names match the live overview rows, so analytics_queries'
+# overview_payload(snapshot, snapshot) shapes it unchanged
+SNAPSHOT_SQL = """
+    SELECT
+        *,
+        (EXTRACT(EPOCH FROM computed_at) * 1000)::bigint AS computed_at_ms
+    FROM analytics_overview_snapshot;
+"""
+
+# Serializes refreshes from several app processes
+REFRESH_LOCK_KEY = 720002
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def refresh_overview_snapshot(conn):
+    """Recompute the snapshot row; returns the server-side compute time in ms"""
+    now_ms = int(time.time() * 1000)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (REFRESH_LOCK_KEY,))
+    cur.execute(REFRESH_SQL, {
+        'since_7d': now_ms - 7 * DAY_MS,
+        'since_30d': now_ms - 30 * DAY_MS,
+        'since_60d': now_ms - 60 * DAY_MS,
+    })
+    compute_ms = cur.fetchone()['compute_ms']
+    conn.commit()
+    cur.close()
+    return compute_ms
+
+
+def snapshot_info(snapshot):
+    """Staleness metadata returned next to the overview data"""
+    if snapshot is None:
+        return None
+    return {
+        'computedAt': snapshot['computed_at_ms'],
+        'computeMs': snapshot['compute_ms'],
+        'ageMs': max(0, int(time.time() * 1000) - snapshot['computed_at_ms']),
+    }
+
+
+class OverviewSnapshotter:
+    """Refreshes the snapshot every `interval` seconds or when asked to
+
+    Refresh requests arriving while a refresh runs are collapsed into one
+    follow-up refresh.
+    """
+
+    def __init__(self, pool, interval=300):
+        self.pool = pool
+        self.interval = interval
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='analytics-overview-snapshot', daemon=True)
+        self._thread.start()
+
+    def request_refresh(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                with self.pool.connection() as conn:
+                    refresh_overview_snapshot(conn)
+                self.last_error = None
+            except (psycopg2.Error, PoolTimeout) as e:
+                # Not migrated yet or database unavailable; retry next round
+                self.last_error = str(e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,110 @@
+# Page coverage bitmaps
+#
+# Which pages of a book a school has opened used to be an integer[] on each
+# books row, so totalAccessCount summed ARRAY_LENGTH over the arrays and
+# the distinct pages of a book across schools took an unnest + ARRAY_AGG
+# (DISTINCT ...) over every element. Coverage is now a bit string per
+# (book, school) row: bit n is set when page n was opened.
+#
+#   books.pages_bitmap  varbit, as long as the highest page opened + 1
+#   books.pages_count   set bits, maintained by Postgres (generated column)
+#   books.access_count  what ARRAY_LENGTH(pages_accessed) was (see below)
+#
+#   analytics_pages_varbit(integer[])  page numbers -> bitmap
+#   analytics_varbit_pages(varbit)     bitmap -> sorted page numbers
+#   analytics_varbit_or(varbit, varbit)
+#   analytics_bit_union(varbit)        aggregate OR; shorter bitmaps are
+#                                      zero-extended, unlike bit_or()
+#
+# A 40-page book takes 5 bytes instead of 160, the ingest merge is a single
+# OR instead of unnest + DISTINCT + re-sort, and the union across schools
+# is one OR per row. Page numbers above MAX_PAGE_NUMBER are rejected at
+# ingest so a bad upload cannot produce a huge bitmap.
+
+# Largest page number a sync may report (bitmaps stay below 8 KB)
+MAX_PAGE_NUMBER = 65535
+
+FUNCTIONS_SQL = """
+    CREATE OR REPLACE FUNCTION analytics_pages_varbit(pages integer[]) RETURNS varbit
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT COALESCE(string_agg(CASE WHEN p.page IS NULL THEN '0' ELSE '1' END, '' ORDER BY i), '')::varbit
+        FROM generate_series(0, (SELECT LEAST(MAX(x), {max_page}) FROM unnest(pages) AS x)) AS i
+        LEFT JOIN (SELECT DISTINCT x AS page FROM unnest(pages) AS x) p ON p.page = i;
+    $$;
+
+    CREATE OR REPLACE FUNCTION analytics_varbit_pages(bitmap varbit) RETURNS integer[]
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT ARRAY(
+            SELECT i - 1
+            FROM (SELECT bitmap::text AS bits) b
+            CROSS JOIN generate_series(1, length(b.bits)) AS i
+            WHERE substr(b.bits, i, 1) = '1'
+            ORDER BY i
+        );
+    $$;
+
+    CREATE OR REPLACE FUNCTION analytics_varbit_count(bitmap varbit) RETURNS integer
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT length(replace(bitmap::text, '0', ''));
+    $$;
+
+    CREATE OR REPLACE FUNCTION analytics_varbit_or(a varbit, b varbit) RETURNS varbit
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+        SELECT CASE
+            WHEN length(a) = length(b) THEN a | b
+            WHEN length(a) > length(b) THEN a | (b || repeat('0', length(a) - length(b))::varbit)
+            ELSE (a || repeat('0', length(b) - length(a))::varbit) | b
+        END;
+    $$;
+
+    DROP AGGREGATE IF EXISTS analytics_bit_union(varbit);
+    CREATE AGGREGATE analytics_bit_union(varbit) (
+        SFUNC = analytics_varbit_or,
+        STYPE = varbit,
+        COMBINEFUNC = analytics_varbit_or,
+        PARALLEL = SAFE
+    );
+""".format(max_page=MAX_PAGE_NUMBER)
+
+# Applied by analytics_migrations (executed without params, so % is literal).
+# Converts the existing arrays, then drops them.
+SCHEMA_SQL = FUNCTIONS_SQL + """
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS pages_bitmap varbit NOT NULL DEFAULT B'';
+    UPDATE books
+    SET pages_bitmap = analytics_pages_varbit(pages_accessed)
+    WHERE pages_accessed IS NOT NULL AND cardinality(pages_accessed) > 0;
+    ALTER TABLE books DROP COLUMN IF EXISTS pages_accessed;
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS pages_count integer
+        GENERATED ALWAYS AS (analytics_varbit_count(pages_bitmap)) STORED;
+"""
+
+# Run by analytics_migrations just before SCHEMA_SQL, in its transaction:
+# keeps the arrays it drops, for ACCESS_COUNTS_SQL and for
+# `python analytics_bench.py page-bitmaps`
+ARRAYS_ARCHIVE_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_pages_accessed_archive AS
+    SELECT id, book_id, pages_accessed FROM books;
+"""
+
+# totalAccessCount / accessCount used to be ARRAY_LENGTH(pages_accessed),
+# which counted repeated (and out-of-range) entries that a bitmap cannot
+# hold. books.access_count keeps that figure: the archived array length,
+# or the set bits where no array was archived (databases converted before
+# the archive existed). Ingest keeps it as the old merge did: the union
+# was de-duplicated, so a synced row counts its distinct pages.
+ACCESS_COUNTS_SQL = """
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS access_count integer;
+    DO $$
+    BEGIN
+        IF to_regclass('analytics_pages_accessed_archive') IS NOT NULL THEN
+            UPDATE books b
+            SET access_count = COALESCE(cardinality(a.pages_accessed), 0)
+            FROM analytics_pages_accessed_archive a
+            WHERE a.id = b.id AND b.access_count IS NULL;
+        END IF;
+    END
+    $$;
+    UPDATE books SET access_count = pages_count WHERE access_count IS NULL;
+    ALTER TABLE books ALTER COLUMN access_count SET DEFAULT 0;
+    ALTER TABLE books ALTER COLUMN access_count SET NOT NULL;
+"""
@@ -0,0 +1,84 @@
+# Keyset (cursor) pagination helpers
+#
+# A cursor is an opaque token holding the sort value and id of the last row
+# of a page. The next page is fetched with a row comparison
+#
+#   WHERE (sort_key, id) < (%s, %s) ORDER BY sort_key DESC, id DESC
+#
+# which the composite indexes below turn into an index range scan, so deep
+# pages cost the same as the first one.
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+SCHEMA_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_schools_keyset_reading_time
+        ON schools ((COALESCE(total_reading_time_ms, 0)) DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_keyset_records
+        ON schools ((COALESCE(total_records, 0)) DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_keyset_name
+        ON schools ((COALESCE(school_name, '')) DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_sync_logs_keyset
+        ON sync_logs (created_at DESC, id DESC);
+"""
+
+# Migration 16: the limit/offset pages of schools/stats order by the plain
+# columns (NULLs first, as before keyset pagination)
+OFFSET_INDEXES_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_schools_offset_reading_time
+        ON schools (total_reading_time_ms DESC NULLS FIRST, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_offset_records
+        ON schools (total_records DESC NULLS FIRST, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_offset_name
+        ON schools (school_name DESC NULLS FIRST, id DESC);
+"""
+
+
+class InvalidCursor(ValueError):
+    """Raised for tokens that are malformed or belong to another listing"""
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(scope, value, last_id):
+    """Opaque token for the row (value, last_id) within listing `scope`"""
+    raw = json.dumps([scope, _encode_value(value), last_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, scope):
+    """Return (value, last_id) from a token produced by encode_cursor"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        token_scope, value, last_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid pagination cursor')
+    if token_scope != scope or not isinstance(last_id, int):
+        raise InvalidCursor('Cursor does not belong to this listing')
+    return value, last_id
+
+
+def next_cursor(rows, limit, scope, sort_field, id_field='id'):
+    """Cursor for the page after `rows`, or None when this was the last page
+
+    Pops `sort_field` from each row when it is a helper column that is not
+    part of the response.
+    """
+    if not rows:
+        return None
+    last = rows[-1]
+    value = last[sort_field]
+    if sort_field.startswith('_'):
+        for row in rows:
+            row.pop(sort_field, None)
+    if len(rows) < limit:
+        return None
+    return encode_cursor(scope, value, last[id_field])
@@ -0,0 +1,195 @@
+# Monthly range partitioning of page_sessions
+#
+# page_sessions is partitioned on session_start_time (epoch ms, UTC month
+# boundaries) into page_sessions_pYYYYMM tables plus a DEFAULT partition that
+# catches anything outside the prepared range (e.g. tablets with a wrong
+# clock). Queries that filter session_start_time with constant bounds are
+# pruned to the matching months by the planner.
+#
+# Upcoming months are created ahead of time by a background thread (and by
+# `flask partitions ensure`); old months can be detached and dropped or moved
+# to an archive schema with `flask partitions prune`. Rollups keep the
+# aggregates of pruned months, so timelines still cover them.
+
+import re
+import threading
+import time
+from datetime import date
+
+import psycopg2
+
+from analytics_db import PoolTimeout
+
+PARTITION_NAME_RE = re.compile(r'^page_sessions_p(\d{4})(\d{2})$')
+
+# Applied by analytics_migrations (executed without params, so % is literal)
+FUNCTIONS_SQL = """
+    CREATE OR REPLACE FUNCTION analytics_create_page_sessions_partition(month_start date)
+    RETURNS text
+    LANGUAGE plpgsql AS $fn$
+    DECLARE
+        part text := 'page_sessions_p' || to_char(month_start, 'YYYYMM');
+        lo bigint := (EXTRACT(EPOCH FROM month_start::timestamp AT TIME ZONE 'UTC') * 1000)::bigint;
+        hi bigint := (EXTRACT(EPOCH FROM (month_start + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC') * 1000)::bigint;
+    BEGIN
+        IF to_regclass(part) IS NOT NULL THEN
+            RETURN NULL;
+        END IF;
+        EXECUTE format('CREATE TABLE %I (LIKE page_sessions INCLUDING DEFAULTS)', part);
+        -- Rows that already landed in the default partition move over first,
+        -- otherwise ATTACH would refuse the overlapping range
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM page_sessions_default
+                            WHERE session_start_time >= %s AND session_start_time < %s
+                            RETURNING *)
+             INSERT INTO %I SELECT * FROM moved', lo, hi, part);
+        EXECUTE format('ALTER TABLE page_sessions ATTACH PARTITION %I FOR VALUES FROM (%s) TO (%s)',
+                       part, lo, hi);
+        RETURN part;
+    END;
+    $fn$;
+
+    CREATE OR REPLACE FUNCTION analytics_ensure_page_sessions_partitions(months_ahead integer)
+    RETURNS integer
+    LANGUAGE plpgsql AS $fn$
+    DECLARE
+        month_start date := date_trunc('month', now() AT TIME ZONE 'UTC')::date;
+        created integer := 0;
+    BEGIN
+        FOR i IN 0..months_ahead LOOP
+            IF analytics_create_page_sessions_partition((month_start + make_interval(months => i))::date) IS NOT NULL THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+        RETURN created;
+    END;
+    $fn$;
+"""
+
+# Converts an existing plain page_sessions table in place. Months with data
+# from the last ten years get their own partition; older outliers go to the
+# default partition.
+CONVERT_SQL = """
+    DO $convert$
+    DECLARE
+        seq text := pg_get_serial_sequence('page_sessions', 'id');
+        m date;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'page_sessions'::regclass) = 'p' THEN
+            RETURN;
+        END IF;
+
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', seq);
+        ALTER TABLE page_sessions RENAME TO page_sessions_unpartitioned;
+
+        EXECUTE format($ddl$
+            CREATE TABLE page_sessions (
+                id bigint NOT NULL DEFAULT nextval(%L),
+                book_record_id integer NOT NULL REFERENCES books (id),
+                book_id integer NOT NULL,
+                page_number integer NOT NULL,
+                session_start_time bigint NOT NULL,
+                active_time_ms bigint,
+                CONSTRAINT page_sessions_partitioned_pkey PRIMARY KEY (id, session_start_time)
+            ) PARTITION BY RANGE (session_start_time)
+        $ddl$, seq);
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY page_sessions.id', seq);
+        CREATE TABLE page_sessions_default PARTITION OF page_sessions DEFAULT;
+
+        FOR m IN
+            SELECT DISTINCT date_trunc('month', TO_TIMESTAMP(session_start_time / 1000.0) AT TIME ZONE 'UTC')::date
+            FROM page_sessions_unpartitioned
+            WHERE session_start_time >= (EXTRACT(EPOCH FROM now() - INTERVAL '10 years') * 1000)::bigint
+                AND session_start_time < (EXTRACT(EPOCH FROM now() + INTERVAL '1 year') * 1000)::bigint
+        LOOP
+            PERFORM analytics_create_page_sessions_partition(m);
+        END LOOP;
+        PERFORM analytics_ensure_page_sessions_partitions(3);
+
+        -- The rollup trigger stays on the old table, so the copy is not
+        -- counted twice
+        INSERT INTO page_sessions (id, book_record_id, book_id, page_number, session_start_time, active_time_ms)
+        SELECT id, book_record_id, book_id, page_number, session_start_time, active_time_ms
+        FROM page_sessions_unpartitioned;
+
+        DROP TABLE page_sessions_unpartitioned;
+    END;
+    $convert$;
+"""
+
+
+# ============================================================================
+# MAINTENANCE
+# ============================================================================
+
+def ensure_partitions(conn, months_ahead=3):
+    """Create partitions for the current month and `months_ahead` more"""
+    cur = conn.cursor()
+    cur.execute("SELECT analytics_ensure_page_sessions_partitions(%s) AS created;", (months_ahead,))
+    created = cur.fetchone()['created']
+    conn.commit()
+    cur.close()
+    return created
+
+
+def list_partitions(conn):
+    """Return [(name, month_start)] for the monthly partitions, oldest first"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname AS name
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'page_sessions'::regclass;
+    """)
+    partitions = []
+    for row in cur.fetchall():
+        match = PARTITION_NAME_RE.match(row['name'])
+        if match:
+            partitions.append((row['name'], date(int(match.group(1)), int(match.group(2)), 1)))
+    conn.commit()
+    cur.close()
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def prune_partitions(conn, keep_months, archive_schema=None, today=None):
+    """Detach months older than `keep_months` and drop or archive them
+
+    With `archive_schema` the detached tables are moved there (and can be
+    dumped or re-attached later); otherwise they are dropped.
+    """
+    today = today or date.today()
+    cutoff_index = today.year * 12 + today.month - 1 - keep_months
+    cutoff = date(cutoff_index // 12, cutoff_index % 12 + 1, 1)
+
+    pruned = []
+    cur = conn.cursor()
+    for name, month_start in list_partitions(conn):
+        if month_start >= cutoff:
+            break
+        cur.execute('ALTER TABLE page_sessions DETACH PARTITION "%s";' % name)
+        if archive_schema:
+            cur.execute('CREATE SCHEMA IF NOT EXISTS "%s";' % archive_schema)
+            cur.execute('ALTER TABLE "%s" SET SCHEMA "%s";' % (name, archive_schema))
+        else:
+            cur.execute('DROP TABLE "%s";' % name)
+        conn.commit()
+        pruned.append(name)
+    cur.close()
+    return pruned
+
+
+def start_partition_maintainer(pool, months_ahead=3, interval=6 * 60 * 60):
+    """Keep upcoming partitions created from a daemon thread"""
+    def maintain():
+        while True:
+            try:
+                with pool.connection() as conn:
+                    ensure_partitions(conn, months_ahead)
+            except (psycopg2.Error, PoolTimeout):
+                # Not migrated yet or database unavailable; retry next round
+                pass
+            time.sleep(interval)
+
+    thread = threading.Thread(target=maintain, name='analytics-partition-maintainer', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,510 @@
+# SQL and response shaping for the analytics read routes
+#
+# Shared by the Flask routes (psycopg2) and the async variant in
+# analytics_asgi (asyncpg), so both serve identical JSON. Statements use
+# psycopg2 placeholders; analytics_asgi rewrites them to $n.
+
+import time
+from datetime import datetime
+
+from analytics_pagination import InvalidCursor, decode_cursor
+
+
+def get_time_range_ms(range_str):
+    """Convert range string to milliseconds"""
+    ranges = {
+        '24h': 24 * 60 * 60 * 1000,
+        '7d': 7 * 24 * 60 * 60 * 1000,
+        '30d': 30 * 24 * 60 * 60 * 1000,
+        '90d': 90 * 24 * 60 * 60 * 1000,
+        '365d': 365 * 24 * 60 * 60 * 1000,
+    }
+    end_time = int(time.time() * 1000)
+    start_time = end_time - ranges.get(range_str, ranges['30d'])
+    return start_time, end_time
+
+def calculate_percentage_change(current, previous):
+    """Calculate percentage change between two values"""
+    if previous == 0:
+        return 100 if current > 0 else 0
+    return round(((current - previous) / previous) * 100)
+
+def fetch_dicts(cur):
+    """fetchall() as plain dicts
+
+    With a tuple cursor this is a zip per row instead of RealDictRow's
+    per-column inserts, which dominates fetch time on large results.
+    """
+    rows = cur.fetchall()
+    if not rows or isinstance(rows[0], dict):
+        return rows
+    names = [column[0] for column in cur.description]
+    return [dict(zip(names, row)) for row in rows]
+
+# ============================================================================
+# 1. OVERVIEW STATS
+# ============================================================================
+
+OVERVIEW_CURRENT_SQL = """
+    SELECT
+        COUNT(*) FILTER (WHERE is_active = true) as total_active_schools,
+        (SELECT COUNT(DISTINCT book_id) FROM books) as total_books,
+        COALESCE(SUM(total_reading_time_ms), 0) as total_reading_time_ms,
+        COALESCE(SUM(total_records), 0) as total_records,
+        COUNT(*) FILTER (
+            WHERE last_sync_time >= EXTRACT(EPOCH FROM NOW() - INTERVAL '7 days') * 1000
+        ) as active_schools_last_7_days,
+        COUNT(*) FILTER (
+            WHERE last_sync_time >= EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000
+        ) as active_schools_last_30_days
+    FROM schools;
+"""
+
+OVERVIEW_PREVIOUS_SQL = """
+    SELECT
+        COUNT(*) FILTER (
+            WHERE last_sync_time BETWEEN
+                EXTRACT(EPOCH FROM NOW() - INTERVAL '60 days') * 1000
+                AND EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000
+        ) as prev_schools,
+        COALESCE(SUM(total_reading_time_ms), 0) as prev_reading_time,
+        COALESCE(SUM(total_records), 0) as prev_records
+    FROM schools
+    WHERE last_sync_time < EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days') * 1000;
+"""
+
+def overview_payload(current, previous):
+    """Shape the overview rows into the response data"""
+    return {
+        'totalActiveSchools': current['total_active_schools'],
+        'totalBooks': current['total_books'],
+        'totalReadingTimeMs': current['total_reading_time_ms'],
+        'totalReadingTimeHours': round(current['total_reading_time_ms'] / (1000 * 60 * 60), 2),
+        'totalRecords': current['total_records'],
+        'activeSchoolsLast7Days': current['active_schools_last_7_days'],
+        'activeSchoolsLast30Days': current['active_schools_last_30_days'],
+        'percentageChange': {
+            'schools': calculate_percentage_change(
+                current['active_schools_last_30_days'],
+                previous['prev_schools'] if previous['prev_schools'] else 0
+            ),
+            'readingTime': calculate_percentage_change(
+                current['total_reading_time_ms'],
+                previous['prev_reading_time'] if previous['prev_reading_time'] else 0
+            ),
+            'records': calculate_percentage_change(
+                current['total_records'],
+                previous['prev_records'] if previous['prev_records'] else 0
+            )
+        }
+    }
+
+# ============================================================================
+# 2. SCHOOLS STATISTICS
+# ============================================================================
+
+# Frontend sort field -> indexed sort key for cursor pages (see
+# analytics_pagination): a row comparison cannot step past NULL, so NULL
+# sorts as 0 / ''
+SCHOOLS_SORT_KEYS = {
+    'totalReadingTime': 'COALESCE(total_reading_time_ms, 0)',
+    'schoolName': "COALESCE(school_name, '')",
+    'totalRecords': 'COALESCE(total_records, 0)'
+}
+
+# Frontend sort field -> column for limit/offset pages, which keep the
+# original `column DESC` order (NULLs first); the columns are NOT NULL in
+# the migrated schema, where both orders agree
+SCHOOLS_SORT_COLUMNS = {
+    'totalReadingTime': 'total_reading_time_ms',
+    'schoolName': 'school_name',
+    'totalRecords': 'total_records'
+}
+
+def schools_stats_query(sort_by, limit, offset, cursor=None):
+    """Return (query, params, cursor_scope) for one page of schools
+
+    Keyset pagination when a cursor is given, OFFSET otherwise.
+    """
+    if sort_by not in SCHOOLS_SORT_KEYS:
+        sort_by = 'totalReadingTime'
+    sort_key = SCHOOLS_SORT_KEYS[sort_by]
+    scope = 'schools:' + sort_by
+
+    if cursor:
+        last_value, last_id = decode_cursor(cursor, scope)
+        page_clause = f"WHERE ({sort_key}, id) < (%s, %s)"
+        order_by = f"{sort_key} DESC, id DESC"
+        params = (last_value, last_id, limit)
+    else:
+        page_clause = ""
+        order_by = f"{SCHOOLS_SORT_COLUMNS[sort_by]} DESC NULLS FIRST, id DESC"
+        params = (limit, offset)
+
+    query = f"""
+        SELECT
+            id,
+            school_name AS "schoolName",
+            serial_number AS "serialNumber",
+            total_reading_time_ms AS "totalReadingTimeMs",
+            ROUND((total_reading_time_ms / (1000.0 * 60 * 60))::numeric, 2) AS "totalReadingTimeHours",
+            total_books_accessed AS "totalBooksAccessed",
+            total_records AS "totalRecords",
+            last_sync_time AS "lastSyncTime",
+            is_active AS "isActive",
+            {sort_key} AS "_sortKey"
+        FROM schools
+        {page_clause}
+        ORDER BY {order_by}
+        LIMIT %s{'' if cursor else ' OFFSET %s'};
+    """
+    return query, params, scope
+
+# ============================================================================
+# 3. POPULAR BOOKS
+# ============================================================================
+
+# pagesAccessed is aggregated for the selected books in the same statement
+# instead of one unnest() query per returned book
+_POPULAR_BOOKS_SQL = """
+    WITH book_stats AS (
+        SELECT
+            b.book_id AS "bookId",
+            b.book_title AS "bookTitle",
+            b.book_id AS grade,
+            SUM(b.total_active_time_ms) AS "totalActiveTimeMs",
+            SUM(b.access_count) AS "totalAccessCount",
+            COUNT(DISTINCT b.school_id) {distinct_filter} AS "uniqueSchools",
+            AVG(ps.active_time_ms) AS "avgSessionTimeMs"
+        FROM books b
+        LEFT JOIN page_sessions ps ON ps.book_record_id = b.id
+        GROUP BY b.book_id, b.book_title
+    ),
+    top_books AS (
+        SELECT
+            "bookId",
+            "bookTitle",
+            grade,
+            COALESCE("totalActiveTimeMs", 0) AS "totalActiveTimeMs",
+            COALESCE("totalAccessCount", 0) AS "totalAccessCount",
+            "uniqueSchools",
+            COALESCE(ROUND("avgSessionTimeMs"), 0) AS "avgSessionTimeMs"
+        FROM book_stats
+        ORDER BY "totalActiveTimeMs" DESC
+        LIMIT %s
+    ),
+    top_pages AS (
+        SELECT
+            b.book_id,
+            analytics_varbit_pages(analytics_bit_union(b.pages_bitmap)) AS pages
+        FROM books b
+        JOIN (SELECT DISTINCT "bookId" FROM top_books) t ON t."bookId" = b.book_id
+        GROUP BY b.book_id
+    )
+    SELECT
+        tb."bookId",
+        tb."bookTitle",
+        tb.grade,
+        tb."totalActiveTimeMs",
+        tb."totalAccessCount",
+        tb."uniqueSchools",
+        tb."avgSessionTimeMs",
+        COALESCE(tp.pages, ARRAY[]::integer[]) AS "pagesAccessed"
+    FROM top_books tb
+    LEFT JOIN top_pages tp ON tp.book_id = tb."bookId"
+    ORDER BY tb."totalActiveTimeMs" DESC;
+"""
+
+def popular_books_query(limit, distinct_filter=''):
+    """Return (query, params); `distinct_filter` as in analytics_hll"""
+    return _POPULAR_BOOKS_SQL.format(distinct_filter=distinct_filter), (limit,)
+
+# ============================================================================
+# 4. TIMELINE DATA (raw path; see analytics_rollups for the default)
+# ============================================================================
+
+TIMELINE_SQL = """
+    SELECT
+        (EXTRACT(EPOCH FROM DATE_TRUNC('day', TO_TIMESTAMP(ps.session_start_time / 1000.0))) * 1000)::bigint AS timestamp,
+        TO_CHAR(TO_TIMESTAMP(ps.session_start_time / 1000.0), 'YYYY-MM-DD') AS date,
+        COUNT(*) AS "totalSessions",
+        SUM(ps.active_time_ms) AS "totalActiveTimeMs",
+        COUNT(DISTINCT ps.book_id) AS "uniqueBooks",
+        COUNT(DISTINCT b.school_id) AS "uniqueSchools"
+    FROM page_sessions ps
+    JOIN books b ON ps.book_record_id = b.id
+    WHERE ps.session_start_time >= %s
+        AND ps.session_start_time <= %s
+    GROUP BY timestamp, date
+    ORDER BY timestamp;
+"""
+
+# Distinct books / schools over the whole window (the timeline's "range")
+TIMELINE_RANGE_SQL = """
+    SELECT
+        COUNT(DISTINCT ps.book_id) AS "uniqueBooks",
+        COUNT(DISTINCT b.school_id) AS "uniqueSchools"
+    FROM page_sessions ps
+    JOIN books b ON ps.book_record_id = b.id
+    WHERE ps.session_start_time >= %s
+        AND ps.session_start_time <= %s;
+"""
+
+# ============================================================================
+# 5. BOOKS BY GRADE
+# ============================================================================
+
+BOOKS_BY_GRADE_SQL = """
+    WITH grade_stats AS (
+        SELECT
+            book_id AS grade,
+            COUNT(*) AS count,
+            SUM(total_active_time_ms) AS total_reading_time_ms
+        FROM books
+        WHERE book_id BETWEEN 3 AND 10
+        GROUP BY book_id
+    ),
+    total_count AS (
+        SELECT SUM(count) AS total FROM grade_stats
+    )
+    SELECT
+        gs.grade,
+        gs.count,
+        gs.total_reading_time_ms AS "totalReadingTimeMs",
+        ROUND((gs.count::numeric / NULLIF(tc.total, 0) * 100), 1) AS percentage
+    FROM grade_stats gs
+    CROSS JOIN total_count tc
+    ORDER BY gs.grade;
+"""
+
+# ============================================================================
+# 6. SYNC LOGS
+# ============================================================================
+
+def sync_logs_query(limit, offset, cursor=None):
+    """Return (query, params, cursor_scope) for one page of sync logs
+
+    Keyset pagination when a cursor is given, OFFSET otherwise.
+    """
+    scope = 'sync_logs'
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor, scope)
+        try:
+            last_created_at = datetime.fromisoformat(last_created_at)
+        except (TypeError, ValueError):
+            raise InvalidCursor('Invalid pagination cursor')
+        page_clause = "WHERE (sl.created_at, sl.id) < (%s, %s)"
+        params = (last_created_at, last_id, limit)
+    else:
+        page_clause = ""
+        params = (limit, offset)
+
+    query = f"""
+        SELECT
+            sl.id,
+            sl.school_id AS "schoolId",
+            s.school_name AS "schoolName",
+            sl.sync_timestamp AS "syncTimestamp",
+            sl.records_processed AS "recordsProcessed",
+            sl.success,
+            sl.error_message AS "errorMessage",
+            sl.created_at AS "createdAt"
+        FROM sync_logs sl
+        LEFT JOIN schools s ON sl.school_id = s.id
+        {page_clause}
+        ORDER BY sl.created_at DESC, sl.id DESC
+        LIMIT %s{'' if cursor else ' OFFSET %s'};
+    """
+    return query, params, scope
+
+# ============================================================================
+# 7. DEVICE STATS
+# ============================================================================
+
+DEVICE_STATS_SQL = """
+    WITH platform_counts AS (
+        SELECT
+            platform,
+            COUNT(*) AS count,
+            MAX(app_version) AS app_version,
+            MAX(last_seen_at) AS last_seen_at
+        FROM device_info
+        GROUP BY platform
+    ),
+    total_devices AS (
+        SELECT SUM(count) AS total FROM platform_counts
+    )
+    SELECT
+        pc.platform,
+        pc.count,
+        ROUND((pc.count::numeric / NULLIF(td.total, 0) * 100), 1) AS percentage,
+        pc.app_version AS "appVersion",
+        pc.last_seen_at AS "lastSeenAt"
+    FROM platform_counts pc
+    CROSS JOIN total_devices td
+    ORDER BY pc.count DESC;
+"""
+
+# ============================================================================
+# 8. SYNC STATUS
+# ============================================================================
+
+# Schools pending sync and recent errors: cheap (indexed) and read live
+SYNC_STATUS_SQL = """
+    SELECT
+        (
+            SELECT COUNT(*)
+            FROM schools
+            WHERE last_sync_time < %s
+                OR last_sync_time IS NULL
+        ) AS "schoolsPendingSync",
+        COALESCE((
+            SELECT json_agg(e ORDER BY e.timestamp DESC)
+            FROM (
+                SELECT
+                    sl.school_id AS "schoolId",
+                    s.school_name AS "schoolName",
+                    sl.error_message AS "errorMessage",
+                    sl.sync_timestamp AS timestamp
+                FROM sync_logs sl
+                JOIN schools s ON sl.school_id = s.id
+                WHERE sl.success = false
+                ORDER BY sl.sync_timestamp DESC
+                LIMIT 5
+            ) e
+        ), '[]'::json) AS "recentErrors";
+"""
+
+# Totals over all of sync_logs. Precomputed by the sync_totals job
+# (analytics_jobs); run inline only until the job has stored a result.
+SYNC_TOTALS_SQL = """
+    SELECT
+        COUNT(*) AS "totalSyncs",
+        SUM(CASE WHEN success THEN 1 ELSE 0 END) AS "successfulSyncs",
+        SUM(CASE WHEN NOT success THEN 1 ELSE 0 END) AS "failedSyncs",
+        ROUND((SUM(CASE WHEN success THEN 1 ELSE 0 END)::numeric / NULLIF(COUNT(*), 0) * 100), 2) AS "successRate",
+        MAX(sync_timestamp) AS "lastSyncTime"
+    FROM sync_logs;
+"""
+
+def sync_status_params():
+    """Schools not synced in the last 24 hours count as pending"""
+    return (int(time.time() * 1000) - 24 * 60 * 60 * 1000,)
+
+def sync_status_payload(row, totals, durations):
+    """Shape the live sync status row, totals and duration summary into the response data"""
+    return {
+        'totalSyncs': totals['totalSyncs'],
+        'successfulSyncs': totals['successfulSyncs'],
+        'failedSyncs': totals['failedSyncs'],
+        'successRate': totals['successRate'],
+        'lastSyncTime': totals['lastSyncTime'],
+        **row,
+        'averageSyncTime': durations['meanMs'],
+        'p95SyncTime': durations['p95Ms'],
+    }
+
+# ============================================================================
+# 9. PAGE ENGAGEMENT
+# ============================================================================
+
+PAGE_ENGAGEMENT_BOOK_SQL = """
+    SELECT
+        ps.book_id AS "bookId",
+        b.book_title AS "bookTitle",
+        ps.page_number AS "pageNumber",
+        COUNT(*) AS "totalSessions",
+        ROUND(AVG(ps.active_time_ms)) AS "avgActiveTimeMs",
+        SUM(ps.active_time_ms) AS "totalActiveTimeMs"
+    FROM page_sessions ps
+    JOIN books b ON ps.book_record_id = b.id
+    WHERE ps.book_id = %s
+    GROUP BY ps.book_id, b.book_title, ps.page_number
+    ORDER BY ps.page_number;
+"""
+
+PAGE_ENGAGEMENT_TOP_SQL = """
+    SELECT
+        ps.book_id AS "bookId",
+        b.book_title AS "bookTitle",
+        ps.page_number AS "pageNumber",
+        COUNT(*) AS "totalSessions",
+        ROUND(AVG(ps.active_time_ms)) AS "avgActiveTimeMs",
+        SUM(ps.active_time_ms) AS "totalActiveTimeMs"
+    FROM page_sessions ps
+    JOIN books b ON ps.book_record_id = b.id
+    GROUP BY ps.book_id, b.book_title, ps.page_number
+    ORDER BY "totalActiveTimeMs" DESC
+    LIMIT 50;
+"""
+
+# ============================================================================
+# Additional helper endpoints
+# ============================================================================
+
+# Raw path; see analytics_rollups for the default
+SCHOOL_TIMELINE_SQL = """
+    SELECT
+        TO_CHAR(TO_TIMESTAMP(ps.session_start_time / 1000.0), 'YYYY-MM-DD') AS date,
+        (EXTRACT(EPOCH FROM DATE_TRUNC('day', TO_TIMESTAMP(ps.session_start_time / 1000.0))) * 1000)::bigint AS timestamp,
+        COUNT(*) AS "totalSessions",
+        SUM(ps.active_time_ms) AS "totalActiveTimeMs",
+        COUNT(DISTINCT ps.book_id) AS "uniqueBooks"
+    FROM page_sessions ps
+    JOIN books b ON ps.book_record_id = b.id
+    WHERE b.school_id = %s
+        AND ps.session_start_time >= %s
+        AND ps.session_start_time <= %s
+    GROUP BY date, timestamp
+    ORDER BY timestamp;
+"""
+
+# Takes the book id twice (main query and pagesAccessed subquery)
+BOOK_DETAILS_SQL = """
+    SELECT
+        b.book_id AS "bookId",
+        b.book_title AS "bookTitle",
+        b.book_id AS grade,
+        SUM(b.total_active_time_ms) AS "totalActiveTimeMs",
+        COUNT(ps.id) AS "totalAccessCount",
+        COUNT(DISTINCT b.school_id) AS "uniqueSchools",
+        ROUND(AVG(ps.active_time_ms)) AS "avgSessionTimeMs",
+        MIN(b.first_access_time) AS "firstAccessTime",
+        MAX(b.last_access_time) AS "lastAccessTime",
+        MAX(b.total_pages) AS "totalPages",
+        COALESCE((
+            SELECT analytics_varbit_pages(analytics_bit_union(pb.pages_bitmap))
+            FROM books pb
+            WHERE pb.book_id = %s
+        ), ARRAY[]::integer[]) AS "pagesAccessed"
+    FROM books b
+    LEFT JOIN page_sessions ps ON ps.book_record_id = b.id
+    WHERE b.book_id = %s
+    GROUP BY b.book_id, b.book_title;
+"""
+
+BOOK_SCHOOLS_SQL = """
+    SELECT
+        s.id AS "schoolId",
+        s.school_name AS "schoolName",
+        b.total_active_time_ms AS "totalTime",
+        NULLIF(b.access_count, 0) AS "accessCount"
+    FROM books b
+    JOIN schools s ON b.school_id = s.id
+    WHERE b.book_id = %s
+    ORDER BY b.total_active_time_ms DESC
+    LIMIT 10;
+"""
+
+# Raw path; see analytics_rollups for the default
+READING_PATTERNS_SQL = """
+    SELECT
+        EXTRACT(HOUR FROM TO_TIMESTAMP(session_start_time / 1000.0))::integer AS hour,
+        EXTRACT(DOW FROM TO_TIMESTAMP(session_start_time / 1000.0))::integer AS "dayOfWeek",
+        COUNT(*) AS "totalSessions",
+        ROUND(AVG(active_time_ms)) AS "avgSessionTimeMs"
+    FROM page_sessions
+    WHERE session_start_time >= %s
+    GROUP BY hour, "dayOfWeek"
+    ORDER BY "dayOfWeek", hour;
+"""
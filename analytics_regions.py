@@ -0,0 +1,208 @@
+# Regional aggregates: school -> province / district / zone -> global
+#
+# analytics_region_totals holds one row per region at each level plus the
+# global root, with the additive school totals of that region. A
+# statement-level trigger on schools applies every insert, update and
+# delete as a delta (subtract the old row, add the new one) to the root and
+# to the region of each level, so a node is always the sum of its schools
+# without ever re-summing them:
+#
+#   level     name
+#   global    ''                 every school
+#   province  'Western'          schools with that province
+#   district  'Colombo'          ...
+#   zone      'Colombo North'
+#
+# Schools without a value for a level count under name ''. Levels are not
+# assumed to nest (zones are not guaranteed to lie in one district), so each
+# level partitions the schools independently and the root is their common
+# parent.
+#
+# Figures that depend on the current time (schools synced in the last N
+# days) cannot be maintained this way and stay with the overview snapshot.
+
+from analytics_queries import SCHOOLS_SORT_KEYS
+
+# Route level -> schools column
+REGION_LEVELS = {
+    'province': 'province',
+    'district': 'district',
+    'zone': 'zone',
+}
+
+_DELTA_SOURCES = {
+    'INSERT': "SELECT 1 AS sign, n.* FROM new_rows n",
+    'DELETE': "SELECT -1 AS sign, o.* FROM old_rows o",
+    'UPDATE': "SELECT 1 AS sign, n.* FROM new_rows n UNION ALL SELECT -1 AS sign, o.* FROM old_rows o",
+}
+
+
+def _apply_deltas_sql(source):
+    # One GROUPING SETS pass yields the root and every level; in the
+    # (province) set district and zone are grouped out (NULL), so COALESCE
+    # picks the province. HAVING drops the () set's row for statements that
+    # touched no rows. Nodes are upserted in key order so concurrent syncs
+    # lock them in the same order.
+    return """
+        INSERT INTO analytics_region_totals AS t
+            (level, name, school_count, active_schools, total_reading_time_ms, total_records,
+             total_books_accessed)
+        SELECT
+            CASE
+                WHEN GROUPING(d.province) = 0 THEN 'province'
+                WHEN GROUPING(d.district) = 0 THEN 'district'
+                WHEN GROUPING(d.zone) = 0 THEN 'zone'
+                ELSE 'global'
+            END AS level,
+            COALESCE(d.province, d.district, d.zone, '') AS name,
+            SUM(d.sign),
+            SUM(d.sign * d.is_active::integer),
+            SUM(d.sign * COALESCE(d.total_reading_time_ms, 0)),
+            SUM(d.sign * COALESCE(d.total_records, 0)),
+            SUM(d.sign * COALESCE(d.total_books_accessed, 0))
+        FROM ({source}) d
+        GROUP BY GROUPING SETS ((), (d.province), (d.district), (d.zone))
+        HAVING COUNT(*) > 0
+        ORDER BY 1, 2
+        ON CONFLICT (level, name) DO UPDATE SET
+            school_count = t.school_count + EXCLUDED.school_count,
+            active_schools = t.active_schools + EXCLUDED.active_schools,
+            total_reading_time_ms = t.total_reading_time_ms + EXCLUDED.total_reading_time_ms,
+            total_records = t.total_records + EXCLUDED.total_records,
+            total_books_accessed = t.total_books_accessed + EXCLUDED.total_books_accessed;
+    """.format(source=source)
+
+
+# Applied by analytics_migrations (executed without params, so % is literal)
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_region_totals (
+        level text NOT NULL,
+        name text NOT NULL,
+        school_count bigint NOT NULL DEFAULT 0,
+        active_schools bigint NOT NULL DEFAULT 0,
+        total_reading_time_ms bigint NOT NULL DEFAULT 0,
+        total_records bigint NOT NULL DEFAULT 0,
+        total_books_accessed bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (level, name)
+    );
+
+    CREATE OR REPLACE FUNCTION analytics_region_totals_apply() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {apply_insert}
+        ELSIF TG_OP = 'DELETE' THEN
+            {apply_delete}
+        ELSE
+            {apply_update}
+        END IF;
+        -- Regions whose last school moved away or was deleted
+        DELETE FROM analytics_region_totals WHERE school_count = 0 AND level <> 'global';
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Transition tables allow one event per trigger
+    DROP TRIGGER IF EXISTS trg_schools_region_insert ON schools;
+    CREATE TRIGGER trg_schools_region_insert
+        AFTER INSERT ON schools
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_region_totals_apply();
+
+    DROP TRIGGER IF EXISTS trg_schools_region_update ON schools;
+    CREATE TRIGGER trg_schools_region_update
+        AFTER UPDATE ON schools
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_region_totals_apply();
+
+    DROP TRIGGER IF EXISTS trg_schools_region_delete ON schools;
+    CREATE TRIGGER trg_schools_region_delete
+        AFTER DELETE ON schools
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_region_totals_apply();
+
+    -- Top schools within a region, in the schools stats sort order
+    CREATE INDEX IF NOT EXISTS idx_schools_province_reading_time
+        ON schools (COALESCE(province, ''), COALESCE(total_reading_time_ms, 0) DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_district_reading_time
+        ON schools (COALESCE(district, ''), COALESCE(total_reading_time_ms, 0) DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_schools_zone_reading_time
+        ON schools (COALESCE(zone, ''), COALESCE(total_reading_time_ms, 0) DESC, id DESC);
+
+    -- Existing schools, and an empty root on a fresh install
+    LOCK TABLE schools IN SHARE MODE;
+    TRUNCATE analytics_region_totals;
+    INSERT INTO analytics_region_totals (level, name) VALUES ('global', '');
+    {apply_existing}
+""".format(
+    apply_insert=_apply_deltas_sql(_DELTA_SOURCES['INSERT']),
+    apply_delete=_apply_deltas_sql(_DELTA_SOURCES['DELETE']),
+    apply_update=_apply_deltas_sql(_DELTA_SOURCES['UPDATE']),
+    apply_existing=_apply_deltas_sql("SELECT 1 AS sign, s.* FROM schools s"),
+)
+
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+# Same column names as the overview rows, so overview_payload can take the
+# root's totals over the snapshot's
+REGION_ROOT_SQL = """
+    SELECT
+        active_schools AS total_active_schools,
+        total_reading_time_ms,
+        total_records
+    FROM analytics_region_totals
+    WHERE level = 'global' AND name = '';
+"""
+
+_REGION_COLUMNS = """
+        level,
+        name,
+        school_count AS "schoolCount",
+        active_schools AS "activeSchools",
+        total_reading_time_ms AS "totalReadingTimeMs",
+        ROUND(total_reading_time_ms / (1000.0 * 60 * 60), 2) AS "totalReadingTimeHours",
+        total_records AS "totalRecords",
+        total_books_accessed AS "totalBooksAccessed"
+"""
+
+REGIONS_SQL = """
+    SELECT {columns}
+    FROM analytics_region_totals
+    WHERE level = %s
+    ORDER BY total_reading_time_ms DESC, name;
+""".format(columns=_REGION_COLUMNS)
+
+REGION_SQL = """
+    SELECT {columns}
+    FROM analytics_region_totals
+    WHERE level = %s AND name = %s;
+""".format(columns=_REGION_COLUMNS)
+
+
+def region_schools_query(level, name, sort_by, limit):
+    """Return (query, params) for the top `limit` schools of one region"""
+    column = REGION_LEVELS[level]
+    sort_key = SCHOOLS_SORT_KEYS.get(sort_by, SCHOOLS_SORT_KEYS['totalReadingTime'])
+    query = f"""
+        SELECT
+            id,
+            school_name AS "schoolName",
+            serial_number AS "serialNumber",
+            total_reading_time_ms AS "totalReadingTimeMs",
+            ROUND((total_reading_time_ms / (1000.0 * 60 * 60))::numeric, 2) AS "totalReadingTimeHours",
+            total_books_accessed AS "totalBooksAccessed",
+            total_records AS "totalRecords",
+            last_sync_time AS "lastSyncTime",
+            is_active AS "isActive"
+        FROM schools
+        WHERE COALESCE({column}, '') = %s
+        ORDER BY {sort_key} DESC, id DESC
+        LIMIT %s;
+    """
+    return query, (name, limit)
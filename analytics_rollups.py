@@ -0,0 +1,461 @@
+# Daily rollup tables for the timeline and reading-pattern endpoints
+#
+# page_sessions is aggregated into small tables that a statement-level
+# trigger keeps current as sessions are inserted (including COPY):
+#
+#   analytics_daily_rollup   one row per (day, school_id, book_id)
+#   analytics_hourly_rollup  one row per (day, hour, day_of_week)
+#   analytics_page_rollup    one row per (day, book_id, page_number), for the
+#                            windowed page rankings (analytics_topk)
+#
+# Read queries take whole days from the rollups and only scan raw
+# page_sessions for the partial days at the edges of the requested window
+# (the current day and the first day when the window starts mid-day), so
+# results match the raw GROUP BY queries exactly.
+
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from analytics_queries import fetch_dicts
+
+# Day boundaries are computed in a fixed time zone so that writers and
+# readers with different session settings agree on bucket edges. This is the
+# one setting for the whole backend: the sync, sketch, top-k and columnar
+# paths import it, and the backend's connection pool sets it as the session
+# TimeZone for the raw-SQL routes. The rollup triggers (migrations 5, 7 and
+# 14) have it baked in, so changing it needs a new migration that replaces
+# them and then `flask rollups rebuild`.
+ROLLUP_TIMEZONE = 'UTC'
+
+
+def _local_ts(col):
+    return "(TO_TIMESTAMP(%s / 1000.0) AT TIME ZONE '%s')" % (col, ROLLUP_TIMEZONE)
+
+
+def _day_start_ms(day):
+    return "(EXTRACT(EPOCH FROM (%s)::timestamp AT TIME ZONE '%s') * 1000)::bigint" % (day, ROLLUP_TIMEZONE)
+
+
+# ============================================================================
+# SCHEMA
+# ============================================================================
+
+# Applied by analytics_migrations (executed without params, so % is literal).
+# Each constant is the exact text of the migrations named beside it; change
+# the schema by adding a constant and a migration, never by editing these.
+
+# Migrations 5 and 7: daily / hourly rollups and their trigger
+DAILY_ROLLUPS_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_daily_rollup (
+        day date NOT NULL,
+        school_id integer NOT NULL,      -- 0 when books.school_id is NULL
+        book_id integer NOT NULL,        -- 0 when page_sessions.book_id is NULL
+        total_sessions bigint NOT NULL DEFAULT 0,
+        timed_sessions bigint NOT NULL DEFAULT 0,
+        total_active_time_ms bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, school_id, book_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_daily_rollup_school_day
+        ON analytics_daily_rollup (school_id, day);
+
+    CREATE TABLE IF NOT EXISTS analytics_hourly_rollup (
+        day date NOT NULL,
+        hour smallint NOT NULL,
+        day_of_week smallint NOT NULL,
+        total_sessions bigint NOT NULL DEFAULT 0,
+        timed_sessions bigint NOT NULL DEFAULT 0,
+        total_active_time_ms bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, hour)
+    );
+
+    CREATE OR REPLACE FUNCTION analytics_rollup_page_sessions() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO analytics_daily_rollup AS r
+            (day, school_id, book_id, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day_n}::date,
+            COALESCE(b.school_id, 0),
+            COALESCE(n.book_id, 0),
+            COUNT(*),
+            COUNT(n.active_time_ms),
+            COALESCE(SUM(n.active_time_ms), 0)
+        FROM new_rows n
+        JOIN books b ON n.book_record_id = b.id
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (day, school_id, book_id) DO UPDATE SET
+            total_sessions = r.total_sessions + EXCLUDED.total_sessions,
+            timed_sessions = r.timed_sessions + EXCLUDED.timed_sessions,
+            total_active_time_ms = r.total_active_time_ms + EXCLUDED.total_active_time_ms;
+
+        INSERT INTO analytics_hourly_rollup AS r
+            (day, hour, day_of_week, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day_n}::date,
+            EXTRACT(HOUR FROM {day_n})::smallint,
+            EXTRACT(DOW FROM {day_n})::smallint,
+            COUNT(*),
+            COUNT(n.active_time_ms),
+            COALESCE(SUM(n.active_time_ms), 0)
+        FROM new_rows n
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2
+        ON CONFLICT (day, hour) DO UPDATE SET
+            total_sessions = r.total_sessions + EXCLUDED.total_sessions,
+            timed_sessions = r.timed_sessions + EXCLUDED.timed_sessions,
+            total_active_time_ms = r.total_active_time_ms + EXCLUDED.total_active_time_ms;
+
+        RETURN NULL;
+    END;
+    $$;
+
+    DROP TRIGGER IF EXISTS trg_page_sessions_rollup ON page_sessions;
+    CREATE TRIGGER trg_page_sessions_rollup
+        AFTER INSERT ON page_sessions
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_rollup_page_sessions();
+""".format(day_n=_local_ts('n.session_start_time'))
+
+# Migration 14: page rollup; the trigger function is replaced to fill it too
+PAGE_ROLLUP_SQL = """
+    CREATE TABLE IF NOT EXISTS analytics_page_rollup (
+        day date NOT NULL,
+        book_id integer NOT NULL,
+        page_number integer NOT NULL,
+        total_sessions bigint NOT NULL DEFAULT 0,
+        timed_sessions bigint NOT NULL DEFAULT 0,
+        total_active_time_ms bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, book_id, page_number)
+    );
+
+    CREATE OR REPLACE FUNCTION analytics_rollup_page_sessions() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO analytics_daily_rollup AS r
+            (day, school_id, book_id, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day_n}::date,
+            COALESCE(b.school_id, 0),
+            COALESCE(n.book_id, 0),
+            COUNT(*),
+            COUNT(n.active_time_ms),
+            COALESCE(SUM(n.active_time_ms), 0)
+        FROM new_rows n
+        JOIN books b ON n.book_record_id = b.id
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (day, school_id, book_id) DO UPDATE SET
+            total_sessions = r.total_sessions + EXCLUDED.total_sessions,
+            timed_sessions = r.timed_sessions + EXCLUDED.timed_sessions,
+            total_active_time_ms = r.total_active_time_ms + EXCLUDED.total_active_time_ms;
+
+        INSERT INTO analytics_hourly_rollup AS r
+            (day, hour, day_of_week, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day_n}::date,
+            EXTRACT(HOUR FROM {day_n})::smallint,
+            EXTRACT(DOW FROM {day_n})::smallint,
+            COUNT(*),
+            COUNT(n.active_time_ms),
+            COALESCE(SUM(n.active_time_ms), 0)
+        FROM new_rows n
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2
+        ON CONFLICT (day, hour) DO UPDATE SET
+            total_sessions = r.total_sessions + EXCLUDED.total_sessions,
+            timed_sessions = r.timed_sessions + EXCLUDED.timed_sessions,
+            total_active_time_ms = r.total_active_time_ms + EXCLUDED.total_active_time_ms;
+
+        INSERT INTO analytics_page_rollup AS r
+            (day, book_id, page_number, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day_n}::date,
+            n.book_id,
+            n.page_number,
+            COUNT(*),
+            COUNT(n.active_time_ms),
+            COALESCE(SUM(n.active_time_ms), 0)
+        FROM new_rows n
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (day, book_id, page_number) DO UPDATE SET
+            total_sessions = r.total_sessions + EXCLUDED.total_sessions,
+            timed_sessions = r.timed_sessions + EXCLUDED.timed_sessions,
+            total_active_time_ms = r.total_active_time_ms + EXCLUDED.total_active_time_ms;
+
+        RETURN NULL;
+    END;
+    $$;
+""".format(day_n=_local_ts('n.session_start_time'))
+
+# Migration 14, after PAGE_ROLLUP_SQL: counts the sessions recorded so far
+PAGE_ROLLUP_BACKFILL_SQL = """
+    LOCK TABLE page_sessions IN SHARE MODE;
+    TRUNCATE analytics_page_rollup;
+    INSERT INTO analytics_page_rollup
+        (day, book_id, page_number, total_sessions, timed_sessions, total_active_time_ms)
+    SELECT
+        {day_ps}::date,
+        ps.book_id,
+        ps.page_number,
+        COUNT(*),
+        COUNT(ps.active_time_ms),
+        COALESCE(SUM(ps.active_time_ms), 0)
+    FROM page_sessions ps
+    GROUP BY 1, 2, 3;
+""".format(day_ps=_local_ts('ps.session_start_time'))
+
+
+def rebuild_rollups(conn, since_ms=None):
+    """Regenerate rollups from raw page_sessions
+
+    With `since_ms`, only days from the one containing `since_ms` onwards are
+    rebuilt (backfill); otherwise everything is. page_sessions is locked
+    against writes for the duration so the trigger and the rebuild cannot
+    double count. A full rebuild only covers raw data that is still attached;
+    use `since_ms` after partitions have been pruned.
+    """
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE page_sessions IN SHARE MODE;")
+
+    if since_ms is None:
+        cur.execute("TRUNCATE analytics_daily_rollup, analytics_hourly_rollup, analytics_page_rollup;")
+        where, params = "", {}
+    else:
+        # Constant bound so the scan is pruned to the affected partitions
+        window = _window_params(since_ms, since_ms)
+        cur.execute("DELETE FROM analytics_daily_rollup WHERE day >= %s;", (window['first_day'],))
+        cur.execute("DELETE FROM analytics_hourly_rollup WHERE day >= %s;", (window['first_day'],))
+        cur.execute("DELETE FROM analytics_page_rollup WHERE day >= %s;", (window['first_day'],))
+        where = "WHERE ps.session_start_time >= %(since_day_start)s"
+        params = {'since_day_start': window['last_day_start']}
+
+    day_ps = _local_ts('ps.session_start_time')
+    cur.execute("""
+        INSERT INTO analytics_daily_rollup
+            (day, school_id, book_id, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day}::date,
+            COALESCE(b.school_id, 0),
+            COALESCE(ps.book_id, 0),
+            COUNT(*),
+            COUNT(ps.active_time_ms),
+            COALESCE(SUM(ps.active_time_ms), 0)
+        FROM page_sessions ps
+        JOIN books b ON ps.book_record_id = b.id
+        {where}
+        GROUP BY 1, 2, 3;
+    """.format(day=day_ps, where=where), params)
+    daily_rows = cur.rowcount
+
+    cur.execute("""
+        INSERT INTO analytics_hourly_rollup
+            (day, hour, day_of_week, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day}::date,
+            EXTRACT(HOUR FROM {day})::smallint,
+            EXTRACT(DOW FROM {day})::smallint,
+            COUNT(*),
+            COUNT(ps.active_time_ms),
+            COALESCE(SUM(ps.active_time_ms), 0)
+        FROM page_sessions ps
+        {where}
+        GROUP BY 1, 2, 3;
+    """.format(day=day_ps, where=where), params)
+    hourly_rows = cur.rowcount
+
+    cur.execute("""
+        INSERT INTO analytics_page_rollup
+            (day, book_id, page_number, total_sessions, timed_sessions, total_active_time_ms)
+        SELECT
+            {day}::date,
+            ps.book_id,
+            ps.page_number,
+            COUNT(*),
+            COUNT(ps.active_time_ms),
+            COALESCE(SUM(ps.active_time_ms), 0)
+        FROM page_sessions ps
+        {where}
+        GROUP BY 1, 2, 3;
+    """.format(day=day_ps, where=where), params)
+    page_rows = cur.rowcount
+
+    conn.commit()
+    cur.close()
+    return {'dailyRows': daily_rows, 'hourlyRows': hourly_rows, 'pageRows': page_rows}
+
+
+# ============================================================================
+# QUERY PATH
+# ============================================================================
+
+# Whole days strictly between the first and last day of the window come from
+# the rollups; sessions on those two edge days come from page_sessions.
+_EDGE_FILTER = """
+    ((ps.session_start_time >= %(start)s AND ps.session_start_time < %(first_day_end)s)
+     OR (ps.session_start_time >= %(last_day_start)s AND ps.session_start_time <= %(end)s))
+"""
+
+
+def _window_params(start_time, end_time, **extra):
+    """Edge-day boundaries for a [start_time, end_time] window in epoch ms"""
+    tz = ZoneInfo(ROLLUP_TIMEZONE)
+    first_day = datetime.fromtimestamp(start_time / 1000.0, tz).date()
+    last_day = datetime.fromtimestamp(end_time / 1000.0, tz).date()
+
+    def day_start_ms(day):
+        midnight = datetime(day.year, day.month, day.day, tzinfo=tz)
+        return int(midnight.astimezone(timezone.utc).timestamp() * 1000)
+
+    return dict(
+        extra,
+        start=start_time,
+        end=end_time,
+        first_day=first_day,
+        last_day=last_day,
+        first_day_end=day_start_ms(first_day + timedelta(days=1)),
+        last_day_start=day_start_ms(last_day),
+    )
+
+
+def _daily_rows_cte(school_filter):
+    return """
+    daily AS (
+        SELECT r.day, r.school_id, r.book_id, r.total_sessions, r.timed_sessions, r.total_active_time_ms
+        FROM analytics_daily_rollup r
+        WHERE r.day > %(first_day)s
+            AND r.day < %(last_day)s
+            {rollup_school}
+        UNION ALL
+        SELECT
+            {day}::date,
+            COALESCE(b.school_id, 0),
+            COALESCE(ps.book_id, 0),
+            COUNT(*),
+            COUNT(ps.active_time_ms),
+            COALESCE(SUM(ps.active_time_ms), 0)
+        FROM page_sessions ps
+        JOIN books b ON ps.book_record_id = b.id
+        WHERE {edge_filter}
+            {raw_school}
+        GROUP BY 1, 2, 3
+    )
+    """.format(
+        day=_local_ts('ps.session_start_time'),
+        edge_filter=_EDGE_FILTER,
+        rollup_school="AND r.school_id = %(school_id)s" if school_filter else "",
+        raw_school="AND b.school_id = %(school_id)s" if school_filter else "",
+    )
+
+
+def rollup_timeline_query(start_time, end_time, distinct_filter=''):
+    """Rollup-backed equivalent of the /timeline query, as (query, params)
+
+    `distinct_filter` (a FILTER clause) restricts which days get exact
+    distinct counts; see analytics_hll.
+    """
+    return ("""
+        WITH {daily}
+        SELECT
+            {day_ms} AS timestamp,
+            TO_CHAR(day, 'YYYY-MM-DD') AS date,
+            SUM(total_sessions)::bigint AS "totalSessions",
+            CASE WHEN SUM(timed_sessions) > 0 THEN SUM(total_active_time_ms) END AS "totalActiveTimeMs",
+            COUNT(DISTINCT NULLIF(book_id, 0)) {distinct_filter} AS "uniqueBooks",
+            COUNT(DISTINCT NULLIF(school_id, 0)) {distinct_filter} AS "uniqueSchools"
+        FROM daily
+        GROUP BY day
+        ORDER BY day;
+    """.format(daily=_daily_rows_cte(False), day_ms=_day_start_ms('day'), distinct_filter=distinct_filter),
+        _window_params(start_time, end_time))
+
+
+def rollup_range_query(start_time, end_time, distinct_filter=''):
+    """Distinct books and schools over a whole /timeline window, as (query, params)
+
+    Without `distinct_filter` the counts are exact. With it (see
+    analytics_hll) the query instead returns the IDs of the days it keeps,
+    as "bookIds" / "schoolIds" arrays, to merge into the day sketches.
+    """
+    if distinct_filter:
+        select = """
+            ARRAY_AGG(DISTINCT NULLIF(book_id, 0)) {f} AS "bookIds",
+            ARRAY_AGG(DISTINCT NULLIF(school_id, 0)) {f} AS "schoolIds"
+        """.format(f=distinct_filter)
+    else:
+        select = """
+            COUNT(DISTINCT NULLIF(book_id, 0)) AS "uniqueBooks",
+            COUNT(DISTINCT NULLIF(school_id, 0)) AS "uniqueSchools"
+        """
+    return ("""
+        WITH {daily}
+        SELECT {select}
+        FROM daily;
+    """.format(daily=_daily_rows_cte(False), select=select),
+        _window_params(start_time, end_time))
+
+
+def rollup_school_timeline_query(school_id, start_time, end_time):
+    """Rollup-backed equivalent of the /schools/<id>/timeline query, as (query, params)"""
+    return ("""
+        WITH {daily}
+        SELECT
+            TO_CHAR(day, 'YYYY-MM-DD') AS date,
+            {day_ms} AS timestamp,
+            SUM(total_sessions)::bigint AS "totalSessions",
+            CASE WHEN SUM(timed_sessions) > 0 THEN SUM(total_active_time_ms) END AS "totalActiveTimeMs",
+            COUNT(DISTINCT NULLIF(book_id, 0)) AS "uniqueBooks"
+        FROM daily
+        GROUP BY day
+        ORDER BY day;
+    """.format(daily=_daily_rows_cte(True), day_ms=_day_start_ms('day')),
+        _window_params(start_time, end_time, school_id=school_id))
+
+
+def rollup_reading_patterns_query(start_time, end_time):
+    """Rollup-backed equivalent of the /reading-patterns query, as (query, params)"""
+    day_ps = _local_ts('ps.session_start_time')
+    return ("""
+        WITH hourly AS (
+            SELECT r.hour, r.day_of_week, r.total_sessions, r.timed_sessions, r.total_active_time_ms
+            FROM analytics_hourly_rollup r
+            WHERE r.day > %(first_day)s
+                AND r.day < %(last_day)s
+            UNION ALL
+            SELECT
+                EXTRACT(HOUR FROM {day})::smallint,
+                EXTRACT(DOW FROM {day})::smallint,
+                COUNT(*),
+                COUNT(ps.active_time_ms),
+                COALESCE(SUM(ps.active_time_ms), 0)
+            FROM page_sessions ps
+            WHERE {edge_filter}
+            GROUP BY 1, 2
+        )
+        SELECT
+            hour::integer AS hour,
+            day_of_week::integer AS "dayOfWeek",
+            SUM(total_sessions)::bigint AS "totalSessions",
+            ROUND(SUM(total_active_time_ms)::numeric / NULLIF(SUM(timed_sessions), 0)) AS "avgSessionTimeMs"
+        FROM hourly
+        GROUP BY hour, day_of_week
+        ORDER BY "dayOfWeek", hour;
+    """.format(day=day_ps, edge_filter=_EDGE_FILTER),
+        _window_params(start_time, end_time))
+
+
+def rollup_timeline(cur, start_time, end_time):
+    cur.execute(*rollup_timeline_query(start_time, end_time))
+    return fetch_dicts(cur)
+
+
+def rollup_school_timeline(cur, school_id, start_time, end_time):
+    cur.execute(*rollup_school_timeline_query(school_id, start_time, end_time))
+    return fetch_dicts(cur)
+
+
+def rollup_reading_patterns(cur, start_time, end_time):
+    cur.execute(*rollup_reading_patterns_query(start_time, end_time))
+    return fetch_dicts(cur)
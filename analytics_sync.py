@@ -0,0 +1,298 @@
+# Bulk ingestion of tablet sync uploads
+#
+# A sync upload carries the school's book records and the page sessions
+# recorded since the last sync, either as one JSON document:
+#
+#   {"syncTimestamp": 1700000000000,
+#    "books": [{"bookId": 5, "bookTitle": "...", "totalActiveTimeMs": 1200,
+#               "pagesAccessed": [1, 2], "firstAccessTime": ..., "lastAccessTime": ...,
+#               "totalPages": 40}, ...],
+#    "sessions": [{"bookId": 5, "pageNumber": 2, "sessionStartTime": ..., "activeTimeMs": 800}, ...]}
+#
+# or as NDJSON (Content-Type: application/x-ndjson), one object per line
+# tagged with "type": "sync" | "book" | "session". Either form may be sent
+# with Content-Encoding: gzip.
+#
+# Ingest is idempotent so tablets can blindly retry after a dropped
+# connection: book records are cumulative and merged with GREATEST/LEAST,
+# and page sessions are deduplicated on (book_record_id, page_number,
+# session_start_time).
+
+import csv
+import io
+import json
+import time
+import zlib
+
+from psycopg2.extras import execute_values
+
+from analytics_memo import notify_entities
+from analytics_pages import MAX_PAGE_NUMBER
+from analytics_rollups import ROLLUP_TIMEZONE
+
+# Upper bound on the decompressed upload size
+MAX_SYNC_PAYLOAD_BYTES = 256 * 1024 * 1024
+
+# Unique keys the ingest upserts rely on (analytics_migrations 3 and 7; frozen)
+SCHEMA_SQL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_books_school_book
+        ON books (school_id, book_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_page_sessions_natural_key
+        ON page_sessions (book_record_id, page_number, session_start_time);
+    ALTER TABLE sync_logs ADD COLUMN IF NOT EXISTS duration_ms integer;
+"""
+
+
+class SyncPayloadError(ValueError):
+    """Raised for malformed sync uploads (reported as 400)"""
+
+
+# ============================================================================
+# PAYLOAD PARSING
+# ============================================================================
+
+def _decompress(body, content_encoding):
+    if content_encoding not in ('gzip', 'x-gzip'):
+        if len(body) > MAX_SYNC_PAYLOAD_BYTES:
+            raise SyncPayloadError('Sync payload too large')
+        return body
+    # Bounded decompression so a small gzip bomb cannot exhaust memory
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(body, MAX_SYNC_PAYLOAD_BYTES + 1)
+    except zlib.error as e:
+        raise SyncPayloadError('Invalid gzip body: %s' % e)
+    if len(data) > MAX_SYNC_PAYLOAD_BYTES or decompressor.unconsumed_tail:
+        raise SyncPayloadError('Sync payload too large')
+    return data
+
+
+def parse_sync_payload(body, content_type='application/json', content_encoding=None):
+    """Return (sync_timestamp, books, sessions) from an upload body
+
+    sync_timestamp is an int (epoch ms) or None; raises SyncPayloadError
+    for malformed bodies.
+    """
+    data = _decompress(body, (content_encoding or '').lower())
+    sync_timestamp = None
+    books, sessions = [], []
+
+    try:
+        if 'ndjson' in (content_type or ''):
+            for line_no, line in enumerate(data.splitlines(), 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                kind = record.get('type')
+                if kind == 'book':
+                    books.append(record)
+                elif kind == 'session':
+                    sessions.append(record)
+                elif kind == 'sync':
+                    sync_timestamp = record.get('syncTimestamp')
+                else:
+                    raise SyncPayloadError('Line %d: unknown record type %r' % (line_no, kind))
+        else:
+            document = json.loads(data)
+            sync_timestamp = document.get('syncTimestamp')
+            books = document.get('books') or []
+            sessions = document.get('sessions') or []
+    except (json.JSONDecodeError, UnicodeDecodeError, AttributeError) as e:
+        raise SyncPayloadError('Invalid sync payload: %s' % e)
+
+    # Checked here so a bad value is a 400, not an error in the sync log path
+    if sync_timestamp is not None:
+        try:
+            sync_timestamp = int(sync_timestamp)
+        except (TypeError, ValueError, OverflowError):
+            raise SyncPayloadError('Invalid syncTimestamp: %r' % (sync_timestamp,))
+
+    return sync_timestamp, books, sessions
+
+
+def _book_rows(school_id, books):
+    # One row per bookId: ON CONFLICT DO UPDATE cannot touch a row twice
+    rows = {}
+    try:
+        for b in books:
+            book_id = int(b['bookId'])
+            pages = {int(p) for p in b.get('pagesAccessed') or []}
+            if pages and not 0 <= min(pages) <= max(pages) <= MAX_PAGE_NUMBER:
+                raise ValueError('page numbers must be within 0..%d' % MAX_PAGE_NUMBER)
+            if book_id in rows:
+                pages |= set(rows[book_id][4])
+            rows[book_id] = (
+                school_id,
+                book_id,
+                b.get('bookTitle'),
+                int(b.get('totalActiveTimeMs') or 0),
+                sorted(pages),
+                b.get('firstAccessTime'),
+                b.get('lastAccessTime'),
+                b.get('totalPages'),
+                len(pages),
+            )
+    except (KeyError, TypeError, ValueError) as e:
+        raise SyncPayloadError('Invalid book record: %s' % e)
+    return list(rows.values())
+
+
+def _sessions_csv(sessions):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    try:
+        for s in sessions:
+            active = s.get('activeTimeMs')
+            page = int(s['pageNumber'])
+            if not 0 <= page <= MAX_PAGE_NUMBER:
+                raise ValueError('page number must be within 0..%d' % MAX_PAGE_NUMBER)
+            writer.writerow((
+                int(s['bookId']),
+                page,
+                int(s['sessionStartTime']),
+                '' if active is None else int(active),
+            ))
+    except (KeyError, TypeError, ValueError) as e:
+        raise SyncPayloadError('Invalid session record: %s' % e)
+    buf.seek(0)
+    return buf
+
+
+# ============================================================================
+# INGEST
+# ============================================================================
+
+def ingest_sync(conn, school_id, sync_timestamp, books, sessions):
+    """Load one school's upload in a single transaction
+
+    Returns a summary dict; its 'insertedPages' (new sessions per day, book
+    and page, for TopKEngine.add) and 'bookIds' (books whose data changed,
+    for EntityMemo.invalidate) are not for the response. Raises LookupError
+    if the school is unknown.
+    """
+    cur = conn.cursor()
+    sync_timestamp = int(sync_timestamp or time.time() * 1000)
+    book_rows = _book_rows(school_id, books)
+    sessions_csv = _sessions_csv(sessions)
+
+    cur.execute("SELECT id FROM schools WHERE id = %s FOR UPDATE;", (school_id,))
+    if cur.fetchone() is None:
+        raise LookupError('School %s not found' % school_id)
+
+    # Book records are cumulative on the tablet, so merging is idempotent
+    if book_rows:
+        execute_values(cur, """
+            INSERT INTO books (
+                school_id, book_id, book_title, total_active_time_ms, pages_bitmap,
+                first_access_time, last_access_time, total_pages, access_count
+            )
+            VALUES %s
+            ON CONFLICT (school_id, book_id) DO UPDATE SET
+                book_title = COALESCE(EXCLUDED.book_title, books.book_title),
+                total_active_time_ms = GREATEST(books.total_active_time_ms, EXCLUDED.total_active_time_ms),
+                pages_bitmap = analytics_varbit_or(books.pages_bitmap, EXCLUDED.pages_bitmap),
+                -- As the old DISTINCT array merge: the union's page count
+                access_count = analytics_varbit_count(analytics_varbit_or(books.pages_bitmap, EXCLUDED.pages_bitmap)),
+                first_access_time = LEAST(books.first_access_time, EXCLUDED.first_access_time),
+                last_access_time = GREATEST(books.last_access_time, EXCLUDED.last_access_time),
+                total_pages = GREATEST(books.total_pages, EXCLUDED.total_pages);
+        """, book_rows, template='(%s, %s, %s, %s, analytics_pages_varbit(%s::integer[]), %s, %s, %s, %s)', page_size=1000)
+
+    # Sessions go through COPY into a staging table, then one set-based
+    # insert that resolves book_record_id and drops already-seen sessions
+    cur.execute("""
+        CREATE TEMP TABLE sync_sessions_stage (
+            book_id integer,
+            page_number integer,
+            session_start_time bigint,
+            active_time_ms bigint
+        ) ON COMMIT DROP;
+    """)
+    cur.copy_expert(
+        "COPY sync_sessions_stage FROM STDIN WITH (FORMAT csv, NULL '')",
+        sessions_csv,
+    )
+    # The new sessions come back counted per (day, book, page), in the
+    # rollup days, for the in-memory rankings (analytics_topk)
+    cur.execute("""
+        WITH inserted AS (
+            INSERT INTO page_sessions (book_record_id, book_id, page_number, session_start_time, active_time_ms)
+            SELECT DISTINCT ON (b.id, s.page_number, s.session_start_time)
+                b.id, s.book_id, s.page_number, s.session_start_time, s.active_time_ms
+            FROM sync_sessions_stage s
+            JOIN books b ON b.school_id = %(school_id)s AND b.book_id = s.book_id
+            ON CONFLICT (book_record_id, page_number, session_start_time) DO NOTHING
+            RETURNING book_id, page_number, session_start_time, active_time_ms
+        )
+        SELECT
+            (TO_TIMESTAMP(session_start_time / 1000.0) AT TIME ZONE %(timezone)s)::date AS day,
+            book_id,
+            page_number,
+            COUNT(*) AS sessions,
+            COUNT(active_time_ms) AS timed_sessions,
+            COALESCE(SUM(active_time_ms), 0) AS active_time_ms
+        FROM inserted
+        GROUP BY 1, 2, 3;
+    """, {'school_id': school_id, 'timezone': ROLLUP_TIMEZONE})
+    inserted_pages = [dict(row) for row in cur.fetchall()]
+    inserted = sum(row['sessions'] for row in inserted_pages)
+
+    # School totals in one statement; total_records only grows by the
+    # sessions that were actually new, so a retried upload adds nothing
+    cur.execute("""
+        UPDATE schools s SET
+            total_reading_time_ms = agg.total_reading_time_ms,
+            total_books_accessed = agg.total_books_accessed,
+            total_records = COALESCE(s.total_records, 0) + %(inserted)s,
+            last_sync_time = GREATEST(COALESCE(s.last_sync_time, 0), %(sync_timestamp)s)
+        FROM (
+            SELECT
+                COALESCE(SUM(total_active_time_ms), 0) AS total_reading_time_ms,
+                COUNT(*) AS total_books_accessed
+            FROM books
+            WHERE school_id = %(school_id)s
+        ) agg
+        WHERE s.id = %(school_id)s;
+    """, {'school_id': school_id, 'inserted': inserted, 'sync_timestamp': sync_timestamp})
+
+    # Memoized book and school responses to drop once this commits
+    book_ids = {row[1] for row in book_rows} | {row['book_id'] for row in inserted_pages}
+    notify_entities(cur, school_id, book_ids)
+
+    cur.close()
+    return {
+        'schoolId': school_id,
+        'syncTimestamp': sync_timestamp,
+        'booksReceived': len(book_rows),
+        'sessionsReceived': len(sessions),
+        'sessionsInserted': inserted,
+        # Already ingested by an earlier attempt, or for a book with no record
+        'sessionsSkipped': len(sessions) - inserted,
+        'insertedPages': inserted_pages,
+        'bookIds': sorted(book_ids),
+    }
+
+
+def record_sync_log(conn, school_id, sync_timestamp, records_processed, success,
+                    duration_ms, error_message=None, started_at=None, bytes_received=None):
+    """Insert the sync_logs row for an upload and commit; returns its id
+
+    On success this commits together with the ingested data, so a sync_logs
+    row exists exactly when the upload landed. `started_at` is the server
+    time (epoch ms) the upload started; the finish time is derived from it.
+    """
+    finished_at = started_at + duration_ms if started_at is not None else None
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO sync_logs (
+            school_id, sync_timestamp, records_processed, success, error_message, duration_ms,
+            started_at, finished_at, bytes_received
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id;
+    """, (school_id, sync_timestamp, records_processed, success, error_message, duration_ms,
+          started_at, finished_at, bytes_received))
+    sync_id = cur.fetchone()['id']
+    conn.commit()
+    cur.close()
+    return sync_id
@@ -0,0 +1,260 @@
+# Sync duration statistics
+#
+# Every sync_logs row records when the upload started and finished (server
+# clock, epoch ms), its size on the wire and, derived from those, records
+# per second. A statement-level trigger folds successful syncs into two
+# small aggregates as they are logged (including COPY):
+#
+#   analytics_sync_duration_daily  one row per (day, duration bucket)
+#   analytics_sync_school_daily    one row per (day, school_id)
+#
+# The sync status and sync durations routes read those instead of scanning
+# sync_logs: the mean is exact, percentiles are interpolated within the
+# histogram buckets. Failed syncs keep their duration in sync_logs but are
+# left out of the aggregates, since they mostly end in a timeout.
+
+from datetime import date, datetime, timezone
+
+from analytics_rollups import ROLLUP_TIMEZONE
+
+# Upper bounds (exclusive, ms) of the histogram buckets; bucket 0 is below
+# the first bound and the last bucket is open-ended
+DURATION_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000, 20000, 30000, 60000, 120000, 300000)
+
+_BUCKET = 'width_bucket(%s, ARRAY[%s])' % ('{duration}', ', '.join(str(b) for b in DURATION_BUCKETS_MS))
+_DAY = "(%s AT TIME ZONE '%s')::date" % ('{created_at}', ROLLUP_TIMEZONE)
+
+
+def _aggregate_sql(source, alias, records='COALESCE(SUM({a}.records_processed), 0)'):
+    """INSERT ... SELECT folding successful sync_logs rows of `source` into both aggregates
+
+    `records` is the total_records expression; migration 11 shipped with a
+    bare SUM, which is NULL when no row of a group has records_processed.
+    """
+    columns = {'duration': alias + '.duration_ms', 'created_at': alias + '.created_at'}
+    return """
+        INSERT INTO analytics_sync_duration_daily AS d
+            (day, bucket, syncs, total_ms, max_ms, total_bytes, total_records)
+        SELECT
+            {day},
+            {bucket},
+            COUNT(*),
+            SUM({a}.duration_ms),
+            MAX({a}.duration_ms),
+            COALESCE(SUM({a}.bytes_received), 0),
+            {records}
+        FROM {source} {a}
+        WHERE {a}.success AND {a}.duration_ms IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (day, bucket) DO UPDATE SET
+            syncs = d.syncs + EXCLUDED.syncs,
+            total_ms = d.total_ms + EXCLUDED.total_ms,
+            max_ms = GREATEST(d.max_ms, EXCLUDED.max_ms),
+            total_bytes = d.total_bytes + EXCLUDED.total_bytes,
+            total_records = d.total_records + EXCLUDED.total_records;
+
+        INSERT INTO analytics_sync_school_daily AS d
+            (day, school_id, syncs, total_ms, max_ms, total_bytes, total_records)
+        SELECT
+            {day},
+            {a}.school_id,
+            COUNT(*),
+            SUM({a}.duration_ms),
+            MAX({a}.duration_ms),
+            COALESCE(SUM({a}.bytes_received), 0),
+            {records}
+        FROM {source} {a}
+        WHERE {a}.success AND {a}.duration_ms IS NOT NULL AND {a}.school_id IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (day, school_id) DO UPDATE SET
+            syncs = d.syncs + EXCLUDED.syncs,
+            total_ms = d.total_ms + EXCLUDED.total_ms,
+            max_ms = GREATEST(d.max_ms, EXCLUDED.max_ms),
+            total_bytes = d.total_bytes + EXCLUDED.total_bytes,
+            total_records = d.total_records + EXCLUDED.total_records;
+    """.format(source=source, a=alias, day=_DAY.format(**columns), bucket=_BUCKET.format(**columns),
+               records=records.format(a=alias))
+
+
+# Applied by analytics_migrations (executed without params, so % is literal).
+# records_per_second is derived, so it cannot disagree with the columns it
+# is computed from.
+SCHEMA_SQL = """
+    ALTER TABLE sync_logs ADD COLUMN IF NOT EXISTS started_at bigint;
+    ALTER TABLE sync_logs ADD COLUMN IF NOT EXISTS finished_at bigint;
+    ALTER TABLE sync_logs ADD COLUMN IF NOT EXISTS bytes_received bigint;
+    ALTER TABLE sync_logs ADD COLUMN IF NOT EXISTS records_per_second real
+        GENERATED ALWAYS AS (
+            CASE WHEN duration_ms > 0 THEN records_processed * 1000.0 / duration_ms END
+        ) STORED;
+
+    CREATE TABLE IF NOT EXISTS analytics_sync_duration_daily (
+        day date NOT NULL,
+        bucket smallint NOT NULL,
+        syncs bigint NOT NULL DEFAULT 0,
+        total_ms bigint NOT NULL DEFAULT 0,
+        max_ms integer NOT NULL DEFAULT 0,
+        total_bytes bigint NOT NULL DEFAULT 0,
+        total_records bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, bucket)
+    );
+
+    CREATE TABLE IF NOT EXISTS analytics_sync_school_daily (
+        day date NOT NULL,
+        school_id integer NOT NULL,
+        syncs bigint NOT NULL DEFAULT 0,
+        total_ms bigint NOT NULL DEFAULT 0,
+        max_ms integer NOT NULL DEFAULT 0,
+        total_bytes bigint NOT NULL DEFAULT 0,
+        total_records bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, school_id)
+    );
+
+    CREATE OR REPLACE FUNCTION analytics_aggregate_sync_durations() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        {aggregate_new}
+        RETURN NULL;
+    END;
+    $$;
+
+    DROP TRIGGER IF EXISTS trg_sync_logs_durations ON sync_logs;
+    CREATE TRIGGER trg_sync_logs_durations
+        AFTER INSERT ON sync_logs
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION analytics_aggregate_sync_durations();
+
+    -- Existing history (duration_ms is recorded since the sync ingest route)
+    LOCK TABLE sync_logs IN SHARE MODE;
+    TRUNCATE analytics_sync_duration_daily, analytics_sync_school_daily;
+    {aggregate_all}
+""".format(aggregate_new=_aggregate_sql('new_rows', 'n', 'SUM({a}.records_processed)'),
+           aggregate_all=_aggregate_sql('sync_logs', 'sl', 'SUM({a}.records_processed)'))
+
+# Migration 17: the trigger function again, with total_records as
+# COALESCE(SUM(...), 0) so a group without records_processed cannot violate
+# NOT NULL and abort the sync_logs insert
+AGGREGATE_RECORDS_SQL = """
+    CREATE OR REPLACE FUNCTION analytics_aggregate_sync_durations() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        {aggregate_new}
+        RETURN NULL;
+    END;
+    $$;
+""".format(aggregate_new=_aggregate_sql('new_rows', 'n'))
+
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+DURATION_HISTOGRAM_SQL = """
+    SELECT
+        bucket,
+        SUM(syncs) AS syncs,
+        SUM(total_ms) AS total_ms,
+        MAX(max_ms) AS max_ms,
+        SUM(total_bytes) AS total_bytes,
+        SUM(total_records) AS total_records
+    FROM analytics_sync_duration_daily
+    WHERE day >= %s
+    GROUP BY bucket
+    ORDER BY bucket;
+"""
+
+_SLOWEST_SCHOOLS_SQL = """
+    SELECT
+        d.school_id AS "schoolId",
+        s.school_name AS "schoolName",
+        s.district,
+        SUM(d.syncs) AS syncs,
+        ROUND(SUM(d.total_ms)::numeric / SUM(d.syncs)) AS "averageDurationMs",
+        MAX(d.max_ms) AS "maxDurationMs",
+        ROUND(SUM(d.total_bytes) * 1000.0 / NULLIF(SUM(d.total_ms), 0)) AS "bytesPerSecond",
+        ROUND(SUM(d.total_records) * 1000.0 / NULLIF(SUM(d.total_ms), 0), 1) AS "recordsPerSecond"
+    FROM analytics_sync_school_daily d
+    JOIN schools s ON s.id = d.school_id
+    WHERE d.day >= %s
+    GROUP BY d.school_id, s.school_name, s.district
+    HAVING SUM(d.syncs) >= %s
+    ORDER BY {order}, d.school_id
+    LIMIT %s;
+"""
+
+# Slow on average, or slow per byte (poor connectivity regardless of
+# upload size)
+SLOWEST_SCHOOLS_ORDER = {
+    'averageDuration': '"averageDurationMs" DESC',
+    'throughput': '"bytesPerSecond" ASC NULLS LAST',
+}
+
+# Schools with fewer successful syncs in the window are not ranked
+SLOWEST_SCHOOLS_MIN_SYNCS = 3
+
+
+def slowest_schools_query(since_day, limit, sort_by='averageDuration'):
+    """Return (query, params)"""
+    order = SLOWEST_SCHOOLS_ORDER.get(sort_by, SLOWEST_SCHOOLS_ORDER['averageDuration'])
+    return _SLOWEST_SCHOOLS_SQL.format(order=order), (since_day, SLOWEST_SCHOOLS_MIN_SYNCS, limit)
+
+
+# Aggregates hold everything from this day on
+ALL_HISTORY = date(1970, 1, 1)
+
+
+def since_day(start_ms):
+    """Aggregate day containing `start_ms` (whole days, so the window starts at midnight)"""
+    return datetime.fromtimestamp(start_ms / 1000.0, timezone.utc).date()
+
+
+# ============================================================================
+# SUMMARY
+# ============================================================================
+
+def _quantile(buckets, total, q):
+    """Interpolated `q` quantile from (lower, upper, count) buckets"""
+    rank = q * total
+    seen = 0
+    for lower, upper, count in buckets:
+        if count and seen + count >= rank:
+            return round(lower + (upper - lower) * (rank - seen) / count)
+        seen += count
+    return None
+
+
+def duration_summary(rows):
+    """Mean, percentiles, throughput and histogram from DURATION_HISTOGRAM_SQL rows"""
+    by_bucket = {row['bucket']: row for row in rows}
+    syncs = sum(int(row['syncs']) for row in rows)
+    total_ms = sum(int(row['total_ms']) for row in rows)
+    max_ms = max((int(row['max_ms']) for row in rows), default=None)
+
+    bounds = (0,) + DURATION_BUCKETS_MS
+    histogram, buckets = [], []
+    for i, lower in enumerate(bounds):
+        upper = bounds[i + 1] if i + 1 < len(bounds) else None
+        row = by_bucket.get(i)
+        count = int(row['syncs']) if row else 0
+        histogram.append({'minMs': lower, 'maxMs': upper, 'count': count})
+        # The open-ended bucket ends at the largest duration seen
+        buckets.append((lower, upper if upper is not None else max(lower, max_ms or 0), count))
+
+    def quantile(q):
+        return min(_quantile(buckets, syncs, q), max_ms) if syncs else 0
+
+    total_bytes = sum(int(row['total_bytes']) for row in rows)
+    total_records = sum(int(row['total_records']) for row in rows)
+    return {
+        'syncs': syncs,
+        'meanMs': round(total_ms / syncs) if syncs else 0,
+        'p50Ms': quantile(0.50),
+        'p95Ms': quantile(0.95),
+        'maxMs': max_ms or 0,
+        'bytesPerSecond': round(total_bytes * 1000 / total_ms) if total_ms else None,
+        'recordsPerSecond': round(total_records * 1000 / total_ms, 1) if total_ms else None,
+        'histogram': histogram,
+    }
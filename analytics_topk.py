@@ -0,0 +1,331 @@
+# Top-K rankings per time window
+#
+# Popular books and hot pages over the last day, 7 days and 30 days
+# (?window=day|7d|30d on the popular books and page engagement routes).
+# The exact answers come from the daily rollups (analytics_daily_rollup per
+# book and school, analytics_page_rollup per page), but that still groups
+# and sorts every (book, page) of the window on each request. TopKEngine
+# keeps the per-day counters of the longest window in memory and serves the
+# top TOP_K of each window from a ranking that is only rebuilt after the
+# counters change:
+#
+#   - a sync ingested by this process is counted at once, from the rows its
+#     insert returned (only sessions that were new, so retries add nothing)
+#   - every `refresh_interval` seconds, and soon after each sync NOTIFY
+#     (request_refresh), the counters are reloaded from the rollups, which
+#     picks up syncs ingested by other processes and drops days that left
+#     the window. Syncs counted while a reload runs are replayed onto it
+#     unless its snapshot already includes their sync_logs row.
+#
+# Keys are (book, page) pairs, a few thousand at most, so every counter is
+# exact and a ranking is one heapq.nlargest over the window's totals; a
+# count-min sketch would only add error. Windows are whole days in
+# ROLLUP_TIMEZONE: 'day' is today, '7d' today and the six days before.
+# exact=true runs the same rankings in SQL (top_books_query /
+# top_pages_query); `python analytics_bench.py topk-check` compares the two.
+
+import heapq
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import psycopg2
+
+from analytics_rollups import ROLLUP_TIMEZONE
+
+WINDOW_DAYS = {'day': 1, '7d': 7, '30d': 30}
+
+# Rankings hold this many entries; larger limits use the SQL path
+TOP_K = 100
+
+# Least time between two reloads (seconds) when syncs keep requesting them
+MIN_REFRESH_GAP = 5
+
+PAGE_COUNTS_SQL = """
+    SELECT day, book_id, page_number, total_sessions, timed_sessions, total_active_time_ms
+    FROM analytics_page_rollup
+    WHERE day >= %s;
+"""
+
+# Latest day each school read each book, for uniqueSchools of any window
+SCHOOL_LAST_DAYS_SQL = """
+    SELECT book_id, school_id, MAX(day)
+    FROM analytics_daily_rollup
+    WHERE day >= %s AND school_id <> 0 AND total_sessions > 0
+    GROUP BY book_id, school_id;
+"""
+
+BOOK_TITLES_SQL = """
+    SELECT book_id, MIN(book_title) FROM books GROUP BY book_id;
+"""
+
+# Which of the syncs counted during a reload its snapshot already includes
+VISIBLE_SYNCS_SQL = """
+    SELECT id FROM sync_logs WHERE id = ANY(%s);
+"""
+
+TOP_BOOKS_SQL = """
+    SELECT
+        r.book_id AS "bookId",
+        t.book_title AS "bookTitle",
+        r.book_id AS grade,
+        SUM(r.total_active_time_ms) AS "totalActiveTimeMs",
+        SUM(r.total_sessions) AS "totalSessions",
+        COALESCE(ROUND(SUM(r.total_active_time_ms) / NULLIF(SUM(r.timed_sessions), 0)), 0) AS "avgSessionTimeMs",
+        COUNT(DISTINCT NULLIF(r.school_id, 0)) AS "uniqueSchools"
+    FROM analytics_daily_rollup r
+    LEFT JOIN (SELECT book_id, MIN(book_title) AS book_title FROM books GROUP BY book_id) t
+        ON t.book_id = r.book_id
+    WHERE r.day >= %s
+    GROUP BY r.book_id, t.book_title
+    ORDER BY "totalActiveTimeMs" DESC, r.book_id
+    LIMIT %s;
+"""
+
+TOP_PAGES_SQL = """
+    SELECT
+        r.book_id AS "bookId",
+        t.book_title AS "bookTitle",
+        r.page_number AS "pageNumber",
+        SUM(r.total_sessions) AS "totalSessions",
+        ROUND(SUM(r.total_active_time_ms) / NULLIF(SUM(r.timed_sessions), 0)) AS "avgActiveTimeMs",
+        SUM(r.total_active_time_ms) AS "totalActiveTimeMs"
+    FROM analytics_page_rollup r
+    LEFT JOIN (SELECT book_id, MIN(book_title) AS book_title FROM books GROUP BY book_id) t
+        ON t.book_id = r.book_id
+    WHERE r.day >= %s
+    GROUP BY r.book_id, t.book_title, r.page_number
+    ORDER BY "totalActiveTimeMs" DESC, r.book_id, r.page_number
+    LIMIT %s;
+"""
+
+
+def window_first_day(window, today=None):
+    """First rollup day of `window`; LookupError for an unknown window"""
+    if window not in WINDOW_DAYS:
+        raise LookupError('Unknown window %r, expected one of: %s' % (window, ', '.join(WINDOW_DAYS)))
+    today = today or datetime.now(ZoneInfo(ROLLUP_TIMEZONE)).date()
+    return today - timedelta(days=WINDOW_DAYS[window] - 1)
+
+
+def top_books_query(window, limit):
+    """Return (query, params): exact book ranking of `window` from the rollups"""
+    return TOP_BOOKS_SQL, (window_first_day(window), limit)
+
+
+def top_pages_query(window, limit):
+    """Return (query, params): exact page ranking of `window` from the rollups"""
+    return TOP_PAGES_SQL, (window_first_day(window), limit)
+
+
+def _round_avg(total, count):
+    """ROUND(total / count) as Postgres rounds numerics (half away from zero)"""
+    return (2 * total + count) // (2 * count) if count else None
+
+
+# ============================================================================
+# ENGINE
+# ============================================================================
+
+# pages: day -> {(book_id, page_number): [sessions, timed, active_ms]}
+# last_days: book_id -> {school_id: latest day with sessions}
+State = namedtuple('State', 'first_day pages last_days titles')
+
+
+class TopKEngine:
+    """Windowed book and page rankings, reloaded every `refresh_interval` seconds
+
+    Uses its own connection (`db_config`). Not `ready` until the first load
+    has finished; callers use the SQL path until then.
+    """
+
+    def __init__(self, db_config, refresh_interval=60, k=TOP_K, autostart=True):
+        self.db_config = dict(db_config)
+        self.refresh_interval = refresh_interval
+        self.k = k
+        self.state = None
+        self.last_error = None
+        self.last_refresh_ms = None
+        self._tz = ZoneInfo(ROLLUP_TIMEZONE)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._rankings = {}  # (kind, window, today) -> ranking
+        self._pending = None  # sync_logs id -> add() args, while a reload runs
+        if autostart:
+            thread = threading.Thread(target=self._run, name='analytics-topk', daemon=True)
+            thread.start()
+
+    @property
+    def ready(self):
+        return self.state is not None
+
+    def request_refresh(self):
+        """Reload soon (new sync data, possibly from another process)"""
+        self._wake.set()
+
+    def _run(self):
+        conn = None
+        while True:
+            started = time.monotonic()
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**self.db_config)
+                    conn.autocommit = True
+                self.refresh(conn)
+                self.last_error = None
+            except psycopg2.Error as e:
+                self.last_error = str(e)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            time.sleep(max(0, started + MIN_REFRESH_GAP - time.monotonic()))
+
+    def today(self):
+        return datetime.now(self._tz).date()
+
+    def refresh(self, conn):
+        """Reload the counters of the longest window from the rollups
+
+        `conn` must be in autocommit mode; the reload reads one snapshot.
+        """
+        started = time.perf_counter()
+        first_day = self.today() - timedelta(days=max(WINDOW_DAYS.values()) - 1)
+        with self._lock:
+            self._pending = {}
+        cur = conn.cursor()
+        cur.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;')
+        try:
+            state = self._load(cur, first_day)
+            with self._lock:
+                pending, self._pending = self._pending, None
+                visible = set()
+                if pending:
+                    cur.execute(VISIBLE_SYNCS_SQL, (list(pending),))
+                    visible = {row[0] for row in cur}
+                for sync_id, (school_id, inserted_pages) in sorted(pending.items()):
+                    if sync_id not in visible:
+                        self._count(state, school_id, inserted_pages)
+                self.state = state
+                self._rankings = {}
+        finally:
+            with self._lock:
+                self._pending = None
+            cur.execute('COMMIT;')
+            cur.close()
+        self.last_refresh_ms = round((time.perf_counter() - started) * 1000)
+
+    def _load(self, cur, first_day):
+        cur.execute(PAGE_COUNTS_SQL, (first_day,))
+        pages = defaultdict(dict)
+        for day, book_id, page_number, sessions, timed, active in cur:
+            pages[day][(book_id, page_number)] = [sessions, timed, active]
+        cur.execute(SCHOOL_LAST_DAYS_SQL, (first_day,))
+        last_days = defaultdict(dict)
+        for book_id, school_id, day in cur:
+            last_days[book_id][school_id] = day
+        cur.execute(BOOK_TITLES_SQL)
+        titles = dict(cur.fetchall())
+        return State(first_day, pages, last_days, titles)
+
+    def add(self, sync_id, school_id, inserted_pages):
+        """Count the sessions one sync inserted (ingest_sync's 'insertedPages')
+
+        `sync_id` is the sync's committed sync_logs id (record_sync_log).
+        """
+        if not inserted_pages:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending[sync_id] = (school_id, inserted_pages)
+            if self.state is not None:
+                self._count(self.state, school_id, inserted_pages)
+                self._rankings = {}
+
+    @staticmethod
+    def _count(state, school_id, inserted_pages):
+        for row in inserted_pages:
+            day = row['day']
+            if day < state.first_day:
+                continue
+            counts = state.pages[day].setdefault((row['book_id'], row['page_number']), [0, 0, 0])
+            counts[0] += row['sessions']
+            counts[1] += row['timed_sessions']
+            counts[2] += row['active_time_ms']
+            schools = state.last_days[row['book_id']]
+            if schools.get(school_id, day) <= day:
+                schools[school_id] = day
+
+    def top_books(self, window, limit):
+        """The `limit` (at most k) books with the most active time in `window`"""
+        return self._ranking('books', window)[:limit]
+
+    def top_pages(self, window, limit):
+        """The `limit` (at most k) pages with the most active time in `window`"""
+        return self._ranking('pages', window)[:limit]
+
+    def _ranking(self, kind, window):
+        today = self.today()
+        key = (kind, window, today)
+        ranking = self._rankings.get(key)
+        if ranking is None:
+            first_day = window_first_day(window, today)
+            with self._lock:
+                ranking = self._rank(kind, first_day)
+                self._rankings[key] = ranking
+        return ranking
+
+    def _rank(self, kind, first_day):
+        state = self.state
+        totals = defaultdict(lambda: [0, 0, 0])
+        for day, counts in state.pages.items():
+            if day < first_day:
+                continue
+            for (book_id, page_number), (sessions, timed, active) in counts.items():
+                total = totals[(book_id, page_number) if kind == 'pages' else book_id]
+                total[0] += sessions
+                total[1] += timed
+                total[2] += active
+
+        if kind == 'pages':
+            # Same order as TOP_PAGES_SQL: active time, then book and page
+            top = heapq.nlargest(self.k, totals.items(),
+                                 key=lambda item: (item[1][2], -item[0][0], -item[0][1]))
+            return [{
+                'bookId': book_id,
+                'bookTitle': state.titles.get(book_id),
+                'pageNumber': page_number,
+                'totalSessions': sessions,
+                'avgActiveTimeMs': _round_avg(active, timed),
+                'totalActiveTimeMs': active,
+            } for (book_id, page_number), (sessions, timed, active) in top]
+
+        top = heapq.nlargest(self.k, totals.items(), key=lambda item: (item[1][2], -item[0]))
+        return [{
+            'bookId': book_id,
+            'bookTitle': state.titles.get(book_id),
+            'grade': book_id,
+            'totalActiveTimeMs': active,
+            'totalSessions': sessions,
+            'avgSessionTimeMs': _round_avg(active, timed) or 0,
+            'uniqueSchools': sum(1 for day in state.last_days.get(book_id, {}).values() if day >= first_day),
+        } for book_id, (sessions, timed, active) in top]
+
+    def stats(self):
+        state = self.state
+        if state is None:
+            return {'ready': False, 'lastError': self.last_error}
+        return {
+            'ready': True,
+            'k': self.k,
+            'firstDay': state.first_day.isoformat(),
+            'days': len(state.pages),
+            'pageCounters': sum(len(counts) for counts in state.pages.values()),
+            'bookSchools': sum(len(schools) for schools in state.last_days.values()),
+            'rankingsCached': len(self._rankings),
+            'lastRefreshMs': self.last_refresh_ms,
+            'lastError': self.last_error,
+        }